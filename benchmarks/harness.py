@@ -0,0 +1,150 @@
+"""Shared helpers for the benchmarks, and comparison of saved results.
+
+Benchmarks run with --output save their results as JSON along with the git
+commit, host and time of the run. Two saved runs of the same benchmark can be
+compared to see the change in each latency and throughput figure:
+
+    python benchmarks/harness.py old.json new.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values by the nearest rank"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[rank]
+
+
+def latency_stats(latencies, total):
+    """Summarize per-operation latencies in seconds and the total time taken"""
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=0.0) * 1000,
+        "throughput": len(latencies) / total if total else 0.0,
+    }
+
+
+def peak_rss(pid, children=False):
+    """Return the peak resident set size in bytes of a process, and its child
+    processes (such as gunicorn workers) if children is set. Read from /proc
+    where available, otherwise only the current process can be measured."""
+    pids = [pid]
+    if children:
+        try:
+            with open(f"/proc/{pid}/task/{pid}/children") as f:
+                pids += [int(child) for child in f.read().split()]
+        except OSError:
+            pass
+    total = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            if p != os.getpid():
+                return None
+            # kilobytes on Linux, bytes on macOS
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            total += rss if sys.platform == "darwin" else rss * 1024
+    return total
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(path, benchmark, args, results):
+    """Save benchmark results as JSON with details of the run"""
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "benchmark": benchmark,
+                "time": int(time.time()),
+                "commit": git_commit(),
+                "host": platform.node(),
+                "python": platform.python_version(),
+                "args": args,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results written to {path}")
+
+
+def flatten(result, prefix=""):
+    """Flatten nested results to dotted names of their numeric values"""
+    values = {}
+    for k, v in result.items():
+        if isinstance(v, dict):
+            values.update(flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            values[f"{prefix}{k}"] = v
+    return values
+
+
+def result_key(result):
+    """Identify a result by its non-numeric fields and the store sizes"""
+    return tuple(
+        (k, v)
+        for k, v in sorted(result.items())
+        if isinstance(v, str) or k in ("size", "payload", "clients")
+    )
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['benchmark']}: {old['commit']} -> {new['commit']}")
+    old_results = {result_key(r): r for r in old["results"]}
+    for r in new["results"]:
+        key = result_key(r)
+        if key not in old_results:
+            continue
+        print(", ".join(f"{k}={v}" for k, v in key))
+        old_values = flatten(old_results[key])
+        for name, value in flatten(r).items():
+            if name in dict(key) or not old_values.get(name):
+                continue
+            change = (value - old_values[name]) / old_values[name] * 100
+            print(
+                f"  {name:<28} {old_values[name]:>12.2f} {value:>12.2f} {change:>+7.1f}%"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("old", help="earlier results JSON file")
+    parser.add_argument("new", help="later results JSON file")
+    args = parser.parse_args()
+    compare(args.old, args.new)
+
+
+if __name__ == "__main__":
+    main()
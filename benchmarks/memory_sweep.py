@@ -0,0 +1,56 @@
+"""Time memory store expiry sweeps at increasing store sizes.
+
+Each run fills a memory store with secrets, a fixed number of which are
+expired, and times one delete_expired() sweep. The sweep time should stay flat
+as the store grows since only due secrets are visited.
+
+    python benchmarks/memory_sweep.py --sizes 1000 10000 100000 --expired 100
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from whisper import AttrDict, secret  # noqa: E402
+from whisper.storage.memory import memory  # noqa: E402
+
+
+def make_secret(expire_date):
+    s = secret()
+    s.new_id()
+    s.create_date = int(time.time())
+    s.expire_date = expire_date
+    s.data = "U2FsdGVkX1/qMytBOYisCGZ3KjpkowinHQhu12lGY8E="
+    s.hash = "$2b$12$ku/b46sSaK45f9jV.t8/2OfZoiCtjk8kzC5QBjQsieFai/HLCaYMy"
+    return s
+
+
+def run(size, expired):
+    backend = memory()
+    backend.config = AttrDict(backend.default_config)
+    backend.start()
+    now = int(time.time())
+    for i in range(size):
+        backend.set_secret(make_secret(now - 1 if i < expired else now + 3600))
+    start = time.perf_counter()
+    backend.delete_expired()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--expired", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'stored':>10} {'expired':>8} {'sweep ms':>10}")
+    for size in args.sizes:
+        elapsed = run(size, args.expired)
+        print(f"{size:>10} {args.expired:>8} {elapsed * 1000:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
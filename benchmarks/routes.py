@@ -0,0 +1,197 @@
+"""Load test the HTTP routes with concurrent clients.
+
+Each client repeatedly creates a secret, loads its page and retrieves it, and
+the p50/p99 latency of each route, the overall throughput and the peak RSS of
+the server processes are reported for each number of clients. Unless --url is
+given, gunicorn is started from src with a config using the local disk store
+(or the given --config file), a low bcrypt cost so hashing doesn't dominate,
+and attempt limits disabled since every client shares one IP:
+
+    python benchmarks/routes.py --clients 1 8 32 --requests 50 --output routes.json
+
+Uploads are sent as JSON, or as octet-stream bodies with --stream. Results
+are also written as JSON with --output, see harness.py.
+"""
+
+import argparse
+import base64
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import yaml
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from harness import latency_stats, peak_rss, write_results  # noqa: E402
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def write_config(path, args):
+    config = {
+        "secret_key": "benchmark-secret-key",
+        "storage_class": "whisper.storage.local.local",
+        "storage_config": {"path": os.path.join(path, "secrets")},
+        "hash_config": {"algorithm": "bcrypt", "params": {"rounds": args.rounds}},
+        "attempt_limit_config": {"enabled": False},
+        "max_data_size_mb": max(1, args.payload * 2 // 1048576 + 1),
+    }
+    config_path = os.path.join(path, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config, f)
+    return config_path
+
+
+def start_server(path, args):
+    """Start gunicorn and wait until it answers"""
+    env = {**os.environ, "CONFIG_FILE": args.config or write_config(path, args)}
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "--bind",
+            f"127.0.0.1:{args.port}",
+            "--workers",
+            str(args.workers),
+            "--threads",
+            str(args.threads),
+            "--log-level",
+            "warning",
+            "app:app",
+        ],
+        cwd=SRC,
+        env=env,
+    )
+    url = f"http://127.0.0.1:{args.port}/"
+    for _ in range(100):
+        try:
+            requests.get(url, timeout=1)
+            return server, url
+        except requests.ConnectionError:
+            if server.poll() is not None:
+                sys.exit("gunicorn exited, see its output above")
+            time.sleep(0.1)
+    server.terminate()
+    sys.exit("gunicorn did not start")
+
+
+def client(url, args, data, latencies, errors):
+    """Create, view and retrieve secrets, recording the latency of each"""
+    session = requests.Session()
+    for _ in range(args.requests):
+        try:
+            t = time.perf_counter()
+            if args.stream:
+                r = session.post(
+                    url,
+                    data=data,
+                    headers={
+                        "Content-Type": "application/octet-stream",
+                        "X-Whisper-Password": "benchmark",
+                        "X-Whisper-Expiration": "1 hour",
+                    },
+                )
+            else:
+                r = session.post(
+                    url,
+                    json={
+                        "expiration": "1 hour",
+                        "password": "benchmark",
+                        "encrypted_data": data.decode("ascii"),
+                    },
+                )
+            r.raise_for_status()
+            secret_id = r.json()["id"]
+            latencies["create"].append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            session.get(f"{url}{secret_id}", allow_redirects=False).raise_for_status()
+            latencies["page"].append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            r = session.post(f"{url}{secret_id}", json={"password": "benchmark"})
+            r.raise_for_status()
+            if r.json().get("encrypted_data") != data.decode("ascii"):
+                raise ValueError(f"Secret {secret_id} was not retrieved")
+            latencies["retrieve"].append(time.perf_counter() - t)
+        except (requests.RequestException, ValueError) as e:
+            errors.append(str(e))
+
+
+def run(url, clients, args):
+    data = base64.b64encode(os.urandom(args.payload))
+    latencies = {"create": [], "page": [], "retrieve": []}
+    errors = []
+    threads = [
+        threading.Thread(target=client, args=(url, args, data, latencies, errors))
+        for _ in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = time.perf_counter() - start
+    result = {"clients": clients, "payload": args.payload, "errors": len(errors)}
+    for route, values in latencies.items():
+        result[route] = latency_stats(values, total)
+    result["throughput"] = sum(len(v) for v in latencies.values()) / total
+    if errors:
+        print(f"{len(errors)} errors, first: {errors[0]}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="benchmark a running server instead")
+    parser.add_argument("--config", help="config file for the started server")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument(
+        "--requests", type=int, default=50, help="secrets created per client"
+    )
+    parser.add_argument("--payload", type=int, default=4096, help="bytes per secret")
+    parser.add_argument("--stream", action="store_true", help="octet-stream uploads")
+    parser.add_argument("--rounds", type=int, default=4, help="bcrypt rounds")
+    parser.add_argument("--port", type=int, default=5080)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        server, url = (None, args.url) if args.url else start_server(path, args)
+        try:
+            results = []
+            print("times in ms, throughput in requests per second")
+            print(f"{'clients':>8} {'route':>9} {'p50':>8} {'p99':>8} {'req/s':>8}")
+            for clients in args.clients:
+                r = run(url, clients, args)
+                # the high water mark so far, so it grows with the client count
+                r["peak_rss_bytes"] = (
+                    peak_rss(server.pid, children=True) if server else None
+                )
+                results.append(r)
+                for route in ["create", "page", "retrieve"]:
+                    print(
+                        f"{clients:>8} {route:>9} {r[route]['p50_ms']:>8.1f} "
+                        f"{r[route]['p99_ms']:>8.1f} {r[route]['throughput']:>8.1f}"
+                    )
+            if results and results[-1]["peak_rss_bytes"]:
+                rss = results[-1]["peak_rss_bytes"] / 1048576
+                print(f"Peak server RSS: {rss:.1f} MB")
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+    if args.output:
+        write_results(args.output, "routes", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
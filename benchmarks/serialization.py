@@ -0,0 +1,72 @@
+"""Compare the JSON and binary secret storage formats.
+
+A secret with a random base64 payload, like the ciphertext sent by the
+browser, is serialized and deserialized in each format, and the stored size
+and time per operation are reported.
+
+    python benchmarks/serialization.py --payload 1048576 --rounds 200
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from whisper import secret, serialization  # noqa: E402
+
+
+def make_secret(payload):
+    s = secret()
+    s.new_id()
+    s.create_date = int(time.time())
+    s.expire_date = s.create_date + 3600
+    s.data = base64.b64encode(os.urandom(payload)).decode("utf-8")
+    s.hash = "$2b$12$ku/b46sSaK45f9jV.t8/2OfZoiCtjk8kzC5QBjQsieFai/HLCaYMy"
+    return s
+
+
+def timed(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--payload", type=int, default=1048576, help="bytes")
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    s = make_secret(args.payload)
+    json_data = json.dumps(s.__dict__).encode("utf-8")
+    binary_data = serialization.dumps(s)
+    header = binary_data[: serialization.HEADER.size + len(s.hash)]
+    results = {
+        "json": (
+            len(json_data),
+            timed(lambda: json.dumps(s.__dict__).encode("utf-8"), args.rounds),
+            timed(lambda: serialization.loads(json_data), args.rounds),
+            None,
+        ),
+        "binary": (
+            len(binary_data),
+            timed(lambda: serialization.dumps(s), args.rounds),
+            timed(lambda: serialization.loads(binary_data), args.rounds),
+            timed(lambda: serialization.loads(header, header_only=True), args.rounds),
+        ),
+    }
+
+    print(f"{args.payload} byte payload, times in µs")
+    print(f"{'format':>8} {'bytes':>10} {'dump':>10} {'load':>10} {'header':>10}")
+    for name, (size, dump, load, head) in results.items():
+        head = f"{head * 1e6:>10.1f}" if head is not None else f"{'-':>10}"
+        print(f"{name:>8} {size:>10} {dump * 1e6:>10.1f} {load * 1e6:>10.1f} {head}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Compare the SQLite and local disk stores.
+
+Each backend is given a fresh directory, then the time to set, get and clean
+up a number of secrets is measured. Half of the secrets are expired so the
+cleaner has work to do.
+
+    python benchmarks/sqlite_vs_local.py --count 5000 --payload 4096
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from whisper import check_config, secret  # noqa: E402
+from whisper.storage.local import local  # noqa: E402
+from whisper.storage.sqlite import sqlite  # noqa: E402
+
+
+def make_secrets(count, payload):
+    now = int(time.time())
+    secrets = []
+    for i in range(count):
+        s = secret()
+        s.new_id()
+        s.create_date = now
+        s.expire_date = now - 1 if i % 2 else now + 3600
+        s.data = "A" * payload
+        s.hash = "$2b$12$ku/b46sSaK45f9jV.t8/2OfZoiCtjk8kzC5QBjQsieFai/HLCaYMy"
+        secrets.append(s)
+    return secrets
+
+
+def make_backend(backend_class, path):
+    backend = backend_class()
+    if backend_class is sqlite:
+        path = os.path.join(path, "whisper.db")
+    config = {**backend.default_config, "path": path}
+    backend.config = check_config(config, backend.default_config)
+    backend.start()
+    return backend
+
+
+def timed(fn, items):
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return time.perf_counter() - start
+
+
+def run(backend_class, secrets):
+    with tempfile.TemporaryDirectory() as path:
+        backend = make_backend(backend_class, path)
+        ids = [s.id for s in secrets]
+        results = {
+            "set": timed(backend.set_secret, secrets),
+            "get": timed(backend.get_secret, ids),
+        }
+        start = time.perf_counter()
+        backend.delete_expired()
+        results["delete_expired"] = time.perf_counter() - start
+        results["delete"] = timed(backend.delete_secret, ids)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--payload", type=int, default=4096, help="bytes per secret")
+    args = parser.parse_args()
+
+    secrets = make_secrets(args.count, args.payload)
+    print(f"{args.count} secrets of {args.payload} bytes, times in ms")
+    print(f"{'backend':>8} {'set':>10} {'get':>10} {'expire':>10} {'delete':>10}")
+    for backend_class in [local, sqlite]:
+        r = run(backend_class, secrets)
+        print(
+            f"{backend_class.__name__:>8} {r['set'] * 1000:>10.1f} "
+            f"{r['get'] * 1000:>10.1f} {r['delete_expired'] * 1000:>10.1f} "
+            f"{r['delete'] * 1000:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
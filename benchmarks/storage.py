@@ -0,0 +1,159 @@
+"""Benchmark set, get, delete and delete_expired on the storage backends.
+
+Each backend is filled with a number of secrets (half of them expired), then
+a sample of secrets is set, read and deleted one at a time and latency
+percentiles and throughput are reported along with the time of one cleaner
+sweep. The S3 and GCS stores are run against local stand-ins such as moto
+server and fake-gcs-server, and are skipped unless an endpoint is given:
+
+    moto_server -p 5001 &
+    docker run -d -p 4443:4443 fsouza/fake-gcs-server -scheme http
+    python benchmarks/storage.py --backends memory local s3 gcs \\
+        --sizes 1000 10000 --payloads 1024 65536 \\
+        --s3-endpoint http://localhost:5001 --gcs-endpoint http://localhost:4443 \\
+        --output storage.json
+
+Results are also written as JSON with --output, see harness.py.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from harness import latency_stats, peak_rss, write_results  # noqa: E402
+from whisper import check_config, secret  # noqa: E402
+
+
+def make_secret(now, payload, expired=False):
+    s = secret()
+    s.new_id()
+    s.create_date = now
+    s.expire_date = now - 1 if expired else now + 3600
+    s.data = "A" * payload
+    s.hash = "$2b$12$ku/b46sSaK45f9jV.t8/2OfZoiCtjk8kzC5QBjQsieFai/HLCaYMy"
+    return s
+
+
+def make_backend(name, path, args):
+    """Create and start a backend with a fresh directory or bucket"""
+    bucket = f"whisper-bench-{uuid.uuid4().hex[:8]}"
+    if name == "memory":
+        from whisper.storage.memory import memory as backend_class
+
+        config = {}
+    elif name == "local":
+        from whisper.storage.local import local as backend_class
+
+        config = {"path": path}
+    elif name == "s3":
+        import boto3
+        from whisper.storage.aws import s3 as backend_class
+
+        boto3.client("s3", endpoint_url=args.s3_endpoint).create_bucket(Bucket=bucket)
+        config = {"bucket_name": bucket, "endpoint_url": args.s3_endpoint}
+    elif name == "gcs":
+        # the GCS client connects to an emulator with anonymous credentials
+        os.environ["STORAGE_EMULATOR_HOST"] = args.gcs_endpoint
+        from google.cloud import storage
+        from whisper.storage.gcp import gcs as backend_class
+
+        storage.Client(project="whisper-bench").create_bucket(bucket)
+        config = {"bucket_name": bucket, "gcp_project": "whisper-bench"}
+    backend = backend_class()
+    backend.config = check_config(
+        {**backend.default_config, **config}, backend.default_config
+    )
+    backend.start()
+    return backend
+
+
+def timed(fn, items):
+    """Call fn with each item, returning the latency of each call and the
+    total time"""
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        fn(item)
+        latencies.append(time.perf_counter() - t)
+    return latencies, time.perf_counter() - start
+
+
+def run(name, size, payload, args):
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as path:
+        backend = make_backend(name, path, args)
+        for i in range(size):
+            backend.set_secret(make_secret(now, payload, expired=i % 2))
+        sample = [make_secret(now, payload) for _ in range(min(args.sample, size))]
+        ids = [s.id for s in sample]
+        result = {"backend": name, "size": size, "payload": payload}
+        for op, fn, items in [
+            ("set", backend.set_secret, sample),
+            ("get", backend.get_secret, ids),
+            ("delete", backend.delete_secret, ids),
+        ]:
+            latencies, total = timed(fn, items)
+            result[op] = latency_stats(latencies, total)
+        start = time.perf_counter()
+        backend.delete_expired()
+        result["delete_expired_s"] = time.perf_counter() - start
+        result["peak_rss_bytes"] = peak_rss(os.getpid())
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["memory", "local"],
+        choices=["memory", "local", "s3", "gcs"],
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument(
+        "--payloads", type=int, nargs="+", default=[1024], help="bytes per secret"
+    )
+    parser.add_argument(
+        "--sample", type=int, default=500, help="secrets timed per operation"
+    )
+    parser.add_argument("--s3-endpoint", default="", help="e.g. moto server URL")
+    parser.add_argument("--gcs-endpoint", default="", help="fake-gcs-server URL")
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    print("times in ms, throughput in operations per second")
+    print(
+        f"{'backend':>8} {'size':>8} {'payload':>8} {'op':>7} {'p50':>8} "
+        f"{'p99':>8} {'ops/s':>9}"
+    )
+    for name in args.backends:
+        if name in ("s3", "gcs") and not getattr(args, f"{name}_endpoint"):
+            print(f"Skipping {name}, no --{name}-endpoint given")
+            continue
+        for size in args.sizes:
+            for payload in args.payloads:
+                r = run(name, size, payload, args)
+                results.append(r)
+                for op in ["set", "get", "delete"]:
+                    print(
+                        f"{name:>8} {size:>8} {payload:>8} {op:>7} "
+                        f"{r[op]['p50_ms']:>8.2f} {r[op]['p99_ms']:>8.2f} "
+                        f"{r[op]['throughput']:>9.0f}"
+                    )
+                print(
+                    f"{name:>8} {size:>8} {payload:>8} {'expire':>7} "
+                    f"{r['delete_expired_s'] * 1000:>8.1f}"
+                )
+    if args.output:
+        write_results(args.output, "storage", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
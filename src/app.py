@@ -1,19 +1,27 @@
+import json
 import logging
 import os
 
 from flask import (
     Flask,
+    Response,
+    abort,
     jsonify,
     redirect,
     render_template,
     request,
     send_from_directory,
+    stream_with_context,
     url_for,
 )
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from whisper import load_config, secret
-from whisper.storage import store
+from whisper.hashing import HashPoolError, hash_executor, load_hasher
+from whisper.limiter import attempt_limiter
+from whisper.metrics import metrics
+from whisper.serialization import FormatError
+from whisper.storage import StoreFullError, store
 
 __version__ = "0.1.0"
 
@@ -29,6 +37,9 @@ if __name__ != "__main__":
 config_filename = os.environ.get("CONFIG_FILE", "config.yaml")
 config = load_config(config_filenames=[config_filename])
 
+# expiration choices offered by the secret form
+EXPIRATIONS = ("One time use", "1 hour", "1 day", "1 week")
+
 
 @app.route(f"{config.app_url_base}assets/<path:path>")
 def send_assets(path):
@@ -50,6 +61,8 @@ def new_secret():
 @app.route(f"{config.app_url_base}", methods=["POST"])
 def create_secret():
     """Create a new secret"""
+    if request.mimetype == "application/octet-stream":
+        return create_secret_stream()
     # This has to be here in order for Flask to check against MAX_CONTENT_LENGTH
     # See: https://github.com/pallets/flask/issues/2690
     request.data
@@ -66,14 +79,42 @@ def create_secret():
     return jsonify({"id": s.id})
 
 
+def create_secret_stream():
+    """Create a new secret from a request body holding only the encrypted
+    data, with the other fields in headers. The data is passed to the store as
+    it is read instead of being held in memory."""
+    if request.content_length is None:
+        abort(411)
+    if request.content_length > app.config["MAX_CONTENT_LENGTH"]:
+        abort(413)
+    password = request.headers.get("X-Whisper-Password")
+    expiration = request.headers.get("X-Whisper-Expiration")
+    if password is None:
+        return invalid_header("Missing X-Whisper-Password header.")
+    if expiration not in EXPIRATIONS:
+        return invalid_header("Missing or invalid X-Whisper-Expiration header.")
+    s = secret()
+    s.create(
+        expiration=expiration,
+        key_pass=s.get_key_pass(password, config.secret_key),
+        data=None,
+    )
+    app.logger.info(f"[{request.remote_addr}] Secret create: {s.id}")
+    store.set_secret_stream(s, request.stream)
+    return jsonify({"id": s.id})
+
+
+def invalid_header(message):
+    app.logger.info(f"[{request.remote_addr}] {message}")
+    return jsonify({"result": message}), 400
+
+
 @app.route(f"{config.app_url_base}<string:secret_id>", methods=["GET"])
 def get_secret(secret_id):
     """Display page to retrieve secret"""
-    # get secret object if it exists in storage
-    s = store.get_secret(secret_id)
-    # if the secret exists, display the password page
-    if s and s.check_id():
-        app.logger.info(f"[{request.remote_addr}] Secret request: {s.id}")
+    # check the secret exists without retrieving its data
+    if store.secret_exists(secret_id):
+        app.logger.info(f"[{request.remote_addr}] Secret request: {secret_id}")
         return render_template(
             "show.html",
             version=__version__,
@@ -85,27 +126,61 @@ def get_secret(secret_id):
 @app.route(f"{config.app_url_base}<string:secret_id>", methods=["POST"])
 def show_secret(secret_id):
     """Retrieve encrypted data."""
-    # get secret
-    s = store.get_secret(secret_id)
-    if not s or not s.check_id():
+    # throttle attempts before doing any storage or hashing work
+    if not limiter.allow(secret_id, request.remote_addr):
+        app.logger.info(f"[{request.remote_addr}] Secret throttled: {secret_id}")
+        return jsonify({"result": "Too many attempts, try again later."}), 429
+
+    # get the secret and check the password, one-time secrets are deleted
+    key_pass = secret().get_key_pass(request.json["password"], config.secret_key)
+    s, valid, chunks = store.consume_secret_stream(
+        secret_id, lambda s: s.check_password(key_pass)
+    )
+    if not s:
         app.logger.info(
             f"[{request.remote_addr}] Secret invalid secret_id: {secret_id}"
         )
         return jsonify({"result": "Invalid ID"})
-
-    # check the password
-    key_pass = s.get_key_pass(request.json["password"], config.secret_key)
-    if not s.check_password(key_pass):
+    if not valid:
         app.logger.info(f"[{request.remote_addr}] Secret invalid password: {s.id}")
+        if limiter.record_failure(s.id):
+            store.delete_secret(s.id)
+            app.logger.info(f"[{request.remote_addr}] Secret burned: {s.id}")
         return jsonify({"result": "Invalid password."})
+    limiter.reset_failures(s.id)
 
-    # delete if one-time secret
-    if s.is_one_time():
-        store.delete_secret(secret_id)
+    # rehash multi-use secrets that were hashed with other settings
+    if not s.is_one_time() and s.needs_rehash():
+        rehashed = store.get_secret(s.id)
+        if rehashed:
+            rehashed.set_password(key_pass)
+            store.set_secret(rehashed)
+            app.logger.info(f"[{request.remote_addr}] Secret rehashed: {s.id}")
 
-    # return the secret
+    # stream the secret back as it is read from the store
     app.logger.info(f"[{request.remote_addr}] Secret retrieved: {s.id}")
-    return jsonify({"encrypted_data": s.data})
+    return Response(
+        stream_with_context(encrypted_data_json(chunks)),
+        mimetype="application/json",
+    )
+
+
+def encrypted_data_json(chunks):
+    """Generate the JSON response body for the encrypted data a chunk at a
+    time"""
+    yield '{"encrypted_data": "'
+    for chunk in chunks:
+        yield json.dumps(chunk)[1:-1]
+    yield '"}'
+
+
+@app.route(f"{config.app_url_base}metrics", methods=["GET"])
+def show_metrics():
+    """Metrics of all worker processes in the Prometheus format"""
+    if not metrics.enabled:
+        abort(404)
+    body, content_type = metrics.render()
+    return Response(body, mimetype=content_type)
 
 
 @app.errorhandler(404)
@@ -123,13 +198,68 @@ def request_entity_too_large(error):
     )
 
 
-# load backend store
-store = store(
-    config.storage_class,
-    config.storage_config,
-    clean_interval=config.storage_clean_interval,
-)
-store.start()
+@app.errorhandler(FormatError)
+def invalid_data(error):
+    app.logger.info(f"[{request.remote_addr}] {error.message}")
+    return jsonify({"result": "Invalid encrypted data."}), 400
+
+
+@app.errorhandler(HashPoolError)
+def hash_pool_unavailable(error):
+    app.logger.warning(f"[{request.remote_addr}] {error.message}")
+    return (
+        jsonify({"result": "Server is busy, please try again."}),
+        503,
+    )
+
+
+@app.errorhandler(StoreFullError)
+def store_full(error):
+    app.logger.warning(f"[{request.remote_addr}] {error.message}")
+    return (
+        jsonify({"result": "Secret storage is full, please try again later."}),
+        507,
+    )
+
+
+def start():
+    """Start metrics, the hash pool, the attempt limiter and the store. When
+    the app is run directly, hash pool workers import this module again as
+    __mp_main__, and this is skipped for them."""
+    global hash_pool, limiter, store
+
+    # start metrics before anything records them
+    metrics.start(config.metrics_config)
+
+    # start password hashing pool
+    hash_pool = hash_executor(config.hash_config)
+    hash_pool.start()
+    metrics.add_gauges("hash_pool", hash_pool.stats, "livesum")
+    secret.executor = hash_pool
+    secret.hasher = load_hasher(
+        hash_pool.config.algorithm,
+        hash_pool.config.params,
+        hash_pool.config.target_ms,
+        hash_pool.config.max_memory_mb,
+    )
+
+    # start retrieval attempt limiter
+    limiter = attempt_limiter(config.attempt_limit_config)
+    limiter.start()
+
+    # load backend store
+    store = store(
+        config.storage_class,
+        config.storage_config,
+        clean_interval=config.storage_clean_interval,
+        cache_config=config.storage_cache_config,
+        filter_config=config.storage_filter_config,
+    )
+    store.start()
+
+
+if __name__ != "__mp_main__":
+    start()
 
 # set max content length
 app.config["MAX_CONTENT_LENGTH"] = config.max_data_size_mb * 1000 * 1000
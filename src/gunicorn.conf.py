@@ -0,0 +1,16 @@
+import os
+
+from whisper import load_config
+from whisper.metrics import metrics
+
+# gunicorn loads this file from the working directory
+config = load_config(config_filenames=[os.environ.get("CONFIG_FILE", "config.yaml")])
+
+
+def on_starting(server):
+    """Clear metrics left by an earlier run before any workers start"""
+    metrics.clear(config.metrics_config)
+
+
+def child_exit(server, worker):
+    metrics.process_exit(config.metrics_config, worker.pid)
@@ -4,9 +4,10 @@ import os
 import secrets
 import time
 
-import bcrypt
 import yaml
 
+from whisper.hashers import bcrypt_hasher, identify_hasher
+
 logger = logging.getLogger("whisper")
 
 
@@ -95,6 +96,11 @@ def load_config(config_filenames=["config.yaml"]):
         "storage_class": None,
         "storage_config": {},
         "storage_clean_interval": 900,
+        "storage_cache_config": {},
+        "storage_filter_config": {},
+        "hash_config": {},
+        "attempt_limit_config": {},
+        "metrics_config": {},
         "max_data_size_mb": 1,
         "app_listen_ip": "0.0.0.0",
         "app_port": "5000",
@@ -133,6 +139,12 @@ def class_loader(classname, *args, **kwargs):
 class secret:
     """Secret Class"""
 
+    # optional whisper.hashing.hash_executor used to run bcrypt off the
+    # request thread, hashing is run inline if this is not set
+    executor = None
+    # password hasher used for new hashes, see whisper.hashing.load_hasher
+    hasher = bcrypt_hasher(rounds=12)
+
     def __init__(self, secret_id=None, expiration=None, key_pass=None, data=None):
         self.id = secret_id
         self.create_date = None
@@ -197,6 +209,13 @@ class secret:
             )
         )
 
+    def expires_at(self):
+        """Get epoch seconds of when the secret is considered expired. One-time
+        secrets that are never retrieved expire 30 days after creation."""
+        if self.is_one_time():
+            return (self.create_date or 0) + 86400 * 30
+        return self.expire_date or 0
+
     def is_one_time(self):
         """Check if secret is one-time"""
         return self.expire_date == -1
@@ -206,12 +225,27 @@ class secret:
         return key.encode("utf-8") + password.encode("utf-8")
 
     def check_password(self, key_pass):
-        """Check if a key_pass matches the stored salted SHA"""
+        """Check if a key_pass matches the stored salted hash, using whichever
+        algorithm and parameters the hash was created with"""
         if not self.hash:
             return False
-        return bcrypt.checkpw(key_pass, self.hash.encode("utf-8"))
+        try:
+            stored_hasher = identify_hasher(self.hash)
+        except ValueError:
+            logger.error(f"Unknown password hash format for secret: {self.id}")
+            return False
+        return self.run_hash(stored_hasher.verify, key_pass, self.hash)
 
-    def set_password(self, key_pass, salt_rounds=12):
+    def set_password(self, key_pass):
         """Generate salted hash and store it"""
-        salt = bcrypt.gensalt(rounds=salt_rounds)
-        self.hash = bcrypt.hashpw(key_pass, salt).decode("utf-8")
+        self.hash = self.run_hash(self.hasher.hash, key_pass)
+
+    def needs_rehash(self):
+        """Check if the stored hash does not match the current hasher"""
+        return bool(self.hash) and self.hasher.needs_rehash(self.hash)
+
+    def run_hash(self, fn, *args):
+        """Run a hashing function on the hash executor if one is set"""
+        if self.executor:
+            return self.executor.run(fn, *args)
+        return fn(*args)
@@ -105,9 +105,11 @@ async function get_base64(file_input) {
 
 // Send API request
 function send_new_link_data(encrypted, password, expiration, success, failure) {
-    let api_data = {'encrypted_data': encrypted.toString(), 'password': pw_hash(password), 'expiration': expiration};
+    // the encrypted data is sent as the request body so the server can
+    // stream it to storage, the other fields are sent as headers
+    let headers = {'X-Whisper-Password': pw_hash(password), 'X-Whisper-Expiration': expiration};
     document.getElementById('secret_link').value = 'Uploading data and generating link...';
-    api_call("POST", api_data, success, failure);
+    api_upload(encrypted.toString(), headers, success, failure);
 }
 
 // Generate a new secret link
@@ -216,14 +218,33 @@ function api_call(type, api_data, success_callback, failure_callback) {
         data: JSON.stringify(api_data),
         dataType: 'json',
         async: true,
-        complete: function (xhr, textStatus) {
-            response = $.parseJSON(xhr.responseText);
-            if (textStatus != 'success' && failure_callback) {
-                failure_callback(response);
-            }
-            else if (success_callback) {
-                success_callback(response);
-            }
-        }
+        complete: api_complete(success_callback, failure_callback)
     });
 }
+
+// Upload raw data as the request body, with fields as headers
+function api_upload(data, headers, success_callback, failure_callback) {
+    $.ajax({
+        type: "POST",
+        processData: false,
+        contentType: 'application/octet-stream',
+        headers: headers,
+        data: data,
+        dataType: 'json',
+        async: true,
+        complete: api_complete(success_callback, failure_callback)
+    });
+}
+
+// Handle an API response
+function api_complete(success_callback, failure_callback) {
+    return function (xhr, textStatus) {
+        response = $.parseJSON(xhr.responseText);
+        if (textStatus != 'success' && failure_callback) {
+            failure_callback(response);
+        }
+        else if (success_callback) {
+            success_callback(response);
+        }
+    };
+}
@@ -0,0 +1,232 @@
+import base64
+import hashlib
+import hmac
+import logging
+import math
+import os
+import time
+
+import bcrypt
+
+try:
+    import argon2
+except ImportError:
+    argon2 = None
+
+logger = logging.getLogger(__name__)
+
+# sample key used for calibration benchmarks
+CALIBRATION_KEY = b"whisper-calibration-key"
+
+
+class hasher:
+    """Password hasher base class. Hashes are self describing strings which
+    carry the algorithm and parameters used to create them, so any stored hash
+    can be verified after the configured parameters change."""
+
+    name = None
+    prefix = None
+    default_params = {}
+
+    def __init__(self, **params):
+        self.params = {**self.default_params, **params}
+
+    def hash(self, key_pass):
+        """Return a salted hash string of key_pass"""
+        raise NotImplementedError
+
+    def verify(self, key_pass, hashed):
+        """Check if key_pass matches a hash string"""
+        raise NotImplementedError
+
+    def params_from_hash(self, hashed):
+        """Parse the parameters out of a hash string"""
+        raise NotImplementedError
+
+    def cost(self, params):
+        """Relative amount of work done for a set of parameters"""
+        raise NotImplementedError
+
+    def calibrate(self, target_ms, max_memory=0):
+        """Benchmark the host and set parameters to take about target_ms,
+        using at most max_memory bytes per hash if it is set"""
+        raise NotImplementedError
+
+    def memory(self, params):
+        """Bytes of memory used by one hash with a set of parameters"""
+        return 0
+
+    def hash_length(self):
+        """Length of the hash strings made with the current parameters"""
+        raise NotImplementedError
+
+    def needs_rehash(self, hashed):
+        """Check if a hash was made with a different algorithm or with a cost
+        more than a factor of two away from the current parameters"""
+        if not hashed.startswith(self.prefix):
+            return True
+        try:
+            ratio = self.cost(self.params_from_hash(hashed)) / self.cost(self.params)
+        except (ValueError, IndexError, KeyError):
+            return True
+        return not 0.5 <= ratio <= 2
+
+    def time_hash(self, **params):
+        """Milliseconds taken to hash with the given parameters"""
+        sample = self.__class__(**{**self.params, **params})
+        start = time.perf_counter()
+        sample.hash(CALIBRATION_KEY)
+        return (time.perf_counter() - start) * 1000
+
+    def __repr__(self):
+        return f"{self.name}({self.params})"
+
+
+class bcrypt_hasher(hasher):
+    name = "bcrypt"
+    prefix = "$2"
+    default_params = {"rounds": 12}
+
+    def hash(self, key_pass):
+        salt = bcrypt.gensalt(rounds=self.params["rounds"])
+        return bcrypt.hashpw(key_pass, salt).decode("utf-8")
+
+    def verify(self, key_pass, hashed):
+        try:
+            return bcrypt.checkpw(key_pass, hashed.encode("utf-8"))
+        except ValueError:
+            return False
+
+    def params_from_hash(self, hashed):
+        return {"rounds": int(hashed.split("$")[2])}
+
+    def cost(self, params):
+        return 2 ** params["rounds"]
+
+    def hash_length(self):
+        return 60
+
+    def calibrate(self, target_ms, max_memory=0):
+        # each extra round doubles the work, so time a cheap setting and
+        # extrapolate instead of timing every candidate
+        sample_ms = self.time_hash(rounds=8)
+        rounds = 8 + round(math.log2(target_ms / max(sample_ms, 0.001)))
+        self.params["rounds"] = min(max(rounds, 4), 31)
+
+
+class scrypt_hasher(hasher):
+    name = "scrypt"
+    prefix = "$scrypt$"
+    default_params = {"ln": 15, "r": 8, "p": 1}
+
+    def hash(self, key_pass):
+        salt = os.urandom(16)
+        digest = self._scrypt(key_pass, salt, **self.params)
+        params = ",".join(f"{k}={v}" for k, v in self.params.items())
+        return f"{self.prefix}{params}${self._b64(salt)}${self._b64(digest)}"
+
+    def verify(self, key_pass, hashed):
+        try:
+            _, _, _, salt, digest = hashed.split("$")
+            params = self.params_from_hash(hashed)
+            expected = base64.b64decode(digest)
+            result = self._scrypt(key_pass, base64.b64decode(salt), **params)
+        except (ValueError, KeyError):
+            return False
+        return hmac.compare_digest(result, expected)
+
+    def params_from_hash(self, hashed):
+        params = dict(kv.split("=") for kv in hashed.split("$")[2].split(","))
+        return {k: int(params[k]) for k in self.default_params}
+
+    def cost(self, params):
+        return 2 ** params["ln"] * params["r"] * params["p"]
+
+    def memory(self, params):
+        return 128 * params["r"] * 2 ** params["ln"]
+
+    def calibrate(self, target_ms, max_memory=0):
+        # work is linear in n, so time a cheap setting and extrapolate
+        sample_ms = self.time_hash(ln=12)
+        ln = 12 + round(math.log2(target_ms / max(sample_ms, 0.001)))
+        ln = min(max(ln, 10), 22)
+        if max_memory:
+            # memory is linear in n too, each pool process needs this much
+            fits = int(math.log2(max(max_memory / (128 * self.params["r"]), 2)))
+            ln = min(ln, fits)
+        self.params["ln"] = ln
+
+    def hash_length(self):
+        params = ",".join(f"{k}={v}" for k, v in self.params.items())
+        # base64 of the 16 byte salt and the 64 byte digest
+        return len(f"{self.prefix}{params}$") + 24 + 1 + 88
+
+    def _scrypt(self, key_pass, salt, ln, r, p):
+        n = 2**ln
+        return hashlib.scrypt(
+            key_pass, salt=salt, n=n, r=r, p=p, maxmem=129 * n * r * p + 2**20
+        )
+
+    def _b64(self, value):
+        return base64.b64encode(value).decode("utf-8")
+
+
+class argon2id_hasher(hasher):
+    name = "argon2id"
+    prefix = "$argon2id$"
+    default_params = {"time_cost": 3, "memory_cost": 65536, "parallelism": 4}
+
+    def __init__(self, **params):
+        if not argon2:
+            raise ImportError("argon2-cffi is required for argon2id hashing")
+        super().__init__(**params)
+
+    def hash(self, key_pass):
+        return self._hasher().hash(key_pass)
+
+    def verify(self, key_pass, hashed):
+        try:
+            return self._hasher().verify(hashed, key_pass)
+        except argon2.exceptions.VerificationError:
+            return False
+        except argon2.exceptions.InvalidHash:
+            return False
+
+    def params_from_hash(self, hashed):
+        try:
+            params = argon2.extract_parameters(hashed)
+        except argon2.exceptions.InvalidHash:
+            raise ValueError(hashed)
+        return {k: getattr(params, k) for k in self.default_params}
+
+    def cost(self, params):
+        return params["time_cost"] * params["memory_cost"]
+
+    def memory(self, params):
+        return params["memory_cost"] * 1024
+
+    def calibrate(self, target_ms, max_memory=0):
+        # time_cost is linear, memory_cost and parallelism are left as set
+        sample_ms = self.time_hash(time_cost=1)
+        self.params["time_cost"] = max(round(target_ms / max(sample_ms, 0.001)), 1)
+
+    def hash_length(self):
+        h = self._hasher()
+        params = f"m={h.memory_cost},t={h.time_cost},p={h.parallelism}"
+        # unpadded base64 of the salt and the digest
+        salt, digest = math.ceil(h.salt_len * 4 / 3), math.ceil(h.hash_len * 4 / 3)
+        return len(f"{self.prefix}v=19${params}$") + salt + 1 + digest
+
+    def _hasher(self):
+        return argon2.PasswordHasher(type=argon2.Type.ID, **self.params)
+
+
+hashers = {h.name: h for h in [bcrypt_hasher, scrypt_hasher, argon2id_hasher]}
+
+
+def identify_hasher(hashed):
+    """Return a hasher able to verify the given hash string"""
+    for hasher_class in hashers.values():
+        if hashed.startswith(hasher_class.prefix):
+            return hasher_class()
+    raise ValueError("Unknown password hash format")
@@ -0,0 +1,177 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from whisper import ConfigError, check_config
+from whisper.hashers import hashers
+from whisper.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# the app's threads may hold locks at any time, a forked worker would inherit
+# them held, so workers are started from a single threaded fork server
+MP_CONTEXT = multiprocessing.get_context("forkserver")
+
+
+class HashPoolError(Exception):
+    """Hash Pool Error Base Exception"""
+
+    def __init__(self, message="Password hashing is unavailable"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class HashPoolFullError(HashPoolError):
+    """Hash Pool Queue Full Exception"""
+
+    def __init__(self, message="Password hashing queue is full"):
+        super().__init__(message)
+
+
+class HashPoolTimeoutError(HashPoolError):
+    """Hash Pool Timeout Exception"""
+
+    def __init__(self, message="Password hashing timed out"):
+        super().__init__(message)
+
+
+def load_hasher(algorithm, params={}, target_ms=0, max_memory_mb=0):
+    """Create the configured password hasher. If target_ms is set, benchmark
+    the host and pick parameters so that one hash takes about that long. If
+    max_memory_mb is set, one hash may use at most that much memory."""
+    if algorithm not in hashers:
+        raise ConfigError(algorithm, "Unknown password hash algorithm")
+    try:
+        password_hasher = hashers[algorithm](**params)
+    except (ImportError, TypeError) as e:
+        raise ConfigError(algorithm, f"Could not load password hasher ({e})")
+    max_memory = max_memory_mb * 2**20
+    if target_ms:
+        password_hasher.calibrate(target_ms, max_memory)
+        logger.info(
+            f"Calibrated {password_hasher} for {target_ms} ms, "
+            f"took {password_hasher.time_hash():.0f} ms"
+        )
+    if max_memory and password_hasher.memory(password_hasher.params) > max_memory:
+        raise ConfigError(
+            algorithm,
+            f"Hash parameters need more than {max_memory_mb} MB per hash",
+        )
+    return password_hasher
+
+
+def _timed_call(fn, *args):
+    """Run fn in the pool process, returning the wall clock start time so the
+    caller can compute how long the work sat in the queue."""
+    return time.time(), fn(*args)
+
+
+class hash_executor:
+    """Bounded process pool for CPU heavy password hashing, keeps hashing off
+    the request thread and fails fast when the queue is full."""
+
+    def __init__(self, hash_config={}):
+        self.default_config = {
+            "algorithm": "bcrypt",
+            "params": {},
+            "target_ms": 0,
+            "max_memory_mb": 64,
+            "workers": 0,
+            "queue_size": 64,
+            "timeout": 10,
+        }
+        config = {**self.default_config, **hash_config}
+        self.config = check_config(config, self.default_config)
+        self.workers = self.config.workers or os.cpu_count() or 1
+        self.pool = None
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.config.queue_size)
+        self.depth = 0
+        self.max_depth = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_last = 0.0
+
+    def start(self):
+        """Create the process pool, processes are spawned on first use"""
+        logger.debug(f"Hash pool - Starting with {self.workers} workers")
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=MP_CONTEXT)
+
+    def run(self, fn, *args):
+        """Run fn(*args) in the pool and return the result. Raises
+        HashPoolFullError if the queue is full and HashPoolTimeoutError if the
+        result is not ready within the configured timeout."""
+        # fn is a hasher's hash or verify method
+        with metrics.timed("hash", operation=fn.__name__, algorithm=fn.__self__.name):
+            return self._run(fn, *args)
+
+    def _run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            logger.warning(f"Hash pool - Queue full ({self.config.queue_size})")
+            raise HashPoolFullError()
+        with self.lock:
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self.submitted += 1
+        submit_time = time.time()
+        try:
+            future = self.pool.submit(_timed_call, fn, *args)
+        except BrokenProcessPool:
+            self._release()
+            self._restart()
+            raise HashPoolError()
+        future.add_done_callback(lambda f: self._release())
+        try:
+            start_time, result = future.result(timeout=self.config.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            with self.lock:
+                self.timeouts += 1
+            logger.warning(f"Hash pool - Timed out after {self.config.timeout}s")
+            raise HashPoolTimeoutError()
+        except BrokenProcessPool:
+            self._restart()
+            raise HashPoolError()
+        with self.lock:
+            self.wait_last = max(start_time - submit_time, 0.0)
+            self.wait_total += self.wait_last
+        return result
+
+    def stats(self):
+        """Return queue depth and wait time statistics"""
+        with self.lock:
+            completed = self.submitted - self.depth
+            return {
+                "workers": self.workers,
+                "queue_size": self.config.queue_size,
+                "queue_depth": self.depth,
+                "queue_depth_max": self.max_depth,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "wait_seconds_last": self.wait_last,
+                "wait_seconds_avg": self.wait_total / completed if completed else 0.0,
+            }
+
+    def _release(self):
+        with self.lock:
+            self.depth -= 1
+        self.slots.release()
+
+    def _restart(self):
+        """Replace a pool whose worker processes died"""
+        logger.error("Hash pool - Worker process died, restarting pool")
+        with self.lock:
+            old_pool, self.pool = self.pool, ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=MP_CONTEXT
+            )
+        old_pool.shutdown(wait=False, cancel_futures=True)
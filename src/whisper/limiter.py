@@ -0,0 +1,148 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from whisper import check_config
+
+logger = logging.getLogger(__name__)
+
+
+class attempt_limiter:
+    """Token bucket limiter for secret retrieval attempts, keyed by secret ID
+    and by client IP. Bucket state is kept in a small SQLite database so that
+    it is shared by every worker process on the host."""
+
+    def __init__(self, limit_config={}):
+        self.default_config = {
+            "enabled": True,
+            "path": "/tmp/whisper-attempts.db",
+            "id_burst": 5,
+            "id_rate": 0.1,
+            "ip_burst": 20,
+            "ip_rate": 0.5,
+            "max_failures": 0,
+        }
+        config = {**self.default_config, **limit_config}
+        self.config = check_config(config, self.default_config)
+        self.local = threading.local()
+        self.last_prune = 0
+
+    def start(self):
+        """Create the bucket tables if needed"""
+        if not self.config.enabled:
+            return
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets "
+            "(key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS failures "
+            "(secret_id TEXT PRIMARY KEY, count INTEGER, updated REAL)"
+        )
+
+    def allow(self, secret_id, remote_addr):
+        """Take one token from both the secret ID and client IP buckets.
+        Returns False without taking any tokens if either bucket is empty."""
+        if not self.config.enabled:
+            return True
+        buckets = [
+            (f"id:{secret_id}", self.config.id_burst, self.config.id_rate),
+            (f"ip:{remote_addr}", self.config.ip_burst, self.config.ip_rate),
+        ]
+        now = time.time()
+        try:
+            with self._transaction() as db:
+                updates = []
+                for key, burst, rate in buckets:
+                    row = db.execute(
+                        "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+                    ).fetchone()
+                    tokens = burst
+                    if row:
+                        tokens = min(burst, row[0] + (now - row[1]) * rate)
+                    if tokens < 1:
+                        return False
+                    updates.append((key, tokens - 1, now))
+                db.executemany("REPLACE INTO buckets VALUES (?, ?, ?)", updates)
+        except sqlite3.Error as e:
+            logger.error(f"Attempt limiter error, allowing request: {e}")
+            return True
+        self._prune(now)
+        return True
+
+    def record_failure(self, secret_id):
+        """Count a failed password attempt. Returns True if the secret has
+        reached max_failures and should be burned."""
+        if not self.config.enabled or not self.config.max_failures:
+            return False
+        try:
+            with self._transaction() as db:
+                db.execute(
+                    "INSERT INTO failures VALUES (?, 1, ?) ON CONFLICT(secret_id) "
+                    "DO UPDATE SET count = count + 1, updated = excluded.updated",
+                    (secret_id, time.time()),
+                )
+                count = db.execute(
+                    "SELECT count FROM failures WHERE secret_id = ?", (secret_id,)
+                ).fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error(f"Attempt limiter error: {e}")
+            return False
+        return count >= self.config.max_failures
+
+    def reset_failures(self, secret_id):
+        """Forget failed password attempts after a successful one"""
+        if not self.config.enabled or not self.config.max_failures:
+            return
+        try:
+            with self._transaction() as db:
+                db.execute("DELETE FROM failures WHERE secret_id = ?", (secret_id,))
+        except sqlite3.Error as e:
+            logger.error(f"Attempt limiter error: {e}")
+
+    def _prune(self, now):
+        """Drop buckets that have refilled and stale failure counts, at most
+        once a minute"""
+        if now - self.last_prune < 60:
+            return
+        self.last_prune = now
+        refill = max(
+            self.config.id_burst / self.config.id_rate,
+            self.config.ip_burst / self.config.ip_rate,
+        )
+        try:
+            with self._transaction() as db:
+                db.execute("DELETE FROM buckets WHERE updated < ?", (now - refill,))
+                db.execute(
+                    "DELETE FROM failures WHERE updated < ?", (now - 86400 * 30,)
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Attempt limiter error: {e}")
+
+    def _db(self):
+        """Connection for the current thread"""
+        if not getattr(self.local, "db", None):
+            self.local.db = sqlite3.connect(
+                self.config.path, timeout=5, isolation_level=None
+            )
+        return self.local.db
+
+    def _transaction(self):
+        return _transaction(self._db())
+
+
+class _transaction:
+    """Write transaction that takes the database lock up front"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
@@ -0,0 +1,197 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from whisper import ConfigError, check_config
+
+logger = logging.getLogger(__name__)
+
+STORE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+STORE_BUCKETS += (1.0, 2.5, 5.0, 10.0)
+HASH_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SWEEP_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+class metrics_collector:
+    """Prometheus metrics for storage operations, password hashing and the
+    storage cleaner. prometheus_client's multiprocess mode writes values to
+    files in path, so the metrics page shows the totals of every gunicorn
+    worker. Recording does nothing until started, or if disabled."""
+
+    def __init__(self):
+        self.default_config = {
+            "enabled": False,
+            "path": "/tmp/whisper-metrics",
+            "refresh_interval": 15,
+        }
+        self.config = check_config(self.default_config, self.default_config)
+        self.enabled = False
+        self.gauge_sources = []
+        self.gauges = {}
+
+    def start(self, metrics_config={}):
+        """Create the metrics and start refreshing gauges"""
+        config = {**self.default_config, **metrics_config}
+        self.config = check_config(config, self.default_config)
+        if not self.config.enabled:
+            return
+        # multiprocess mode is chosen when prometheus_client is imported
+        os.makedirs(self.config.path, exist_ok=True)
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = self.config.path
+        try:
+            import prometheus_client
+        except ImportError as e:
+            raise ConfigError("metrics_config", f"Could not load metrics ({e})")
+        self.prometheus = prometheus_client
+        Counter, Histogram = prometheus_client.Counter, prometheus_client.Histogram
+        self.histograms = {
+            "store": Histogram(
+                "whisper_store_operation_seconds",
+                "Storage backend operation latency",
+                ["operation", "backend"],
+                buckets=STORE_BUCKETS,
+            ),
+            "hash": Histogram(
+                "whisper_password_hash_seconds",
+                "Password hash and verify latency, including queue wait",
+                ["operation", "algorithm"],
+                buckets=HASH_BUCKETS,
+            ),
+            "cleaner": Histogram(
+                "whisper_cleaner_sweep_seconds",
+                "Storage cleaner sweep duration",
+                buckets=SWEEP_BUCKETS,
+            ),
+        }
+        self.counters = {
+            "store_errors": Counter(
+                "whisper_store_errors",
+                "Storage backend operations that raised an error",
+                ["operation", "backend", "error"],
+            ),
+            "store_hedges": Counter(
+                "whisper_store_hedged_reads",
+                "Cloud storage reads sent a second time, and how many of those won",
+                ["backend", "outcome"],
+            ),
+            "hash_errors": Counter(
+                "whisper_password_hash_errors",
+                "Password hash and verify calls that raised an error",
+                ["operation", "algorithm", "error"],
+            ),
+            "cleaner_errors": Counter(
+                "whisper_cleaner_errors",
+                "Storage cleaner sweeps that raised an error",
+                ["error"],
+            ),
+            "cleaner_scanned": Counter(
+                "whisper_cleaner_scanned",
+                "Secrets or index entries read by storage cleaner sweeps",
+            ),
+            "cleaner_deleted": Counter(
+                "whisper_cleaner_deleted",
+                "Expired secrets deleted by storage cleaner sweeps",
+            ),
+        }
+        self.enabled = True
+        logger.info(f"Metrics enabled, writing to {self.config.path}")
+        threading.Thread(
+            name="metrics_gauges", target=self.run_gauges, daemon=True
+        ).start()
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Observe the time taken by the block in the named histogram, and
+        count any error it raises"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.inc(f"{name}_errors", error=type(e).__name__, **labels)
+            raise
+        finally:
+            histogram = self.histograms[name]
+            (histogram.labels(**labels) if labels else histogram).observe(
+                time.perf_counter() - start
+            )
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        counter = self.counters[name]
+        (counter.labels(**labels) if labels else counter).inc(amount)
+
+    def add_gauges(self, name, stats, mode="livesum"):
+        """Publish the numeric values returned by stats() as gauges named
+        whisper_<name>_<key>, refreshed every refresh_interval seconds. mode
+        is how the values of each worker are combined, livesum for values kept
+        per process and max for values shared by every process."""
+        self.gauge_sources.append((name, stats, mode))
+
+    def run_gauges(self):
+        while True:
+            self.refresh_gauges()
+            time.sleep(self.config.refresh_interval)
+
+    def refresh_gauges(self):
+        for name, stats, mode in self.gauge_sources:
+            try:
+                values = stats()
+            except Exception as e:
+                logger.error(f"Metrics - Could not read {name} stats: {e}")
+                continue
+            for key, value in values.items():
+                if not isinstance(value, (int, float)):
+                    continue
+                gauge = self.gauges.get((name, key))
+                if gauge is None:
+                    gauge = self.gauges[(name, key)] = self.prometheus.Gauge(
+                        f"whisper_{name}_{key}",
+                        f"{name} {key.replace('_', ' ')}",
+                        multiprocess_mode=mode,
+                    )
+                gauge.set(value)
+
+    def render(self):
+        """Return the metrics of every worker process in the Prometheus text
+        format, and its content type"""
+        from prometheus_client import multiprocess
+
+        registry = self.prometheus.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return (
+            self.prometheus.generate_latest(registry),
+            self.prometheus.CONTENT_TYPE_LATEST,
+        )
+
+    def clear(self, metrics_config={}):
+        """Remove the values of an earlier run, called by the gunicorn master
+        process before any workers start"""
+        config = check_config(
+            {**self.default_config, **metrics_config}, self.default_config
+        )
+        if not config.enabled or not os.path.isdir(config.path):
+            return
+        for name in os.listdir(config.path):
+            if name.endswith(".db"):
+                os.remove(os.path.join(config.path, name))
+
+    def process_exit(self, metrics_config, pid):
+        """Drop the live gauge values of a worker process that has exited"""
+        config = check_config(
+            {**self.default_config, **metrics_config}, self.default_config
+        )
+        if not config.enabled:
+            return
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = config.path
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid, config.path)
+
+
+metrics = metrics_collector()
@@ -0,0 +1,211 @@
+import base64
+import binascii
+import codecs
+import io
+import json
+import logging
+import struct
+
+from whisper import secret
+
+logger = logging.getLogger(__name__)
+
+# Stored secrets are a fixed size header, the password hash and the payload.
+# The payload is the ciphertext decoded from the client's base64, unless it
+# does not round trip exactly, in which case the text is kept as is.
+MAGIC = b"WSEC"
+VERSION = 1
+# magic, version, flags, id, create_date, expire_date, hash length, data length
+HEADER = struct.Struct("<4sBB40sqqHI")
+FLAG_BASE64 = 1
+# the data runs to the end, used when the length is not known up front
+FLAG_TO_END = 2
+CHUNK_SIZE = 65536
+
+
+class FormatError(Exception):
+    """Secret Format Exception"""
+
+    def __init__(self, message="Invalid secret data"):
+        self.message = message
+        super().__init__(self.message)
+
+
+def dumps(s):
+    """Serialize a secret to bytes"""
+    flags = 0
+    data = (s.data or "").encode("utf-8")
+    if data and len(data) % 4 == 0:
+        try:
+            raw = base64.b64decode(data, validate=True)
+        except binascii.Error:
+            raw = None
+        # only the last group can differ when encoded again, from padding bits
+        tail = (len(data) // 4 - 1) * 3
+        if raw is not None and base64.b64encode(raw[tail:]) == data[-4:]:
+            data, flags = raw, FLAG_BASE64
+    hashed = (s.hash or "").encode("utf-8")
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        flags,
+        s.id.encode("utf-8"),
+        s.create_date,
+        s.expire_date,
+        len(hashed),
+        len(data),
+    )
+    return header + hashed + data
+
+
+def dumps_stream(s, stream, chunk_size=CHUNK_SIZE):
+    """Serialize a secret whose base64 data is read from a file-like stream,
+    yielding bytes as the data is decoded a chunk at a time. Raises
+    FormatError if the data is not base64."""
+    hashed = (s.hash or "").encode("utf-8")
+    yield HEADER.pack(
+        MAGIC,
+        VERSION,
+        FLAG_BASE64 | FLAG_TO_END,
+        s.id.encode("utf-8"),
+        s.create_date,
+        s.expire_date,
+        len(hashed),
+        0,
+    ) + hashed
+    yield from _decode_chunks(stream, chunk_size)
+
+
+def check_base64(data):
+    """Raise FormatError unless data is base64 that round trips exactly"""
+    for _ in _decode_chunks(io.BytesIO(data), len(data) or 1):
+        pass
+
+
+def _decode_chunks(stream, chunk_size):
+    """Decode base64 read from a stream, yielding bytes a chunk at a time"""
+    pending = b""
+    padded = False
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        # decode whole groups of 4 characters, keep the rest for the next read
+        whole = len(pending) - len(pending) % 4
+        if whole:
+            groups, pending = pending[:whole], pending[whole:]
+            # padding may only end the last group
+            padding = groups.find(b"=")
+            if padded or 0 <= padding < whole - 2:
+                raise FormatError()
+            padded = padding >= 0
+            yield _b64decode(groups)
+            size += whole
+            last = groups[-4:]
+    if pending or not size:
+        raise FormatError()
+    # only the last group can differ when encoded again, from padding bits
+    if base64.b64encode(base64.b64decode(last)) != last:
+        raise FormatError()
+
+
+def _b64decode(data):
+    try:
+        return base64.b64decode(data, validate=True)
+    except binascii.Error:
+        raise FormatError()
+
+
+def load_stream(f, chunk_size=CHUNK_SIZE):
+    """Read a secret from a binary file-like object without reading its data.
+    Returns the secret with its ID, dates and hash set, and a generator of the
+    data as text, or (False, None) if the secret can't be read."""
+    header = f.read(HEADER.size)
+    if not is_binary(header):
+        s = loads(header + f.read())
+        return s, iter([s.data] if s else [])
+    if len(header) < HEADER.size:
+        return False, None
+    flags, hash_len, data_len = (HEADER.unpack(header)[i] for i in (2, 6, 7))
+    s = loads(header + f.read(hash_len), header_only=True)
+    if not s:
+        return False, None
+    remaining = None if flags & FLAG_TO_END else data_len
+    # base64 encoding whole groups of 3 bytes gives the same text as encoding
+    # the whole payload at once
+    chunk_size -= chunk_size % 3
+
+    def chunks():
+        nonlocal remaining
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = _read_full(f, size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            if flags & FLAG_BASE64:
+                yield base64.b64encode(chunk).decode("ascii")
+            else:
+                yield decoder.decode(chunk)
+        if not flags & FLAG_BASE64:
+            yield decoder.decode(b"", final=True)
+
+    return s, chunks()
+
+
+def _read_full(f, size):
+    """Read size bytes unless the end is reached, streams may return less"""
+    data = f.read(size)
+    while data and len(data) < size:
+        more = f.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def loads(data, header_only=False):
+    """Deserialize a secret from bytes, in either this format or the JSON
+    format used before it. With header_only, only the ID, dates and hash are
+    read and data only needs to hold the header and hash. Returns False if the
+    secret can't be read."""
+    if not is_binary(data):
+        return _loads_json(data, header_only)
+    magic, version, flags, secret_id, create, expire, hash_len, data_len = (
+        HEADER.unpack_from(data)
+    )
+    if version != VERSION:
+        logger.error(f"Unknown secret format version {version}")
+        return False
+    s = secret(secret_id.decode("utf-8"))
+    s.create_date, s.expire_date = create, expire
+    start = HEADER.size
+    s.hash = bytes(data[start : start + hash_len]).decode("utf-8") or None
+    if not header_only:
+        end = None if flags & FLAG_TO_END else start + hash_len + data_len
+        payload = bytes(data[start + hash_len : end])
+        if flags & FLAG_BASE64:
+            payload = base64.b64encode(payload)
+        s.data = payload.decode("utf-8")
+    return s if s.check_id() else False
+
+
+def is_binary(data):
+    """Check if stored bytes are in this format rather than JSON"""
+    return bytes(data[: len(MAGIC)]) == MAGIC
+
+
+def _loads_json(data, header_only=False):
+    s = secret()
+    try:
+        s.load_from_dict(json.loads(data))
+    except Exception as e:
+        logger.error(f"Could not parse secret: {e}")
+        return False
+    if header_only:
+        s.data = None
+    return s if s.check_id() else False
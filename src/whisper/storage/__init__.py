@@ -1,19 +1,84 @@
+import fcntl
+import json
 import logging
+import os
+import socket
+import tempfile
 import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-from whisper import check_config, class_loader, secret
+from whisper import check_config, class_loader, secret, serialization
+from whisper.metrics import metrics
+from whisper.storage.cache import secret_cache
+from whisper.storage.filter import secret_filter
 
 logger = logging.getLogger(__name__)
 
 
+class StoreFullError(Exception):
+    """Storage Backend Full Exception"""
+
+    def __init__(self, message="Storage backend is full"):
+        self.message = message
+        super().__init__(self.message)
+
+
+def closing_iter(chunks, f):
+    """Iterate over chunks, closing f when done"""
+    try:
+        yield from chunks
+    finally:
+        f.close()
+
+
+def warm_up(request, count):
+    """Make count requests at once, so that many pooled connections are open
+    and credentials are loaded before the first secret request"""
+    start = time.time()
+    barrier = threading.Barrier(count)
+
+    def connect():
+        barrier.wait(timeout=10)
+        request()
+
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        futures = [pool.submit(connect) for _ in range(count)]
+    errors = [f.exception() for f in futures if f.exception()]
+    if errors:
+        logger.warning(
+            f"Warm up - {len(errors)} of {count} requests failed: {errors[0]}"
+        )
+    logger.info(f"Warm up - Opened {count} connections in {time.time() - start:.2f}s")
+
+
+def lease_held(data, owner):
+    """Check if a cleaner lease object read from shared storage is held by
+    another owner and not yet expired. An unreadable lease, such as a truncated
+    or hand edited one, counts as expired so that it gets replaced."""
+    try:
+        lease = json.loads(data)
+        return lease["owner"] != owner and lease["expires_at"] > time.time()
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Replacing unreadable cleaner lease: {e}")
+        return False
+
+
 class store_cleaner:
     """Storage cleaner class, deletes expired secrets by running a periodic
-    expiration check"""
+    expiration check. Every process runs a cleaner, but only the one holding
+    the backend's cleaner lease sweeps, the others take over if it stops
+    renewing the lease."""
 
     def __init__(self, store):
         logger.debug("Cleaner - Init")
         self.store = store
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.leader = False
+        self.last_run = 0
+        self.last_duration = 0.0
+        self.runs = 0
         self.thread = threading.Thread(name="store_cleaner", target=self.run, args=())
         self.thread.daemon = True
         if not self.thread.is_alive():
@@ -23,19 +88,181 @@ class store_cleaner:
     def run(self):
         """Run the cleaner loop, sleep for clean_interval between runs"""
         while True:
-            logger.info("Cleaner - Deleting expired secrets")
-            self.store.delete_expired()
+            self.sweep()
             logger.info(f"Cleaner - Sleeping for {self.store.clean_interval} seconds")
             time.sleep(self.store.clean_interval)
 
+    def sweep(self):
+        """Delete expired secrets if this process holds the cleaner lease. The
+        lease lasts for three intervals, so a leader that stops is replaced
+        within that time."""
+        try:
+            leader = self.store.acquire_cleaner_lease(
+                self.owner, self.store.clean_interval * 3, self.stats()
+            )
+        except Exception as e:
+            logger.error(f"Cleaner - Could not acquire lease: {e}")
+            leader = False
+        if leader != self.leader:
+            logger.info(f"Cleaner - {'Acquired' if leader else 'Lost'} lease")
+            self.leader = leader
+        if not leader:
+            return
+        logger.info("Cleaner - Deleting expired secrets")
+        start = time.time()
+        result = None
+        try:
+            with metrics.timed("cleaner"):
+                result = self.store.delete_expired()
+        except Exception as e:
+            logger.error(f"Cleaner - Sweep failed: {e}")
+        if isinstance(result, dict):
+            metrics.inc("cleaner_scanned", result["scanned"])
+            metrics.inc("cleaner_deleted", result["deleted"])
+        self.last_run = int(start)
+        self.last_duration = time.time() - start
+        self.runs += 1
+        logger.info(f"Cleaner - Sweep took {self.last_duration:.2f} seconds")
+
+    def stats(self):
+        """Return leadership and the time and duration of the last sweep"""
+        return {
+            "owner": self.owner,
+            "leader": self.leader,
+            "last_run": self.last_run,
+            "last_duration": self.last_duration,
+            "runs": self.runs,
+        }
+
+
+class store_backend:
+    """Storage backend base class. Backends must define get_secret,
+    set_secret, delete_secret and delete_expired. The other operations have
+    defaults built on those, which backends override where they have a
+    cheaper or atomic way to do them."""
+
+    # backends which expire secrets themselves don't need the cleaner
+    native_expiry = False
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+
+    def start(self):
+        """Open connections or files, called once the config is set"""
+        pass
+
+    def get_secret(self, secret_id):
+        """Return a stored secret, or False if it does not exist"""
+        raise NotImplementedError
+
+    def set_secret(self, s):
+        """Save a secret"""
+        raise NotImplementedError
+
+    def delete_secret(self, secret_id):
+        """Delete a secret if it exists"""
+        raise NotImplementedError
+
+    def delete_expired(self):
+        """Delete expired secrets. Returns a dict of the number of secrets
+        scanned and deleted."""
+        raise NotImplementedError
+
+    def set_secret_stream(self, s, stream):
+        """Save a secret whose base64 data is read from a file-like stream"""
+        data = stream.read()
+        serialization.check_base64(data)
+        s.data = data.decode("utf-8")
+        return self.set_secret(s)
+
+    def get_secret_metadata(self, secret_id):
+        """Return a secret's ID and dates without its data or hash"""
+        s = self.get_secret(secret_id)
+        if not isinstance(s, secret) or not s.check_id():
+            return False
+        s.data, s.hash = None, None
+        return s
+
+    def secret_exists(self, secret_id):
+        return bool(self.get_secret_metadata(secret_id))
+
+    def consume_secret(self, secret_id, verifier):
+        """Return a secret and whether verifier(secret) passed, deleting it if
+        it was verified and is a one-time secret. This default isn't atomic,
+        two requests can both receive a one-time secret."""
+        s = self.get_secret(secret_id)
+        if not isinstance(s, secret) or not s.check_id():
+            return False, False
+        if not verifier(s):
+            return s, False
+        if s.is_one_time():
+            self.delete_secret(secret_id)
+        return s, True
+
+    def consume_secret_stream(self, secret_id, verifier):
+        """Like consume_secret, but the secret is returned without its data
+        along with an iterator of the data as text, or None if the secret was
+        not verified"""
+        s, valid = self.consume_secret(secret_id, verifier)
+        if not s or not valid:
+            return s, valid, None
+        data, s.data = s.data, None
+        return s, True, iter([data])
+
+    def acquire_cleaner_lease(self, owner, ttl, stats=None):
+        """Return whether this process should run the cleaner, renewing the
+        lease for ttl seconds if it already holds it. stats of the last sweep
+        are published with the lease. By default the lease is an exclusive
+        lock on the file at cleaner_lock_path, held until the process exits,
+        so one process per host sweeps. Backends shared between hosts
+        override this."""
+        if getattr(self, "cleaner_lock_fd", None) is None:
+            fd = os.open(self.cleaner_lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            self.cleaner_lock_fd = fd
+        os.ftruncate(self.cleaner_lock_fd, 0)
+        os.pwrite(self.cleaner_lock_fd, json.dumps(stats or {}).encode("utf-8"), 0)
+        return True
+
+    @property
+    def cleaner_lock_path(self):
+        return os.path.join(tempfile.gettempdir(), "whisper-cleaner.lock")
+
+    def stats(self):
+        """Return size gauges, empty for backends which can't count their
+        secrets cheaply"""
+        return {}
+
+    def list_secret_ids(self):
+        """Iterate over the IDs of all stored secrets, or return None if the
+        backend can't list them"""
+        return None
+
 
 class store:
-    """Storage base class, stores secrets in a backend"""
+    """Stores secrets in a backend, with the optional cache and ID filter in
+    front of it and the cleaner deleting expired secrets"""
 
-    def __init__(self, storage_class, storage_config={}, clean_interval=900):
+    def __init__(
+        self,
+        storage_class,
+        storage_config={},
+        clean_interval=900,
+        cache_config={},
+        filter_config={},
+    ):
         self.clean_interval = clean_interval
         self.storage_class = storage_class
         self.storage_config = storage_config
+        self.cache_config = cache_config
+        self.filter_config = filter_config
+        self.cache = None
+        self.filter = None
 
     def start(self):
         """Import/create configured backend storage object, check the
@@ -50,25 +277,186 @@ class store:
         config = {**self.backend.default_config, **self.storage_config}
         self.backend.config = check_config(config, self.backend.default_config)
         self.backend.start()
-        self.cleaner = store_cleaner(self)
+        cache = secret_cache(self.cache_config)
+        if cache.config.enabled:
+            self.cache = cache
+        id_filter = secret_filter(self.filter_config)
+        if id_filter.config.enabled:
+            self.filter = id_filter
+            self.filter.start(self.backend)
+        if self.backend.native_expiry:
+            logger.info("Storage backend expires secrets, not starting cleaner")
+        else:
+            self.cleaner = store_cleaner(self)
+            metrics.add_gauges("cleaner", self.cleaner.stats, "max")
+        # backend stats are reported by each worker, some are kept per process
+        metrics.add_gauges("store", self.backend.stats, "liveall")
+        if self.cache:
+            metrics.add_gauges("store_cache", self.cache.stats, "livesum")
+        if self.filter:
+            metrics.add_gauges("store_filter", self.filter.stats, "max")
 
     def get_secret(self, secret_id):
-        """Retrieve a secret from the storage backend"""
-        s = self.backend.get_secret(secret_id)
+        """Retrieve a secret from the cache or the storage backend"""
+        if self._filtered(secret_id):
+            return False
+        s = self.cache.get(secret_id) if self.cache else None
+        if s:
+            return s
+        with self._timed("get_secret"):
+            s = self.backend.get_secret(secret_id)
         if isinstance(s, secret) and s.check_id():
+            if self.cache:
+                self.cache.put(s)
             return s
         else:
             return False
 
     def set_secret(self, secret):
         """Save a secret to the storage backend"""
-        return self.backend.set_secret(secret)
+        if self.cache:
+            self.cache.invalidate(secret.id)
+        with self._timed("set_secret"):
+            result = self.backend.set_secret(secret)
+        # added once stored, the ID isn't known to readers before then
+        if self.filter:
+            self.filter.add(secret.id)
+        return result
+
+    def set_secret_stream(self, s, stream):
+        """Save a secret whose base64 data is read from a file-like stream"""
+        if self.cache:
+            self.cache.invalidate(s.id)
+        with self._timed("set_secret_stream"):
+            result = self.backend.set_secret_stream(s, stream)
+        if self.filter:
+            self.filter.add(s.id)
+        return result
 
     def delete_secret(self, secret_id):
         """Delete a secret from the storage backend"""
         logger.info(f"Delete secret: {secret_id}")
-        return self.backend.delete_secret(secret_id)
+        if self.cache:
+            self.cache.invalidate(secret_id)
+        with self._timed("delete_secret"):
+            return self.backend.delete_secret(secret_id)
 
     def delete_expired(self):
-        """Delete expired secrets from the storage backend"""
-        return self.backend.delete_expired()
+        """Delete expired secrets from the storage backend and the cache.
+        Returns a dict of the number of secrets scanned and deleted, if the
+        backend counts them."""
+        if self.cache:
+            self.cache.delete_expired()
+        result = self.backend.delete_expired()
+        # expired and deleted secrets are only cleared from the filter when it
+        # is rebuilt
+        if self.filter:
+            self.filter.rebuild_if_due()
+        return result
+
+    def get_secret_metadata(self, secret_id):
+        """Retrieve a secret's ID and dates without its data or hash"""
+        if self._filtered(secret_id):
+            return False
+        s = self.cache.get(secret_id) if self.cache else None
+        if s:
+            s.data, s.hash = None, None
+            return s
+        with self._timed("get_secret_metadata"):
+            s = self.backend.get_secret_metadata(secret_id)
+        if isinstance(s, secret) and s.check_id():
+            return s
+        return False
+
+    def secret_exists(self, secret_id):
+        """Check if a secret is stored without retrieving it"""
+        if self._filtered(secret_id):
+            return False
+        if self.cache and self.cache.get(secret_id):
+            return True
+        with self._timed("secret_exists"):
+            return self.backend.secret_exists(secret_id)
+
+    def consume_secret(self, secret_id, verifier):
+        """Retrieve a secret for a reader, checking it with verifier (usually
+        a password check) and deleting it if it is a one-time secret. Returns a
+        tuple of the secret (or False if it does not exist) and whether it was
+        verified."""
+        if self._filtered(secret_id):
+            return False, False
+        s = self.cache.get(secret_id) if self.cache else None
+        if s:
+            return s, verifier(s)
+        with self._timed("consume_secret"):
+            s, valid = self.backend.consume_secret(secret_id, verifier)
+        self._consumed(s, valid)
+        return s, valid
+
+    def consume_secret_stream(self, secret_id, verifier):
+        """Like consume_secret, but the secret is returned without its data
+        along with an iterator of the data as text, or None if the secret was
+        not verified"""
+        if self._filtered(secret_id):
+            return False, False, None
+        s = self.cache.get(secret_id) if self.cache else None
+        if s:
+            data, s.data = s.data, None
+            return (s, True, iter([data])) if verifier(s) else (s, False, None)
+        with self._timed("consume_secret_stream"):
+            s, valid, chunks = self.backend.consume_secret_stream(secret_id, verifier)
+        if s and valid and s.is_one_time():
+            self._consumed(s, valid)
+        elif s and valid and self.cache:
+            chunks = self._cache_chunks(s, chunks)
+        return s, valid, chunks
+
+    def acquire_cleaner_lease(self, owner, ttl, stats=None):
+        """Return whether this process should run the cleaner, see
+        store_backend.acquire_cleaner_lease"""
+        return self.backend.acquire_cleaner_lease(owner, ttl, stats)
+
+    def stats(self):
+        """Return size gauges of the storage backend"""
+        return self.backend.stats()
+
+    def list_secret_ids(self):
+        """Iterate over the IDs of all stored secrets, or return None if the
+        backend can't list them"""
+        return self.backend.list_secret_ids()
+
+    def _timed(self, operation):
+        """Time a backend operation for the store metrics"""
+        return metrics.timed(
+            "store", operation=operation, backend=type(self.backend).__name__
+        )
+
+    def _filtered(self, secret_id):
+        """Check if the filter shows a secret is definitely not stored"""
+        return self.filter is not None and not self.filter.might_contain(secret_id)
+
+    def _consumed(self, s, valid):
+        """Update the cache and filter after a secret was retrieved"""
+        if not s or not valid:
+            return
+        if s.is_one_time():
+            # the backend consume is atomic, so this runs once per secret
+            if self.filter:
+                self.filter.remove(s.id)
+        elif self.cache:
+            self.cache.put(s)
+
+    def _cache_chunks(self, s, chunks):
+        """Pass chunks through, caching the secret once all have been read if
+        it is small enough"""
+        data = []
+        size = 0
+        for chunk in chunks:
+            yield chunk
+            if size <= self.cache.config.max_entry_bytes:
+                data.append(chunk)
+                size += len(chunk)
+        if size <= self.cache.config.max_entry_bytes:
+            cached = secret(s.id)
+            cached.create_date, cached.expire_date = s.create_date, s.expire_date
+            cached.hash, cached.data = s.hash, "".join(data)
+            self.cache.put(cached)
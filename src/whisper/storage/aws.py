@@ -1,21 +1,88 @@
+import argparse
 import json
 import logging
 import os
+import time
 
 import boto3
-from whisper import secret
-from whisper.storage import store
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from whisper import check_config, secret, serialization
+from whisper.storage import closing_iter, lease_held, store_backend, warm_up
+from whisper.storage.hedge import read_hedger
 
 logger = logging.getLogger(__name__)
 
+# errors from a conditional write or delete when the object was changed or
+# deleted since it was read, including a 409 when another conditional request
+# on the object is in progress
+GONE_CODES = (
+    "PreconditionFailed",
+    "412",
+    "ConditionalRequestConflict",
+    "409",
+    "NoSuchKey",
+    "404",
+)
 
-class s3(store):
+
+class s3(store_backend):
     def __init__(self, name="s3", parent=None):
-        self.default_config = {"bucket_name": None, "bucket_path": ""}
+        self.default_config = {
+            "bucket_name": None,
+            "bucket_path": "",
+            "endpoint_url": "",
+            "multipart_chunk_size": 8388608,
+            "max_pool_connections": 32,
+            "cleaner_pool_connections": 4,
+            "connect_timeout": 5,
+            "read_timeout": 60,
+            "max_retries": 3,
+            "retry_mode": "standard",
+            "tcp_keepalive": True,
+            "warm_up_connections": 0,
+            "hedge_config": {},
+        }
         super().__init__(name, parent)
 
     def start(self):
-        self.client = boto3.client("s3")
+        self._connect()
+        self.hedger = read_hedger(
+            self.config.hedge_config, self.config.max_pool_connections, "s3"
+        )
+        if self.config.warm_up_connections:
+            warm_up(
+                lambda: self.client.head_bucket(Bucket=self.config.bucket_name),
+                min(self.config.warm_up_connections, self.config.max_pool_connections),
+            )
+        # checked by the first sweep, see ensure_index
+        self.index_checked = False
+
+    def _connect(self):
+        """Create the S3 clients. Request threads share a client and its
+        connection pool, the cleaner and other background work use a second
+        client with its own smaller pool so they can't hold up requests."""
+        self.client = self._client(self.config.max_pool_connections)
+        self.cleaner_client = self._client(self.config.cleaner_pool_connections)
+
+    def _client(self, max_pool_connections):
+        client_config = Config(
+            max_pool_connections=max_pool_connections,
+            connect_timeout=self.config.connect_timeout,
+            read_timeout=self.config.read_timeout,
+            retries={
+                "max_attempts": self.config.max_retries,
+                "mode": self.config.retry_mode,
+            },
+            tcp_keepalive=self.config.tcp_keepalive,
+        )
+        return boto3.client(
+            "s3", endpoint_url=self.config.endpoint_url or None, config=client_config
+        )
+
+    @property
+    def index_prefix(self):
+        return os.path.join(self.config.bucket_path, "_expiry/")
 
     def get_secret(self, secret_id):
         s = secret(secret_id)
@@ -30,30 +97,264 @@ class s3(store):
             return False
         logger.debug(f"Saving S3 secret: {s.id}")
         self.put_s3_obj(s)
+        self.index_secret(s)
         return True
 
+    def set_secret_stream(self, s, stream):
+        """Upload the secret as its data is read. Secrets larger than
+        multipart_chunk_size are sent as a multipart upload, one part per
+        chunk, smaller ones with a single request."""
+        if not s.check_id():
+            return False
+        logger.debug(f"Saving S3 secret: {s.id}")
+        key = os.path.join(self.config.bucket_path, f"{s.id}.json")
+        chunks = serialization.dumps_stream(s, stream)
+        part = self._read_part(chunks)
+        if len(part) < self.config.multipart_chunk_size:
+            self.client.put_object(
+                Body=part,
+                Bucket=self.config.bucket_name,
+                Key=key,
+                **self._put_args(s),
+            )
+        else:
+            upload_id = self.client.create_multipart_upload(
+                Bucket=self.config.bucket_name, Key=key, **self._put_args(s)
+            )["UploadId"]
+            try:
+                parts = []
+                while part:
+                    response = self.client.upload_part(
+                        Body=part,
+                        Bucket=self.config.bucket_name,
+                        Key=key,
+                        PartNumber=len(parts) + 1,
+                        UploadId=upload_id,
+                    )
+                    parts.append(
+                        {"ETag": response["ETag"], "PartNumber": len(parts) + 1}
+                    )
+                    part = self._read_part(chunks)
+                self.client.complete_multipart_upload(
+                    Bucket=self.config.bucket_name,
+                    Key=key,
+                    MultipartUpload={"Parts": parts},
+                    UploadId=upload_id,
+                )
+            except BaseException:
+                self.client.abort_multipart_upload(
+                    Bucket=self.config.bucket_name, Key=key, UploadId=upload_id
+                )
+                raise
+        self.index_secret(s)
+        return True
+
+    def _read_part(self, chunks):
+        """Collect up to multipart_chunk_size bytes from chunks"""
+        part = b""
+        for chunk in chunks:
+            part += chunk
+            if len(part) >= self.config.multipart_chunk_size:
+                break
+        return part
+
     def delete_secret(self, secret_id):
         logger.info(f"Deleting S3 secret: {secret_id}")
         self.delete_s3_obj(f"{secret_id}.json")
         return True
 
+    def get_secret_metadata(self, secret_id):
+        """Read the secret dates with a HEAD request, from the object metadata
+        or the tags for objects stored without metadata"""
+        s = secret(secret_id)
+        if not s.check_id():
+            return False
+        key = os.path.join(self.config.bucket_path, f"{s.id}.json")
+        try:
+            head = self.client.head_object(Bucket=self.config.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+        metadata = head.get("Metadata", {})
+        if "expire_date" in metadata:
+            s.create_date = int(metadata.get("create_date", 0))
+            s.expire_date = int(metadata["expire_date"])
+        else:
+            s.create_date, s.expire_date = self.get_s3_obj_dates(key)
+        return s
+
+    def secret_exists(self, secret_id):
+        return bool(self.get_secret_metadata(secret_id))
+
+    def list_secret_ids(self):
+        prefix = os.path.join(self.config.bucket_path, "")
+        for key in self.list_s3_keys(prefix, self.cleaner_client, Delimiter="/"):
+            secret_id, ext = os.path.splitext(os.path.basename(key))
+            if ext == ".json":
+                yield secret_id
+
+    def consume_secret(self, secret_id, verifier):
+        """Check the password, then delete one-time secrets with a delete
+        conditional on the ETag that was read. Only one request's delete can
+        succeed, so only one request receives the secret."""
+        s = secret(secret_id)
+        if not s.check_id():
+            return False, False
+        store_obj = self.get_s3_obj(f"{s.id}.json")
+        if not store_obj:
+            return False, False
+        s = self.secret_from_body(store_obj["Body"])
+        if not s:
+            return False, False
+        if not verifier(s):
+            return s, False
+        if s.is_one_time() and not self.delete_if_match(s, store_obj["ETag"]):
+            return False, False
+        return s, True
+
+    def consume_secret_stream(self, secret_id, verifier):
+        """Like consume_secret, but only the header is read from the response
+        before the password is checked, and the data is streamed from the
+        response body"""
+        s = secret(secret_id)
+        if not s.check_id():
+            return False, False, None
+        store_obj = self.get_s3_obj(f"{s.id}.json")
+        if not store_obj:
+            return False, False, None
+        body = store_obj["Body"]
+        streaming = False
+        try:
+            s, chunks = serialization.load_stream(body)
+            if not s or not verifier(s):
+                return s, False, None
+            if s.is_one_time() and not self.delete_if_match(s, store_obj["ETag"]):
+                return False, False, None
+            streaming = True
+            return s, True, closing_iter(chunks, body)
+        finally:
+            # the body is left open only for the caller to stream
+            if not streaming:
+                body.close()
+
+    def delete_if_match(self, s, etag):
+        """Delete a secret's object if it still has the given ETag, returning
+        whether it did. Other errors are raised, the secret may still exist."""
+        try:
+            self.client.delete_object(
+                Bucket=self.config.bucket_name,
+                Key=os.path.join(self.config.bucket_path, f"{s.id}.json"),
+                IfMatch=etag,
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in GONE_CODES:
+                logger.info(f"Secret already consumed: {s.id}: {e}")
+                return False
+            raise
+        logger.info(f"Deleting S3 secret: {s.id}")
+        return True
+
+    def stats(self):
+        return self.hedger.stats()
+
+    def acquire_cleaner_lease(self, owner, ttl, stats=None):
+        """Take or renew the cleaner lease, an object holding the owner and
+        expiry of the lease. Writes are conditional on the object being absent
+        or unchanged since it was read, so only one process can hold it."""
+        key = os.path.join(self.config.bucket_path, "_cleaner.lease")
+        condition = {"IfNoneMatch": "*"}
+        try:
+            lease_obj = self.cleaner_client.get_object(
+                Bucket=self.config.bucket_name, Key=key
+            )
+            condition = {"IfMatch": lease_obj["ETag"]}
+            if lease_held(lease_obj["Body"].read(), owner):
+                return False
+        except self.cleaner_client.exceptions.NoSuchKey:
+            pass
+        lease = {**(stats or {}), "owner": owner, "expires_at": int(time.time() + ttl)}
+        try:
+            self.cleaner_client.put_object(
+                Body=json.dumps(lease).encode("utf-8"),
+                Bucket=self.config.bucket_name,
+                Key=key,
+                **condition,
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("PreconditionFailed", "412"):
+                return False
+            raise
+        return True
+
     def delete_expired(self):
-        store_objs = self.client.list_objects_v2(
-            Bucket=self.config.bucket_name, Prefix=self.config.bucket_path
+        """Delete secrets whose expiry index keys have come due. Index keys
+        are listed in expiry order, so listing stops at the first key that is
+        not due yet and no per-object requests are needed."""
+        if not self.index_checked:
+            self.ensure_index()
+        now = int(time.time())
+        keys = []
+        scanned = deleted = 0
+        for index_key in self.list_s3_keys(self.index_prefix, self.cleaner_client):
+            scanned += 1
+            expires_at, _, secret_id = os.path.basename(index_key).partition(".")
+            if expires_at.isdigit() and int(expires_at) > now:
+                break
+            keys.append(index_key)
+            if secret(secret_id).check_id():
+                keys.append(os.path.join(self.config.bucket_path, f"{secret_id}.json"))
+                deleted += 1
+        logger.info(f"Deleting {len(keys)} expired S3 objects")
+        self.delete_s3_objs(keys, self.cleaner_client)
+        return {"scanned": scanned, "deleted": deleted}
+
+    def index_secret(self, s, client=None):
+        """Add an empty expiry index object for a secret, keyed by the zero
+        padded expiry date so that keys sort in expiry order"""
+        (client or self.client).put_object(
+            Body=b"",
+            Bucket=self.config.bucket_name,
+            Key=f"{self.index_prefix}{s.expires_at():010d}.{s.id}",
         )
-        for store_obj in store_objs.get("Contents", []):
-            secret_id, ext = os.path.splitext(os.path.basename(store_obj["Key"]))
-            if ext != ".json":
-                continue
+
+    def ensure_index(self):
+        """Build the expiry index if it is empty, for secrets stored before it
+        existed. Called by the first sweep of the process holding the cleaner
+        lease, so only one process lists the bucket."""
+        index = self.cleaner_client.list_objects_v2(
+            Bucket=self.config.bucket_name, Prefix=self.index_prefix, MaxKeys=1
+        )
+        if not index.get("KeyCount"):
+            self.rebuild_index()
+        self.index_checked = True
+
+    def rebuild_index(self):
+        """Rebuild the expiry index from the tags of every stored secret"""
+        logger.info(f"Rebuilding S3 expiry index in {self.index_prefix}")
+        count = 0
+        prefix = os.path.join(self.config.bucket_path, "")
+        client = self.cleaner_client
+        for key in self.list_s3_keys(prefix, client, Delimiter="/"):
+            secret_id, ext = os.path.splitext(os.path.basename(key))
             s = secret(secret_id)
-            s.create_date, s.expire_date = self.get_s3_obj_dates(store_obj["Key"])
-            if s.check_id() and s.is_expired():
-                self.delete_secret(secret_id)
-
-    def get_s3_obj_dates(self, full_key):
-        tagset = self.client.get_object_tagging(
-            Bucket=self.config.bucket_name, Key=full_key
-        ).get("TagSet")
+            if ext != ".json" or not s.check_id():
+                continue
+            try:
+                s.create_date, s.expire_date = self.get_s3_obj_dates(key, client)
+            except client.exceptions.NoSuchKey:
+                # consumed or deleted since it was listed
+                continue
+            self.index_secret(s, client)
+            count += 1
+        logger.info(f"Rebuilt S3 expiry index for {count} secrets")
+
+    def get_s3_obj_dates(self, full_key, client=None):
+        tagset = (
+            (client or self.client)
+            .get_object_tagging(Bucket=self.config.bucket_name, Key=full_key)
+            .get("TagSet")
+        )
         create_date, expire_date = 0, 0
         for tag in tagset:
             if tag["Key"] == "create_date":
@@ -70,38 +371,133 @@ class s3(store):
             pass
         return True
 
+    def list_s3_keys(self, prefix, client=None, **kwargs):
+        """Iterate over all keys under a prefix, a page at a time"""
+        paginator = (client or self.client).get_paginator("list_objects_v2")
+        pages = paginator.paginate(
+            Bucket=self.config.bucket_name, Prefix=prefix, **kwargs
+        )
+        for page in pages:
+            for store_obj in page.get("Contents", []):
+                yield store_obj["Key"]
+
+    def delete_s3_objs(self, keys, client=None):
+        """Delete keys in batches of up to 1000 per request"""
+        for i in range(0, len(keys), 1000):
+            response = (client or self.client).delete_objects(
+                Bucket=self.config.bucket_name,
+                Delete={
+                    "Objects": [{"Key": key} for key in keys[i : i + 1000]],
+                    "Quiet": True,
+                },
+            )
+            for error in response.get("Errors", []):
+                logger.error(f"Could not delete S3 object {error['Key']}: {error}")
+        return True
+
     def get_s3_obj(self, key):
+        """Get an object, hedged if it is slow. The body of the response which
+        loses is closed so its connection goes back to the pool."""
         full_path = os.path.join(self.config.bucket_path, key)
         try:
-            store_obj = self.client.get_object(
-                Bucket=self.config.bucket_name, Key=full_path
+            store_obj = self.hedger.read(
+                self.client.get_object,
+                discard=lambda o: o["Body"].close(),
+                Bucket=self.config.bucket_name,
+                Key=full_path,
             )
         except self.client.exceptions.NoSuchKey:
             return False
         return store_obj
 
-    def put_s3_obj(self, s):
+    def put_s3_obj(self, s, **kwargs):
         full_path = os.path.join(self.config.bucket_path, f"{s.id}.json")
         self.client.put_object(
-            Body=bytes(json.dumps(s.__dict__).encode("utf-8")),
+            Body=serialization.dumps(s),
             Bucket=self.config.bucket_name,
             Key=full_path,
-            Tagging=f"create_date={s.create_date}&expire_date={s.expire_date}",
+            **self._put_args(s),
+            **kwargs,
         )
         return True
 
+    def _put_args(self, s):
+        """Content type, metadata and tags for a secret object"""
+        return {
+            "ContentType": "application/octet-stream",
+            "Metadata": {
+                "create_date": str(s.create_date),
+                "expire_date": str(s.expire_date),
+            },
+            "Tagging": f"create_date={s.create_date}&expire_date={s.expire_date}",
+        }
+
     def secret_from_s3_obj(self, secret_filename):
         store_obj = self.get_s3_obj(secret_filename)
         if not store_obj:
             return False
+        return self.secret_from_body(store_obj["Body"])
 
-        s = secret()
-        try:
-            s.load_from_dict(json.load(store_obj["Body"]))
-        except Exception as e:
-            logger.error(f"Could not parse S3 file: {e}")
+    def secret_from_body(self, body):
+        s = serialization.loads(body.read())
+        if not s:
+            logger.error("Could not parse S3 file")
+        return s
 
-        if s and s.check_id():
-            return s
-        else:
-            return False
+    def migrate_format(self):
+        """Rewrite secrets stored as JSON in the binary format. Each write is
+        conditional on the ETag that was read, so a secret consumed or changed
+        meanwhile is left alone."""
+        logger.info("Migrating S3 secrets to binary format")
+        count = 0
+        prefix = os.path.join(self.config.bucket_path, "")
+        for key in self.list_s3_keys(prefix, Delimiter="/"):
+            if not key.endswith(".json"):
+                continue
+            try:
+                store_obj = self.client.get_object(
+                    Bucket=self.config.bucket_name, Key=key
+                )
+            except self.client.exceptions.NoSuchKey:
+                continue
+            data = store_obj["Body"].read()
+            s = serialization.loads(data)
+            if serialization.is_binary(data) or not s:
+                continue
+            try:
+                self.put_s3_obj(s, IfMatch=store_obj["ETag"])
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in GONE_CODES:
+                    raise
+                logger.info(f"Skipping changed S3 secret {key}: {e}")
+                continue
+            count += 1
+        logger.info(f"Migrated {count} S3 secrets to binary format")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="S3 store maintenance")
+    parser.add_argument("command", choices=["rebuild-index", "migrate-format"])
+    parser.add_argument("--bucket-name", required=True, help="bucket name")
+    parser.add_argument("--bucket-path", default="", help="path within bucket")
+    parser.add_argument("--endpoint-url", default="", help="S3 endpoint URL")
+    args = parser.parse_args()
+
+    backend = s3()
+    config = {
+        **backend.default_config,
+        "bucket_name": args.bucket_name,
+        "bucket_path": args.bucket_path,
+        "endpoint_url": args.endpoint_url,
+    }
+    backend.config = check_config(config, backend.default_config)
+    backend._connect()
+    if args.command == "rebuild-index":
+        backend.rebuild_index()
+    elif args.command == "migrate-format":
+        backend.migrate_format()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from whisper import check_config, secret
+
+logger = logging.getLogger(__name__)
+
+
+class secret_cache:
+    """Size bounded LRU cache of multi-use secrets. Entries are kept for at
+    most ttl seconds and never past the secret's expiration date. One-time
+    secrets are never cached."""
+
+    def __init__(self, cache_config={}):
+        self.default_config = {
+            "enabled": False,
+            "max_bytes": 67108864,
+            "max_entry_bytes": 1048576,
+            "ttl": 60,
+        }
+        config = {**self.default_config, **cache_config}
+        self.config = check_config(config, self.default_config)
+        # id: (deadline, create_date, expire_date, hash, data, size)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, secret_id):
+        """Return a copy of a cached secret, or None"""
+        with self.lock:
+            entry = self.entries.get(secret_id)
+            if entry and entry[0] > time.time():
+                self.entries.move_to_end(secret_id)
+                self.hits += 1
+            else:
+                if entry:
+                    self._remove(secret_id)
+                self.misses += 1
+                return None
+        s = secret(secret_id)
+        _, s.create_date, s.expire_date, s.hash, s.data, _ = entry
+        return s
+
+    def put(self, s):
+        """Cache a multi-use secret, evicting the least recently used entries
+        to stay within max_bytes"""
+        if s.is_one_time() or s.data is None:
+            return
+        size = len(s.data) + len(s.hash or "") + 256
+        deadline = min(time.time() + self.config.ttl, s.expires_at())
+        if size > self.config.max_entry_bytes or deadline <= time.time():
+            return
+        with self.lock:
+            self._remove(s.id)
+            while self.entries and self.bytes + size > self.config.max_bytes:
+                self._remove(next(iter(self.entries)))
+            self.entries[s.id] = (
+                deadline,
+                s.create_date,
+                s.expire_date,
+                s.hash,
+                s.data,
+                size,
+            )
+            self.bytes += size
+
+    def invalidate(self, secret_id):
+        with self.lock:
+            self._remove(secret_id)
+
+    def delete_expired(self):
+        """Drop entries past their deadline"""
+        now = time.time()
+        with self.lock:
+            for secret_id in [i for i, e in self.entries.items() if e[0] <= now]:
+                self._remove(secret_id)
+
+    def stats(self):
+        """Return hit and miss counters and cache size gauges"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.config.max_bytes,
+            }
+
+    def _remove(self, secret_id):
+        """Remove an entry. Must hold the lock."""
+        entry = self.entries.pop(secret_id, None)
+        if entry:
+            self.bytes -= entry[-1]
@@ -0,0 +1,202 @@
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from whisper import check_config
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"WFLT0001"
+# magic, counters, hashes, built_at, rebuilding
+HEADER = struct.Struct("<8sQIqB")
+HEADER_SIZE = 64
+
+
+class secret_filter:
+    """Counting Bloom filter of stored secret IDs, kept in a memory mapped file
+    shared by every worker process on the host. A lookup that misses means the
+    secret is definitely not stored, so requests for random IDs never reach the
+    backend. The filter is rebuilt from a listing of the backend at startup and
+    then every rebuild_interval seconds by the storage cleaner."""
+
+    def __init__(self, filter_config={}):
+        self.default_config = {
+            "enabled": False,
+            "path": "/dev/shm/whisper.filter",
+            "capacity": 100000,
+            "error_rate": 0.01,
+            "rebuild_interval": 3600,
+        }
+        config = {**self.default_config, **filter_config}
+        self.config = check_config(config, self.default_config)
+        self.lock = threading.Lock()
+
+    def start(self, backend):
+        self.backend = backend
+        n, p = self.config.capacity, self.config.error_rate
+        counters = math.ceil(-n * math.log(p) / math.log(2) ** 2)
+        hashes = max(1, round(counters / n * math.log(2)))
+        self.fd = os.open(self.config.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            header = os.pread(self.fd, HEADER.size, 0)
+            if len(header) == HEADER.size and header[:8] == MAGIC:
+                _, counters, hashes, _, _ = HEADER.unpack(header)
+            else:
+                os.ftruncate(self.fd, HEADER_SIZE + counters * 2)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, counters, hashes, 0, 0), 0)
+        self.counters, self.hashes = counters, hashes
+        self.mm = mmap.mmap(self.fd, 0)
+        # a second region holds the filter being built during a rebuild
+        self.live = HEADER_SIZE
+        self.pending = HEADER_SIZE + counters
+        logger.info(
+            f"Secret filter {self.config.path}: {counters} counters, "
+            f"{hashes} hashes"
+        )
+        if not self._header()[3]:
+            threading.Thread(
+                name="filter_rebuild", target=self.rebuild, daemon=True
+            ).start()
+
+    @contextmanager
+    def _locked(self):
+        """Hold the in-process lock and a cross-process file lock"""
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _header(self):
+        return HEADER.unpack_from(self.mm, 0)
+
+    def _indexes(self, secret_id):
+        digest = hashlib.blake2b(secret_id.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.counters for i in range(self.hashes)]
+
+    def might_contain(self, secret_id):
+        """False if the secret is definitely not stored. Until the first build
+        has finished every ID might be stored."""
+        if not self._header()[3]:
+            return True
+        return all(self.mm[self.live + i] for i in self._indexes(secret_id))
+
+    def add(self, secret_id):
+        with self._locked():
+            regions = [self.live]
+            if self._header()[4]:
+                regions.append(self.pending)
+            for region in regions:
+                self._increment(region, self._indexes(secret_id))
+
+    def remove(self, secret_id):
+        """Remove a secret that is known to have been stored. Removing one
+        that wasn't would clear counters used by other secrets."""
+        with self._locked():
+            for i in self._indexes(secret_id):
+                # saturated counters are never decremented
+                if 0 < self.mm[self.live + i] < 255:
+                    self.mm[self.live + i] -= 1
+
+    def _increment(self, region, indexes):
+        for i in indexes:
+            if self.mm[region + i] < 255:
+                self.mm[region + i] += 1
+
+    def rebuild_if_due(self):
+        if time.time() - self._header()[3] >= self.config.rebuild_interval:
+            self.rebuild()
+
+    def rebuild(self):
+        """Build a new filter from a listing of the backend. Secrets added
+        while the listing runs are added to both filters, so none are lost
+        when the new filter replaces the old one. Only one process rebuilds at
+        a time."""
+        lock_fd = os.open(f"{self.config.path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return
+        try:
+            # another process may have finished a rebuild meanwhile
+            built_at = self._header()[3]
+            if built_at and time.time() - built_at < self.config.rebuild_interval:
+                return
+            self._rebuild()
+        except Exception as e:
+            logger.error(f"Secret filter rebuild failed: {e}")
+            with self._locked():
+                self._set_header(rebuilding=0)
+        finally:
+            os.close(lock_fd)
+
+    def _rebuild(self):
+        start = time.time()
+        with self._locked():
+            self.mm[self.pending : self.pending + self.counters] = bytes(self.counters)
+            self._set_header(rebuilding=1)
+        ids = self.backend.list_secret_ids()
+        if ids is None:
+            logger.warning("Storage backend can't list secrets, filter disabled")
+            with self._locked():
+                self._set_header(rebuilding=0)
+            return
+        count = 0
+        batch = []
+        for secret_id in ids:
+            batch.append(secret_id)
+            if len(batch) >= 1000:
+                count += self._add_pending(batch)
+                batch = []
+        count += self._add_pending(batch)
+        with self._locked():
+            self.mm[self.live : self.live + self.counters] = self.mm[
+                self.pending : self.pending + self.counters
+            ]
+            self._set_header(built_at=int(time.time()), rebuilding=0)
+        logger.info(
+            f"Rebuilt secret filter with {count} secrets in "
+            f"{time.time() - start:.1f}s"
+        )
+
+    def _add_pending(self, ids):
+        with self._locked():
+            for secret_id in ids:
+                self._increment(self.pending, self._indexes(secret_id))
+        return len(ids)
+
+    def _set_header(self, built_at=None, rebuilding=None):
+        magic, counters, hashes, old_built_at, old_rebuilding = self._header()
+        HEADER.pack_into(
+            self.mm,
+            0,
+            magic,
+            counters,
+            hashes,
+            old_built_at if built_at is None else built_at,
+            old_rebuilding if rebuilding is None else rebuilding,
+        )
+
+    def stats(self):
+        """Return the filter size and its estimated false positive rate, from
+        the fraction of counters in use"""
+        used = self.counters - self.mm[self.live : self.live + self.counters].count(0)
+        return {
+            "bytes": len(self.mm),
+            "counters": self.counters,
+            "hashes": self.hashes,
+            "fill_ratio": used / self.counters,
+            "false_positive_rate": (used / self.counters) ** self.hashes,
+            "built_at": self._header()[3],
+        }
@@ -1,31 +1,116 @@
+import argparse
 import json
 import logging
 import os
+import socket
+import time
 
-from google.api_core.exceptions import RetryError
+import google.auth
+from google.api_core.exceptions import (
+    GoogleAPICallError,
+    PreconditionFailed,
+    RetryError,
+)
+from google.auth.credentials import AnonymousCredentials
 from google.auth.exceptions import TransportError
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
 from google.cloud.exceptions import NotFound
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectTimeout
+from urllib3.connection import HTTPConnection
 from urllib3.exceptions import ConnectTimeoutError, MaxRetryError
-from whisper import secret
-from whisper.storage import store
+from urllib3.util.retry import Retry
+from whisper import check_config, secret, serialization
+from whisper.storage import lease_held, store_backend, warm_up
+from whisper.storage.hedge import read_hedger
 
 logger = logging.getLogger(__name__)
 
 
-class gcs(store):
+class pool_adapter(HTTPAdapter):
+    """HTTP adapter with a connection pool of a given size, retrying failed
+    connections with backoff and optionally enabling TCP keepalive"""
+
+    def __init__(self, pool_size, max_retries, backoff, keepalive):
+        self.socket_options = list(HTTPConnection.default_socket_options)
+        if keepalive:
+            self.socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        # only connection errors are retried here, a request that was sent is
+        # retried by the storage client if it is safe to repeat
+        retry = Retry(
+            total=None,
+            connect=max_retries,
+            read=0,
+            status=0,
+            backoff_factor=backoff,
+        )
+        super().__init__(pool_maxsize=pool_size, max_retries=retry)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+class gcs(store_backend):
     def __init__(self, name="gcp", parent=None):
         self.default_config = {
             "bucket_name": None,
             "bucket_path": "",
             "gcp_project": None,
+            "max_pool_connections": 32,
+            "cleaner_pool_connections": 4,
+            "connect_timeout": 5,
+            "read_timeout": 60,
+            "max_retries": 3,
+            "retry_backoff": 0.5,
+            "tcp_keepalive": True,
+            "warm_up_connections": 0,
+            "hedge_config": {},
         }
         super().__init__(name, parent)
 
     def start(self):
-        self.client = storage.Client(project=self.config.gcp_project)
-        self.bucket = self.client.get_bucket(self.config.bucket_name)
+        self.timeout = (self.config.connect_timeout, self.config.read_timeout)
+        self._connect()
+        self.hedger = read_hedger(
+            self.config.hedge_config, self.config.max_pool_connections, "gcs"
+        )
+        if self.config.warm_up_connections:
+            warm_up(
+                lambda: self.bucket.reload(timeout=self.timeout),
+                min(self.config.warm_up_connections, self.config.max_pool_connections),
+            )
+
+    def _connect(self):
+        """Create the GCS clients and buckets, also used to reconnect after
+        transport errors. Request threads share a client and its connection
+        pool, the cleaner and other background work use a second client with
+        its own smaller pool so they can't hold up requests."""
+        self.client = self._client(self.config.max_pool_connections)
+        self.bucket = self.client.get_bucket(
+            self.config.bucket_name, timeout=self.timeout
+        )
+        self.cleaner_client = self._client(self.config.cleaner_pool_connections)
+        self.cleaner_bucket = self.cleaner_client.bucket(self.config.bucket_name)
+
+    def _client(self, pool_size):
+        if os.environ.get("STORAGE_EMULATOR_HOST"):
+            credentials = AnonymousCredentials()
+        else:
+            credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+        session = AuthorizedSession(credentials)
+        adapter = pool_adapter(
+            pool_size,
+            self.config.max_retries,
+            self.config.retry_backoff,
+            self.config.tcp_keepalive,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return storage.Client(
+            project=self.config.gcp_project, credentials=credentials, _http=session
+        )
 
     def get_secret(self, secret_id):
         s = secret(secret_id)
@@ -42,42 +127,161 @@ class gcs(store):
         self.put_gcs_obj(s)
         return True
 
+    def set_secret_stream(self, s, stream):
+        """Upload the secret as its data is read, with a resumable upload"""
+        if not s.check_id():
+            return False
+        logger.debug(f"Saving GCS secret: {s.id}")
+        full_path = os.path.join(self.config.bucket_path, f"{s.id}.json")
+        store_obj = self.bucket.blob(full_path)
+        store_obj.metadata = {
+            "create_date": s.create_date,
+            "expire_date": s.expire_date,
+        }
+        f = store_obj.open(
+            "wb", content_type="application/octet-stream", timeout=self.timeout
+        )
+        # the upload is only finished by closing the writer, so an error while
+        # reading the data leaves no object behind
+        for chunk in serialization.dumps_stream(s, stream):
+            f.write(chunk)
+        f.close()
+        return True
+
     def delete_secret(self, secret_id):
         logger.info(f"Deleting GCS secret: {secret_id}")
         self.delete_gcs_obj(f"{secret_id}.json")
         return True
 
-    def delete_expired(self):
-        try:
-            store_objs = list(
-                self.client.list_blobs(
-                    self.config.bucket_name, prefix=self.config.bucket_path
+    def get_secret_metadata(self, secret_id):
+        """Read the secret dates from the object metadata without downloading
+        the object"""
+        s = secret(secret_id)
+        if not s.check_id():
+            return False
+        store_obj = self.get_gcs_obj(f"{s.id}.json")
+        if not store_obj:
+            return False
+        s.create_date, s.expire_date = self.get_gcs_obj_dates(store_obj)
+        return s
+
+    def secret_exists(self, secret_id):
+        return bool(self.get_secret_metadata(secret_id))
+
+    def list_secret_ids(self):
+        store_objs = self.cleaner_client.list_blobs(
+            self.config.bucket_name,
+            prefix=self.config.bucket_path,
+            timeout=self.timeout,
+        )
+        for store_obj in store_objs:
+            secret_id, ext = os.path.splitext(os.path.basename(store_obj.name))
+            if ext == ".json":
+                yield secret_id
+
+    def consume_secret(self, secret_id, verifier):
+        """Check the password, then delete one-time secrets with a delete
+        conditional on the generation that was read. Only one request's delete
+        can succeed, so only one request receives the secret."""
+        s = secret(secret_id)
+        if not s.check_id():
+            return False, False
+        store_obj = self.get_gcs_obj(f"{s.id}.json")
+        if not store_obj:
+            return False, False
+        s = self.secret_from_bytes(self.download_gcs_obj(store_obj))
+        if not s:
+            return False, False
+        if not verifier(s):
+            return s, False
+        if s.is_one_time():
+            try:
+                store_obj.delete(
+                    if_generation_match=store_obj.generation, timeout=self.timeout
                 )
+            except (NotFound, PreconditionFailed) as e:
+                logger.info(f"Secret already consumed: {s.id}: {e}")
+                return False, False
+            logger.info(f"Deleting GCS secret: {s.id}")
+        return s, True
+
+    def stats(self):
+        return self.hedger.stats()
+
+    def acquire_cleaner_lease(self, owner, ttl, stats=None):
+        """Take or renew the cleaner lease, an object holding the owner and
+        expiry of the lease. Uploads are conditional on the generation that
+        was read, so only one process can hold it."""
+        lease_obj = self.cleaner_bucket.blob(
+            os.path.join(self.config.bucket_path, "_cleaner.lease")
+        )
+        generation = 0
+        try:
+            data = lease_obj.download_as_bytes(timeout=self.timeout)
+            generation = lease_obj.generation
+            if lease_held(data, owner):
+                return False
+        except NotFound:
+            pass
+        lease = {**(stats or {}), "owner": owner, "expires_at": int(time.time() + ttl)}
+        try:
+            lease_obj.upload_from_string(
+                data=json.dumps(lease).encode("utf-8"),
+                content_type="application/json",
+                if_generation_match=generation,
+                timeout=self.timeout,
             )
-        except (
-            TimeoutError,
-            TransportError,
-            RetryError,
-            ConnectTimeoutError,
-            MaxRetryError,
-            ConnectTimeout,
-        ) as e:
-            logger.error(f"GCS connection error: {e}")
-            self._connect()
-            logger.error("Reconnected.")
+        except PreconditionFailed:
+            return False
+        return True
+
+    def delete_expired(self):
+        """Delete expired secrets using the metadata returned by the listing,
+        so a sweep costs one request per page of objects plus one batch
+        request per 100 expired objects"""
+        for attempt in range(2):
+            try:
+                expired, scanned = self.list_expired_objs()
+                break
+            except (
+                TimeoutError,
+                TransportError,
+                RetryError,
+                ConnectTimeoutError,
+                MaxRetryError,
+                ConnectTimeout,
+            ) as e:
+                logger.error(f"GCS connection error: {e}")
+                self._connect()
+                logger.error("Reconnected.")
+        else:
+            return
+        logger.info(f"Deleting {len(expired)} expired GCS objects")
+        self.delete_gcs_objs(expired)
+        return {"scanned": scanned, "deleted": len(expired)}
 
+    def list_expired_objs(self):
+        """Return the expired secret objects and the number of secrets listed"""
+        expired = []
+        scanned = 0
+        store_objs = self.cleaner_client.list_blobs(
+            self.config.bucket_name,
+            prefix=self.config.bucket_path,
+            timeout=self.timeout,
+        )
         for store_obj in store_objs:
             secret_id, ext = os.path.splitext(os.path.basename(store_obj.name))
             if ext != ".json":
                 continue
+            scanned += 1
             s = secret(secret_id)
-            s.create_date, s.expire_date = self.get_gcs_obj_dates(store_obj.name)
+            s.create_date, s.expire_date = self.get_gcs_obj_dates(store_obj)
             if s.check_id() and s.is_expired():
-                self.delete_secret(secret_id)
+                expired.append(store_obj)
+        return expired, scanned
 
-    def get_gcs_obj_dates(self, full_key):
-        store_obj = self.bucket.get_blob(full_key)
-        if not store_obj or not store_obj.metadata:
+    def get_gcs_obj_dates(self, store_obj):
+        if not store_obj.metadata:
             return False, False
         create_date = store_obj.metadata.get("create_date", 0)
         expire_date = store_obj.metadata.get("expire_date", 0)
@@ -86,42 +290,113 @@ class gcs(store):
     def delete_gcs_obj(self, key):
         full_path = os.path.join(self.config.bucket_path, key)
         try:
-            self.bucket.delete_blob(full_path)
+            self.bucket.delete_blob(full_path, timeout=self.timeout)
         except NotFound:
             pass
         return True
 
+    def delete_gcs_objs(self, store_objs):
+        """Delete objects with batch requests of up to 100 deletes each"""
+        for i in range(0, len(store_objs), 100):
+            try:
+                with self.cleaner_client.batch():
+                    for store_obj in store_objs[i : i + 100]:
+                        store_obj.delete(timeout=self.timeout)
+            except GoogleAPICallError as e:
+                logger.error(f"Could not delete GCS objects: {e}")
+        return True
+
     def get_gcs_obj(self, key):
         full_path = os.path.join(self.config.bucket_path, key)
-        store_obj = self.bucket.get_blob(full_path)
+        store_obj = self.hedger.read(
+            self.bucket.get_blob, full_path, timeout=self.timeout
+        )
         return store_obj
 
-    def put_gcs_obj(self, s):
+    def download_gcs_obj(self, store_obj):
+        return self.hedger.read(store_obj.download_as_bytes, timeout=self.timeout)
+
+    def put_gcs_obj(self, s, **kwargs):
         full_path = os.path.join(self.config.bucket_path, f"{s.id}.json")
         store_obj = self.bucket.blob(full_path)
-        store_obj.upload_from_string(
-            data=bytes(json.dumps(s.__dict__).encode("utf-8")),
-            content_type="application/json",
-        )
+        # metadata set before the upload is sent with it in a single request
         store_obj.metadata = {
             "create_date": s.create_date,
             "expire_date": s.expire_date,
         }
-        store_obj.patch()
+        store_obj.upload_from_string(
+            data=serialization.dumps(s),
+            content_type="application/octet-stream",
+            timeout=self.timeout,
+            **kwargs,
+        )
         return True
 
     def secret_from_gcs_obj(self, secret_filename):
         store_obj = self.get_gcs_obj(secret_filename)
         if not store_obj:
             return False
+        return self.secret_from_bytes(self.download_gcs_obj(store_obj))
 
-        s = secret()
-        try:
-            s.load_from_dict(json.loads(store_obj.download_as_bytes().decode()))
-        except Exception as e:
-            logger.error(f"Could not parse GCS file: {e}")
+    def secret_from_bytes(self, data):
+        s = serialization.loads(data)
+        if not s:
+            logger.error("Could not parse GCS file")
+        return s
 
-        if s and s.check_id():
-            return s
-        else:
-            return False
+    def migrate_format(self):
+        """Rewrite secrets stored as JSON in the binary format. Each upload is
+        conditional on the generation that was read, so a secret consumed or
+        changed meanwhile is left alone."""
+        logger.info("Migrating GCS secrets to binary format")
+        count = 0
+        store_objs = self.cleaner_client.list_blobs(
+            self.config.bucket_name,
+            prefix=self.config.bucket_path,
+            timeout=self.timeout,
+        )
+        for store_obj in store_objs:
+            if not store_obj.name.endswith(".json"):
+                continue
+            try:
+                data = store_obj.download_as_bytes(
+                    if_generation_match=store_obj.generation, timeout=self.timeout
+                )
+            except (NotFound, PreconditionFailed):
+                continue
+            s = serialization.loads(data)
+            if serialization.is_binary(data) or not s:
+                continue
+            try:
+                self.put_gcs_obj(s, if_generation_match=store_obj.generation)
+            except (NotFound, PreconditionFailed) as e:
+                logger.info(f"Skipping changed GCS secret {store_obj.name}: {e}")
+                continue
+            count += 1
+        logger.info(f"Migrated {count} GCS secrets to binary format")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GCS store maintenance")
+    parser.add_argument("command", choices=["migrate-format"])
+    parser.add_argument("--bucket-name", required=True, help="bucket name")
+    parser.add_argument("--bucket-path", default="", help="path within bucket")
+    parser.add_argument("--gcp-project", required=True, help="GCP project")
+    args = parser.parse_args()
+
+    backend = gcs()
+    config = {
+        **backend.default_config,
+        "bucket_name": args.bucket_name,
+        "bucket_path": args.bucket_path,
+        "gcp_project": args.gcp_project,
+    }
+    backend.config = check_config(config, backend.default_config)
+    backend.start()
+    if args.command == "migrate-format":
+        backend.migrate_format()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
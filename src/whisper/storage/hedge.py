@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from whisper import check_config
+from whisper.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# reads needed before the delay is taken from their latencies
+MIN_SAMPLES = 20
+# hedges which can be saved up while reads are fast
+MAX_TOKENS = 10
+
+
+class read_hedger:
+    """Hedged reads for cloud stores. A read which hasn't returned within the
+    given percentile of recent read latencies is sent a second time and
+    whichever response arrives first is used. Each read earns max_rate of a
+    hedge, so hedges are limited to that fraction of reads."""
+
+    def __init__(self, hedge_config={}, workers=32, backend=""):
+        self.default_config = {
+            "enabled": False,
+            "percentile": 95,
+            "min_delay_ms": 5,
+            "max_rate": 0.05,
+            "window": 1000,
+        }
+        config = {**self.default_config, **hedge_config}
+        self.config = check_config(config, self.default_config)
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=self.config.window)
+        self.samples = 0
+        self.delay = None
+        self.tokens = 0.0
+        self.reads = 0
+        self.hedges = 0
+        if self.config.enabled:
+            # the first read and its hedge each need a thread
+            self.pool = ThreadPoolExecutor(
+                max_workers=workers * 2, thread_name_prefix=f"{backend}_read"
+            )
+
+    def read(self, fn, *args, discard=None, **kwargs):
+        """Return fn(*args, **kwargs), hedging it if it is slow. discard is
+        called with the response that loses, to release its connection."""
+        if not self.config.enabled:
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        first = self.pool.submit(fn, *args, **kwargs)
+        first.add_done_callback(lambda f: self._record(time.perf_counter() - start))
+        with self.lock:
+            self.reads += 1
+            self.tokens = min(self.tokens + self.config.max_rate, MAX_TOKENS)
+            delay = self.delay
+        if delay is None or wait([first], timeout=delay).done:
+            return first.result()
+        with self.lock:
+            allowed = self.tokens >= 1
+            if allowed:
+                self.tokens -= 1
+                self.hedges += 1
+        if not allowed:
+            return first.result()
+        hedge = self.pool.submit(fn, *args, **kwargs)
+        metrics.inc("store_hedges", backend=self.backend, outcome="sent")
+        done, _ = wait([first, hedge], return_when=FIRST_COMPLETED)
+        winner = first if first in done else hedge
+        loser = hedge if winner is first else first
+        if winner is hedge:
+            metrics.inc("store_hedges", backend=self.backend, outcome="won")
+        if discard:
+            loser.add_done_callback(lambda f: self._discard(f, discard))
+        return winner.result()
+
+    def _record(self, latency):
+        """Add the latency of a first read and update the hedge delay"""
+        with self.lock:
+            self.latencies.append(latency)
+            self.samples += 1
+            # sorting the window on every read would cost more than it gains
+            if self.samples < MIN_SAMPLES or self.samples % 10:
+                return
+            ordered = sorted(self.latencies)
+            index = int(len(ordered) * self.config.percentile / 100)
+            self.delay = max(
+                ordered[min(index, len(ordered) - 1)],
+                self.config.min_delay_ms / 1000,
+            )
+
+    def _discard(self, future, discard):
+        if future.cancelled() or future.exception() is not None:
+            return
+        try:
+            discard(future.result())
+        except Exception as e:
+            logger.debug(f"Could not discard hedged read: {e}")
+
+    def stats(self):
+        """Return the current delay and the fraction of reads hedged"""
+        if not self.config.enabled:
+            return {}
+        with self.lock:
+            return {
+                "hedge_delay_ms": (self.delay or 0) * 1000,
+                "hedge_rate": self.hedges / self.reads if self.reads else 0,
+            }
@@ -1,68 +1,380 @@
+import argparse
 import glob
-import json
 import logging
 import os
+import struct
+import tempfile
+import threading
+import time
 
-from whisper import secret
-from whisper.storage import store
+from whisper import check_config, secret, serialization
+from whisper.storage import closing_iter, store_backend
 
 logger = logging.getLogger(__name__)
 
 
-class local(store):
+class local(store_backend):
     def __init__(self, name="local", parent=None, path="/tmp/whisper"):
-        self.default_config = {"path": "/tmp/whisper"}
+        self.default_config = {
+            "path": "/tmp/whisper",
+            "fanout_levels": 2,
+            "index_bucket_seconds": 3600,
+        }
         super().__init__(name, parent)
 
     def start(self):
         if not os.path.exists(self.config.path):
             os.makedirs(self.config.path)
             logger.info(f"Created directory {self.config.path}")
+        if self.config.fanout_levels and glob.glob(self._flat_path("*")):
+            threading.Thread(
+                name="local_fanout_migrate", target=self.migrate_fanout, daemon=True
+            ).start()
+        # the first process to create the index directory builds it from any
+        # secrets stored before the index existed
+        try:
+            os.mkdir(self.index_path)
+        except FileExistsError:
+            return
+        threading.Thread(
+            name="local_index_rebuild", target=self.rebuild_index, daemon=True
+        ).start()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.config.path, ".expiry")
+
+    def secret_path(self, secret_id):
+        """Path of a secret file, fanned out into nested directories named by
+        pairs of characters from the start of the ID (ab/cd/abcd...json)"""
+        levels = [
+            secret_id[i * 2 : i * 2 + 2] for i in range(self.config.fanout_levels)
+        ]
+        return os.path.join(self.config.path, *levels, f"{secret_id}.json")
+
+    def _flat_path(self, secret_id):
+        """Path of a secret file stored before fan out was enabled"""
+        return os.path.join(self.config.path, f"{secret_id}.json")
 
     def get_secret(self, secret_id):
         s = secret(secret_id)
         if not s.check_id():
             return False
-        secret_filename = os.path.join(self.config.path, f"{s.id}.json")
+        secret_filename = self.secret_path(s.id)
+        if not os.path.exists(secret_filename):
+            secret_filename = self._flat_path(s.id)
         logger.debug(f"Reading secret from file: {secret_filename}")
         return self.secret_from_file(secret_filename)
 
     def set_secret(self, s):
         if not s.check_id():
             return False
-        secret_filename = os.path.join(self.config.path, f"{s.id}.json")
-        with open(secret_filename, "w") as secret_file:
-            json.dump(s.__dict__, secret_file)
+        secret_filename = self.secret_path(s.id)
+        self._write_atomic(secret_filename, serialization.dumps(s))
+        self.index_secret(s)
+        logger.debug(f"Saving secret: {secret_filename}")
+        return True
+
+    def set_secret_stream(self, s, stream):
+        """Write the secret as its data is read, a chunk at a time"""
+        if not s.check_id():
+            return False
+        secret_filename = self.secret_path(s.id)
+        self._write_atomic(secret_filename, serialization.dumps_stream(s, stream))
+        self.index_secret(s)
         logger.debug(f"Saving secret: {secret_filename}")
         return True
 
     def delete_secret(self, secret_id):
         s = secret(secret_id)
-        secret_filename = os.path.join(self.config.path, f"{s.id}.json")
-        if not s or not s.check_id() or not os.path.exists(secret_filename):
+        if not s or not s.check_id():
             return True
-        logger.info(f"Deleting secret: {secret_id}")
-        os.remove(secret_filename)
+        # the expiry index entry is left in place and removed by the cleaner
+        # when it comes due, finding it here would mean reading the secret.
+        # migrate_fanout can move the flat file between the first two removes,
+        # so the fan out path is tried again.
+        fanout_filename = self.secret_path(s.id)
+        for secret_filename in [
+            fanout_filename,
+            self._flat_path(s.id),
+            fanout_filename,
+        ]:
+            if self._remove(secret_filename):
+                logger.info(f"Deleting secret: {secret_id}")
         return True
 
-    def secret_from_file(self, secret_filename):
+    def get_secret_metadata(self, secret_id):
+        s = secret(secret_id)
+        if not s.check_id():
+            return False
+        secret_filename = self.secret_path(s.id)
         if not os.path.exists(secret_filename):
+            secret_filename = self._flat_path(s.id)
+        return self.secret_header_from_file(secret_filename)
+
+    def secret_exists(self, secret_id):
+        s = secret(secret_id)
+        if not s.check_id():
             return False
-        s = secret()
-        try:
-            with open(secret_filename) as secret_file:
-                s.load_from_dict(json.load(secret_file))
-        except Exception as e:
-            logger.error(f"Could not load secret file [{secret_filename}]: {e}")
-            pass
+        return os.path.exists(self.secret_path(s.id)) or os.path.exists(
+            self._flat_path(s.id)
+        )
+
+    def list_secret_ids(self):
+        for secret_filename in self.secret_filenames():
+            yield os.path.splitext(os.path.basename(secret_filename))[0]
+
+    def consume_secret(self, secret_id, verifier):
+        """Check the password, then delete one-time secrets before returning
+        them. Removing the file is the atomic step, only the request whose
+        remove succeeds receives the secret."""
+        s = secret(secret_id)
+        if not s.check_id():
+            return False, False
+        secret_filename = self.secret_path(s.id)
+        if not os.path.exists(secret_filename):
+            secret_filename = self._flat_path(s.id)
+        s = self.secret_from_file(secret_filename)
+        if not s:
+            return False, False
+        if not verifier(s):
+            return s, False
+        if s.is_one_time():
+            if not self._claim(secret_filename):
+                logger.info(f"Secret already consumed: {s.id}")
+                return False, False
+            logger.info(f"Deleting secret: {s.id}")
+        return s, True
+
+    def consume_secret_stream(self, secret_id, verifier):
+        """Like consume_secret, but only the header is read before the password
+        is checked. The file stays open once removed, so the data of a one-time
+        secret is streamed from it after it is deleted."""
+        s = secret(secret_id)
         if not s.check_id():
+            return False, False, None
+        secret_filename = self.secret_path(s.id)
+        if not os.path.exists(secret_filename):
+            secret_filename = self._flat_path(s.id)
+        try:
+            secret_file = open(secret_filename, "rb")
+        except FileNotFoundError:
+            return False, False, None
+        s, chunks = serialization.load_stream(secret_file)
+        if not s or not verifier(s):
+            secret_file.close()
+            return s, False, None
+        if s.is_one_time():
+            if not self._claim(secret_filename):
+                secret_file.close()
+                logger.info(f"Secret already consumed: {s.id}")
+                return False, False, None
+            logger.info(f"Deleting secret: {s.id}")
+        return s, True, closing_iter(chunks, secret_file)
+
+    def secret_from_file(self, secret_filename):
+        try:
+            with open(secret_filename, "rb") as secret_file:
+                s = serialization.loads(secret_file.read())
+        except FileNotFoundError:
             return False
+        if not s:
+            logger.error(f"Could not load secret file [{secret_filename}]")
         return s
 
+    def secret_header_from_file(self, secret_filename):
+        """Read a secret without its data, only the header is read from files
+        in the binary format"""
+        try:
+            with open(secret_filename, "rb") as secret_file:
+                data = secret_file.read(serialization.HEADER.size)
+                if serialization.is_binary(data):
+                    hash_len = serialization.HEADER.unpack(data)[6]
+                    data += secret_file.read(hash_len)
+                    return serialization.loads(data, header_only=True)
+                return serialization.loads(data + secret_file.read(), True)
+        except (FileNotFoundError, struct.error):
+            return False
+
     def delete_expired(self):
-        secret_filenames = glob.glob(os.path.join(self.config.path, "*.json"))
-        for secret_filename in secret_filenames:
-            secret_id = os.path.splitext(os.path.basename(secret_filename))[0]
-            s = self.secret_from_file(secret_filename)
-            if not s or s.is_expired():
+        """Delete secrets in index buckets that have come due. Only buckets
+        that start before now are read, so the cost of a sweep depends on the
+        number of expired secrets and not the number stored."""
+        now = int(time.time())
+        scanned = deleted = 0
+        for bucket in os.scandir(self.index_path):
+            if not bucket.name.isdigit() or int(bucket.name) > now:
+                continue
+            for entry in os.scandir(bucket.path):
+                scanned += 1
+                expires_at, _, secret_id = entry.name.partition(".")
+                if expires_at.isdigit() and int(expires_at) > now:
+                    continue
                 self.delete_secret(secret_id)
+                self._remove(entry.path)
+                deleted += 1
+            try:
+                os.rmdir(bucket.path)
+            except OSError:
+                pass
+        return {"scanned": scanned, "deleted": deleted}
+
+    @property
+    def cleaner_lock_path(self):
+        return os.path.join(self.config.path, ".cleaner.lock")
+
+    def index_secret(self, s):
+        """Add an expiry index entry for a secret. Entries are empty files
+        named <expires_at>.<id> in a directory per time bucket."""
+        expires_at = s.expires_at()
+        bucket = expires_at - expires_at % self.config.index_bucket_seconds
+        bucket_path = os.path.join(self.index_path, str(bucket))
+        os.makedirs(bucket_path, exist_ok=True)
+        open(os.path.join(bucket_path, f"{expires_at}.{s.id}"), "a").close()
+
+    def rebuild_index(self):
+        """Rebuild the expiry index by reading every stored secret. Secret
+        files that cannot be read are deleted."""
+        logger.info(f"Rebuilding expiry index in {self.index_path}")
+        os.makedirs(self.index_path, exist_ok=True)
+        count = 0
+        for secret_filename in self.secret_filenames():
+            s = self.secret_header_from_file(secret_filename)
+            if not s:
+                self._remove(secret_filename)
+                continue
+            self.index_secret(s)
+            count += 1
+        logger.info(f"Rebuilt expiry index for {count} secrets")
+
+    def secret_filenames(self):
+        """List all secret files, in both the fan out and flat layouts"""
+        levels = ["*"] * self.config.fanout_levels
+        filenames = glob.glob(os.path.join(self.config.path, *levels, "*.json"))
+        if self.config.fanout_levels:
+            filenames += glob.glob(self._flat_path("*"))
+        return filenames
+
+    def migrate_fanout(self):
+        """Move secrets from the flat layout into fan out directories. Secrets
+        are still found in the flat layout while this runs. Each secret is moved
+        with a single rename so it never has two names, and a secret already
+        written to the fan out layout is kept over its flat copy."""
+        logger.info(f"Migrating secrets in {self.config.path} to fan out layout")
+        count = 0
+        for flat_filename in glob.glob(self._flat_path("*")):
+            secret_id = os.path.splitext(os.path.basename(flat_filename))[0]
+            secret_filename = self.secret_path(secret_id)
+            os.makedirs(os.path.dirname(secret_filename), exist_ok=True)
+            if os.path.exists(secret_filename):
+                # written again since the layout changed, the flat copy is stale
+                self._remove(flat_filename)
+                continue
+            try:
+                os.rename(flat_filename, secret_filename)
+            except FileNotFoundError:
+                continue
+            count += 1
+        logger.info(f"Migrated {count} secrets to fan out layout")
+
+    def migrate_format(self):
+        """Rewrite secrets stored as JSON in the binary format. The new file
+        only replaces the old one if the old one could be moved aside first,
+        so a secret consumed meanwhile is never brought back."""
+        logger.info(f"Migrating secrets in {self.config.path} to binary format")
+        count = 0
+        for secret_filename in self.secret_filenames():
+            try:
+                with open(secret_filename, "rb") as secret_file:
+                    data = secret_file.read()
+            except FileNotFoundError:
+                continue
+            if serialization.is_binary(data):
+                continue
+            s = serialization.loads(data)
+            if not s:
+                continue
+            dirname = os.path.dirname(secret_filename)
+            fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(serialization.dumps(s))
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            old_filename = f"{tmp_filename}.old"
+            try:
+                os.rename(secret_filename, old_filename)
+            except FileNotFoundError:
+                self._remove(tmp_filename)
+                continue
+            os.rename(tmp_filename, secret_filename)
+            self._remove(old_filename)
+            count += 1
+        logger.info(f"Migrated {count} secrets to binary format")
+
+    def _write_atomic(self, filename, data):
+        """Write to a temporary file, fsync it and rename it into place, so a
+        crash never leaves a partially written secret. data is bytes or an
+        iterator of bytes."""
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                if isinstance(data, bytes):
+                    data = [data]
+                for chunk in data:
+                    tmp_file.write(chunk)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            self._remove(tmp_filename)
+            raise
+
+    def _claim(self, secret_filename):
+        """Remove a one-time secret's file, returning whether this call removed
+        it. A flat file moved by migrate_fanout since it was read is removed
+        from its new path."""
+        if self._remove(secret_filename):
+            return True
+        secret_id = os.path.splitext(os.path.basename(secret_filename))[0]
+        fanout_filename = self.secret_path(secret_id)
+        return fanout_filename != secret_filename and self._remove(fanout_filename)
+
+    def _remove(self, filename):
+        """Remove a file, returning whether it existed"""
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            return False
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local disk store maintenance")
+    parser.add_argument(
+        "command",
+        choices=["rebuild-index", "migrate-fanout", "migrate-format"],
+    )
+    parser.add_argument("--path", default="/tmp/whisper", help="storage path")
+    parser.add_argument("--fanout-levels", type=int, default=2, help="fan out levels")
+    args = parser.parse_args()
+
+    backend = local()
+    config = {
+        **backend.default_config,
+        "path": args.path,
+        "fanout_levels": args.fanout_levels,
+    }
+    backend.config = check_config(config, backend.default_config)
+    if args.command == "rebuild-index":
+        backend.rebuild_index()
+    elif args.command == "migrate-fanout":
+        backend.migrate_fanout()
+    elif args.command == "migrate-format":
+        backend.migrate_format()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
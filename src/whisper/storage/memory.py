@@ -1,40 +1,320 @@
+import heapq
 import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
 
-from whisper.storage import store
+from whisper import check_config, secret
+from whisper.storage import StoreFullError, store_backend
+from whisper.storage.local import local
 
 logger = logging.getLogger(__name__)
 
 
-class memory(store):
+class record:
+    """Compact in-memory copy of a secret, the encrypted data and hash are
+    kept as bytes"""
+
+    __slots__ = (
+        "id",
+        "create_date",
+        "expire_date",
+        "expires_at",
+        "data",
+        "hash",
+        "size",
+    )
+
+    def __init__(self, s):
+        self.id = s.id
+        self.create_date = s.create_date
+        self.expire_date = s.expire_date
+        self.expires_at = s.expires_at()
+        self.data = s.data.encode("utf-8") if s.data is not None else None
+        self.hash = s.hash.encode("utf-8") if s.hash is not None else None
+        self.size = (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.id)
+            + sys.getsizeof(self.data)
+            + sys.getsizeof(self.hash)
+        )
+
+    def to_secret(self):
+        s = secret(self.id)
+        s.create_date = self.create_date
+        s.expire_date = self.expire_date
+        s.data = self.data.decode("utf-8") if self.data is not None else None
+        s.hash = self.hash.decode("utf-8") if self.hash is not None else None
+        return s
+
+
+class stripe:
+    """One of the dicts secrets are spread over, with its lock and the size
+    and number of the records it holds"""
+
+    __slots__ = ("secrets", "lock", "bytes", "count")
+
+    def __init__(self):
+        self.secrets = {}
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.count = 0
+
+    def account(self, old, new):
+        """Update the stripe totals when a record is replaced, added or
+        removed. Must be called holding the stripe lock."""
+        if old:
+            self.bytes -= old.size
+            self.count -= 1
+        if new:
+            self.bytes += new.size
+            self.count += 1
+
+
+class memory(store_backend):
     def __init__(self, name="memory", parent=None):
-        self.default_config = {}
+        self.default_config = {
+            "stripes": 16,
+            "max_bytes": 0,
+            "overflow": "reject",
+            "overflow_path": "/tmp/whisper-overflow",
+        }
         super().__init__(name, parent)
 
     def start(self):
-        self.secrets = {}
+        # secrets are spread over several dicts, each with its own lock, so
+        # request threads working on different secrets rarely contend
+        self.stripes = [stripe() for _ in range(self.config.stripes)]
+        # min-heap of (expires_at, secret_id) so the cleaner only visits
+        # secrets that are due, entries for deleted secrets are skipped
+        self.expiry = []
+        self.expiry_lock = threading.Lock()
+        # byte budget, only kept when max_bytes is set. Multi-use secrets in
+        # creation order, with their sizes, are the candidates for spilling.
+        self.budget_lock = threading.Lock()
+        self.reserved_bytes = 0
+        self.spillable = OrderedDict()
+        self.overflow = None
+        if self.config.overflow == "spill":
+            self.overflow = local()
+            config = {**self.overflow.default_config, "path": self.config.overflow_path}
+            self.overflow.config = check_config(config, self.overflow.default_config)
+            self.overflow.start()
+
+    def _stripe(self, secret_id):
+        return self.stripes[hash(secret_id) % len(self.stripes)]
 
     def get_secret(self, secret_id):
-        if not self.secrets.get(secret_id):
-            return False
-        logger.debug(f"Reading memory secret: {self.secrets[secret_id].__dict__}")
-        return self.secrets[secret_id]
+        st = self._stripe(secret_id)
+        with st.lock:
+            r = st.secrets.get(secret_id)
+        if not r:
+            return self.overflow.get_secret(secret_id) if self.overflow else False
+        s = r.to_secret()
+        logger.debug(f"Reading memory secret: {s.id}")
+        return s
 
     def set_secret(self, s):
         if not s.check_id():
             return False
-        self.secrets[s.id] = s
-        logger.debug(f"Saving memory secret: {self.secrets[s.id].__dict__}")
+        r = record(s)
+        st = self._stripe(s.id)
+        self._reserve(r.size)
+        with st.lock:
+            old = st.secrets.get(s.id)
+            st.secrets[s.id] = r
+            st.account(old, r)
+        self._release(old, r)
+        with self.expiry_lock:
+            heapq.heappush(self.expiry, (r.expires_at, s.id))
+        logger.debug(f"Saving memory secret: {s.id}")
         return True
 
     def delete_secret(self, secret_id):
         logger.info(f"Deleting memory secret: {secret_id}")
-        self.secrets.pop(secret_id, None)
+        st = self._stripe(secret_id)
+        with st.lock:
+            r = st.secrets.pop(secret_id, None)
+            st.account(r, None)
+        self._release(r)
+        if self.overflow:
+            self.overflow.delete_secret(secret_id)
         return True
 
+    def get_secret_metadata(self, secret_id):
+        st = self._stripe(secret_id)
+        with st.lock:
+            r = st.secrets.get(secret_id)
+        if not r:
+            if self.overflow:
+                return self.overflow.get_secret_metadata(secret_id)
+            return False
+        s = secret(r.id)
+        s.create_date, s.expire_date = r.create_date, r.expire_date
+        return s
+
+    def secret_exists(self, secret_id):
+        st = self._stripe(secret_id)
+        with st.lock:
+            if secret_id in st.secrets:
+                return True
+        return self.overflow.secret_exists(secret_id) if self.overflow else False
+
+    def list_secret_ids(self):
+        for st in self.stripes:
+            with st.lock:
+                secret_ids = list(st.secrets)
+            yield from secret_ids
+        if self.overflow:
+            yield from self.overflow.list_secret_ids()
+
+    def consume_secret(self, secret_id, verifier):
+        """Check the password, then pop one-time secrets under the stripe lock.
+        The pop only succeeds if the record read is still stored, so only one
+        request receives the secret."""
+        st = self._stripe(secret_id)
+        with st.lock:
+            r = st.secrets.get(secret_id)
+        if not r:
+            if self.overflow:
+                return self.overflow.consume_secret(secret_id, verifier)
+            return False, False
+        s = r.to_secret()
+        if not verifier(s):
+            return s, False
+        if s.is_one_time():
+            with st.lock:
+                if st.secrets.get(secret_id) is not r:
+                    return False, False
+                del st.secrets[secret_id]
+                st.account(r, None)
+            logger.info(f"Deleting memory secret: {secret_id}")
+            self._release(r)
+        return s, True
+
     def delete_expired(self):
-        to_delete = []
-        for secret_id, s in self.secrets.items():
-            if not s or s.is_expired():
-                to_delete.append(secret_id)
-        for secret_id in to_delete:
-            self.delete_secret(secret_id)
+        """Pop due entries off the expiry heap, the cost of a sweep depends on
+        the number of expired secrets and not the number stored"""
+        now = int(time.time())
+        scanned = deleted = 0
+        while True:
+            with self.expiry_lock:
+                if not self.expiry or self.expiry[0][0] > now:
+                    break
+                expires_at, secret_id = heapq.heappop(self.expiry)
+            scanned += 1
+            st = self._stripe(secret_id)
+            with st.lock:
+                r = st.secrets.get(secret_id)
+                if not r or r.expires_at != expires_at:
+                    continue
+                logger.info(f"Deleting memory secret: {secret_id}")
+                del st.secrets[secret_id]
+                st.account(r, None)
+            self._release(r)
+            deleted += 1
+        self._compact_expiry()
+        if self.overflow:
+            overflow = self.overflow.delete_expired()
+            scanned += overflow["scanned"]
+            deleted += overflow["deleted"]
+        return {"scanned": scanned, "deleted": deleted}
+
+    def acquire_cleaner_lease(self, owner, ttl, stats=None):
+        """Secrets are kept per process, so every process cleans its own"""
+        return True
+
+    def stats(self):
+        """Return resident byte and record count gauges, summed over the
+        stripes without locking them"""
+        return {
+            "resident_bytes": sum(st.bytes for st in self.stripes),
+            "record_count": self.record_count(),
+            "max_bytes": self.config.max_bytes,
+        }
+
+    def record_count(self):
+        return sum(st.count for st in self.stripes)
+
+    def _reserve(self, size):
+        """Reserve size bytes of the budget, spilling the oldest multi-use
+        secrets to disk if configured. Raises StoreFullError if the secret
+        does not fit. Victims are picked under the budget lock and written to
+        disk without holding any lock."""
+        if not self.config.max_bytes:
+            return
+        if size > self.config.max_bytes:
+            logger.warning(f"Memory store full: secret of {size} bytes")
+            raise StoreFullError()
+        while True:
+            with self.budget_lock:
+                excess = self.reserved_bytes + size - self.config.max_bytes
+                if excess <= 0:
+                    self.reserved_bytes += size
+                    return
+                if not self.overflow or not self.spillable:
+                    logger.warning(
+                        f"Memory store full: {self.reserved_bytes} bytes resident"
+                    )
+                    raise StoreFullError()
+                victims = []
+                while self.spillable and excess > 0:
+                    secret_id, victim_size = self.spillable.popitem(last=False)
+                    victims.append(secret_id)
+                    excess -= victim_size
+            for secret_id in victims:
+                self._spill(secret_id)
+
+    def _spill(self, secret_id):
+        """Write a secret to the overflow store, then remove it from memory if
+        it hasn't changed meanwhile"""
+        st = self._stripe(secret_id)
+        with st.lock:
+            r = st.secrets.get(secret_id)
+        if not r:
+            return
+        try:
+            self.overflow.set_secret(r.to_secret())
+        except Exception:
+            # still in memory, so it can be picked again
+            with self.budget_lock:
+                self.spillable[secret_id] = r.size
+            raise
+        with st.lock:
+            spilled = st.secrets.get(secret_id) is r
+            if spilled:
+                del st.secrets[secret_id]
+                st.account(r, None)
+        if not spilled:
+            # replaced or deleted while it was written, the copy is stale
+            self.overflow.delete_secret(secret_id)
+            return
+        logger.info(f"Spilled memory secret to disk: {secret_id}")
+        with self.budget_lock:
+            self.reserved_bytes -= r.size
+
+    def _release(self, old, new=None):
+        """Return the budget of a replaced or removed record and track a new
+        multi-use record for spilling. The new record's size is already
+        reserved."""
+        if not self.config.max_bytes or not (old or new):
+            return
+        with self.budget_lock:
+            if old:
+                self.reserved_bytes -= old.size
+                self.spillable.pop(old.id, None)
+            if new and new.expire_date != -1:
+                self.spillable[new.id] = new.size
+
+    def _compact_expiry(self):
+        """Rebuild the heap once it is mostly entries for deleted secrets"""
+        if len(self.expiry) <= self.record_count() * 2 + 1024:
+            return
+        with self.expiry_lock:
+            entries = []
+            for st in self.stripes:
+                with st.lock:
+                    entries += [(r.expires_at, r.id) for r in st.secrets.values()]
+            heapq.heapify(entries)
+            self.expiry = entries
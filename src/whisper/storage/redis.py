@@ -0,0 +1,172 @@
+import argparse
+import logging
+
+from redis import ConnectionPool, Redis
+from whisper import check_config, secret, serialization
+from whisper.storage import store_backend
+
+logger = logging.getLogger(__name__)
+
+# Delete a key only if it still holds the value that was read. The value is
+# matched by its length and its first bytes, which hold the header with the
+# secret's dates and salted password hash, so a secret's data isn't sent back
+# to the server.
+DELETE_IF_UNCHANGED = """
+local key = KEYS[1]
+if redis.call("STRLEN", key) == tonumber(ARGV[1])
+    and redis.call("GETRANGE", key, 0, #ARGV[2] - 1) == ARGV[2] then
+    return redis.call("DEL", key)
+end
+return 0
+"""
+COMPARE_BYTES = 512
+
+
+class redis(store_backend):
+    """Redis store. Secrets are string keys with a native expiry set from the
+    expiration date when they are written, so Redis removes expired secrets and
+    no cleaner is run. Works with any Redis protocol server, and the client can
+    be swapped for a fakeredis client in tests."""
+
+    native_expiry = True
+
+    def __init__(self, name="redis", parent=None):
+        self.default_config = {
+            "url": "redis://localhost:6379/0",
+            "key_prefix": "whisper:",
+            "max_connections": 16,
+            "socket_timeout": 5,
+        }
+        super().__init__(name, parent)
+
+    def start(self):
+        self.pool = ConnectionPool.from_url(
+            self.config.url,
+            max_connections=self.config.max_connections,
+            socket_timeout=self.config.socket_timeout,
+        )
+        self.client = Redis(connection_pool=self.pool)
+        self.client.ping()
+        # run with EVALSHA, the script is loaded again if the server lost it
+        self.delete_script = self.client.register_script(DELETE_IF_UNCHANGED)
+        logger.info(f"Connected to Redis store: {self.pool}")
+
+    def _keys(self, secret_id):
+        """Key for a multi-use and a one-time secret, one-time secrets are kept
+        under their own key so a consume never deletes a multi-use secret"""
+        return (
+            f"{self.config.key_prefix}{secret_id}",
+            f"{self.config.key_prefix}once:{secret_id}",
+        )
+
+    def _from_value(self, secret_id, value):
+        if value is None:
+            return False
+        s = serialization.loads(value)
+        if not s or s.id != secret_id:
+            return False
+        return s
+
+    def get_secret(self, secret_id):
+        s = secret(secret_id)
+        if not s.check_id():
+            return False
+        logger.debug(f"Reading Redis secret: {s.id}")
+        multi, once = self.client.mget(self._keys(s.id))
+        return self._from_value(s.id, multi or once)
+
+    def secret_exists(self, secret_id):
+        if not secret(secret_id).check_id():
+            return False
+        return bool(self.client.exists(*self._keys(secret_id)))
+
+    def list_secret_ids(self):
+        prefix = self.config.key_prefix.encode("utf-8")
+        for key in self.client.scan_iter(match=prefix + b"*", count=1000):
+            yield key[len(prefix) :].decode("utf-8").removeprefix("once:")
+
+    def set_secret(self, s):
+        if not s.check_id():
+            return False
+        logger.debug(f"Saving Redis secret: {s.id}")
+        multi, once = self._keys(s.id)
+        self.client.set(
+            once if s.is_one_time() else multi,
+            serialization.dumps(s),
+            exat=s.expires_at(),
+        )
+        return True
+
+    def delete_secret(self, secret_id):
+        logger.info(f"Deleting Redis secret: {secret_id}")
+        self.client.delete(*self._keys(secret_id))
+        return True
+
+    def delete_expired(self):
+        logger.debug("Redis expires secrets itself, nothing to clean")
+
+    def consume_secret(self, secret_id, verifier):
+        """Read the secret and check it, then delete a one-time secret with a
+        server side compare and delete, in two round trips. Only one request
+        can delete it, so only one request can ever receive it, and the secret
+        stays readable while its password is checked."""
+        s = secret(secret_id)
+        if not s.check_id():
+            return False, False
+        multi, once = self._keys(s.id)
+        multi_value, once_value = self.client.mget(multi, once)
+        if multi_value is not None:
+            s = self._from_value(s.id, multi_value)
+            return s, verifier(s)
+        s = self._from_value(s.id, once_value)
+        if not s:
+            return False, False
+        if not verifier(s):
+            return s, False
+        # the secret was consumed or deleted since it was read
+        if not self._delete_if_unchanged(once, once_value):
+            return False, False
+        logger.info(f"Deleting Redis secret: {s.id}")
+        return s, True
+
+    def _delete_if_unchanged(self, key, value):
+        """Delete key if it still holds value, returning whether it did"""
+        args = [len(value), value[:COMPARE_BYTES]]
+        return self.delete_script(keys=[key], args=args) == 1
+
+    def migrate_format(self):
+        """Rewrite secrets stored as JSON in the binary format, keeping their
+        expiry. Writes only replace keys that still exist, so a secret consumed
+        meanwhile is not brought back."""
+        logger.info("Migrating Redis secrets to binary format")
+        count = 0
+        for key in self.client.scan_iter(match=f"{self.config.key_prefix}*"):
+            value = self.client.get(key)
+            if value is None or serialization.is_binary(value):
+                continue
+            s = serialization.loads(value)
+            if not s:
+                continue
+            if self.client.set(key, serialization.dumps(s), xx=True, keepttl=True):
+                count += 1
+        logger.info(f"Migrated {count} Redis secrets to binary format")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Redis store maintenance")
+    parser.add_argument("command", choices=["migrate-format"])
+    parser.add_argument("--url", default="redis://localhost:6379/0", help="Redis URL")
+    parser.add_argument("--key-prefix", default="whisper:", help="key prefix")
+    args = parser.parse_args()
+
+    backend = redis()
+    config = {**backend.default_config, "url": args.url, "key_prefix": args.key_prefix}
+    backend.config = check_config(config, backend.default_config)
+    backend.start()
+    if args.command == "migrate-format":
+        backend.migrate_format()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,357 @@
+import fcntl
+import glob
+import logging
+import os
+import struct
+import threading
+import time
+
+from whisper import ConfigError, secret
+from whisper.storage import store_backend
+
+logger = logging.getLogger(__name__)
+
+# magic, type, id, create_date, expire_date, expires_at, hash length, data length
+RECORD = struct.Struct("<4sB40sqqqHI")
+RECORD_MAGIC = b"WREC"
+# type, id, offset, length, expires_at
+FOOTER_ENTRY = struct.Struct("<B40sQIq")
+# magic, footer offset, entry count
+TRAILER = struct.Struct("<4sQI")
+TRAILER_MAGIC = b"WFTR"
+PUT, TOMBSTONE = 1, 2
+
+
+class segment_file:
+    """One append-only segment of the log and its accounting"""
+
+    def __init__(self, path, number):
+        self.number = number
+        self.filename = os.path.join(path, f"segment-{number:08d}.log")
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600)
+        self.size = 0
+        self.live = 0
+        self.max_expires_at = 0
+        self.sealed = False
+        # (type, id, offset, length, expires_at) of every record, in order
+        self.entries = []
+        # id: expires_at of deleted secrets
+        self.tombstones = {}
+
+    def append(self, record_type, secret_id, record, expires_at):
+        offset = self.size
+        os.pwrite(self.fd, record, offset)
+        self.size += len(record)
+        self.entries.append((record_type, secret_id, offset, len(record), expires_at))
+        self.max_expires_at = max(self.max_expires_at, expires_at)
+        return offset
+
+    def read(self, offset, length):
+        return os.pread(self.fd, length, offset)
+
+    def seal(self):
+        """Write the footer listing every record, so the index can be rebuilt
+        without reading the records themselves"""
+        footer = b"".join(
+            FOOTER_ENTRY.pack(t, i.encode("utf-8"), o, n, e)
+            for t, i, o, n, e in self.entries
+        )
+        footer += TRAILER.pack(TRAILER_MAGIC, self.size, len(self.entries))
+        os.pwrite(self.fd, footer, self.size)
+        os.fsync(self.fd)
+        self.sealed = True
+
+    def load(self):
+        """Read the record entries from the footer, or by scanning the records
+        if the segment was never sealed"""
+        file_size = os.fstat(self.fd).st_size
+        if file_size >= TRAILER.size:
+            magic, footer_offset, count = TRAILER.unpack(
+                self.read(file_size - TRAILER.size, TRAILER.size)
+            )
+            if magic == TRAILER_MAGIC:
+                footer = self.read(footer_offset, count * FOOTER_ENTRY.size)
+                for t, i, o, n, e in FOOTER_ENTRY.iter_unpack(footer):
+                    self.entries.append((t, i.decode("utf-8"), o, n, e))
+                self.size = footer_offset
+                self.sealed = True
+                return
+        offset = 0
+        while offset + RECORD.size <= file_size:
+            magic, t, i, _, _, e, hash_len, data_len = RECORD.unpack(
+                self.read(offset, RECORD.size)
+            )
+            length = RECORD.size + hash_len + data_len
+            if magic != RECORD_MAGIC or offset + length > file_size:
+                break
+            self.entries.append((t, i.decode("utf-8"), offset, length, e))
+            offset += length
+        # drop any partially written record at the end
+        os.ftruncate(self.fd, offset)
+        self.size = offset
+
+    def remove(self):
+        os.close(self.fd)
+        os.remove(self.filename)
+
+
+class segment(store_backend):
+    """Log structured store. Secrets are appended to rolling segment files and
+    found through an in-memory index, deletes are appended as tombstones, and
+    a background compactor rewrites segments that are mostly dead records."""
+
+    def __init__(self, name="segment", parent=None):
+        self.default_config = {
+            "path": "/tmp/whisper-segments",
+            "segment_size": 67108864,
+            "compact_ratio": 0.5,
+            "compact_interval": 60,
+        }
+        super().__init__(name, parent)
+
+    def start(self):
+        os.makedirs(self.config.path, exist_ok=True)
+        # the index lives in this process, so only one process may use the log
+        self.lock_fd = os.open(
+            os.path.join(self.config.path, "LOCK"), os.O_RDWR | os.O_CREAT, 0o600
+        )
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise ConfigError(
+                self.config.path, "Segment store is in use by another process"
+            )
+        self.lock = threading.RLock()
+        # id: (segment number, offset, length, expires_at)
+        self.index = {}
+        self.segments = {}
+        self.load()
+        self.compactor = threading.Thread(
+            name="segment_compactor", target=self.run_compactor, daemon=True
+        )
+        self.compactor.start()
+
+    def load(self):
+        """Rebuild the index from segment footers, oldest segment first"""
+        start = time.time()
+        now = int(start)
+        filenames = sorted(glob.glob(os.path.join(self.config.path, "segment-*.log")))
+        for filename in filenames:
+            number = int(os.path.basename(filename)[8:-4])
+            seg = self.segments[number] = segment_file(self.config.path, number)
+            seg.load()
+            for t, secret_id, offset, length, expires_at in seg.entries:
+                seg.max_expires_at = max(seg.max_expires_at, expires_at)
+                if t == TOMBSTONE:
+                    self._unindex(secret_id)
+                    if expires_at > now:
+                        seg.tombstones[secret_id] = expires_at
+                elif expires_at > now:
+                    self._index(secret_id, number, offset, length, expires_at)
+            if not seg.sealed:
+                seg.seal()
+        self.active = self._new_segment()
+        logger.info(
+            f"Loaded {len(self.index)} secrets from {len(filenames)} segments "
+            f"in {time.time() - start:.3f}s"
+        )
+
+    def get_secret(self, secret_id):
+        s = secret(secret_id)
+        if not s.check_id():
+            return False
+        s, _ = self._read(s)
+        return s
+
+    def get_secret_metadata(self, secret_id):
+        """Read only the record header for the secret dates"""
+        s = secret(secret_id)
+        if not s.check_id():
+            return False
+        with self.lock:
+            position = self.index.get(s.id)
+            if not position:
+                return False
+            number, offset, _, _ = position
+            header = self.segments[number].read(offset, RECORD.size)
+        s.create_date, s.expire_date = RECORD.unpack(header)[3:5]
+        return s
+
+    def secret_exists(self, secret_id):
+        with self.lock:
+            return secret_id in self.index
+
+    def list_secret_ids(self):
+        with self.lock:
+            return list(self.index)
+
+    def _read(self, s):
+        """Fill in a secret from its record, returns it with the index
+        position it was read from"""
+        with self.lock:
+            position = self.index.get(s.id)
+            if not position:
+                return False, None
+            number, offset, length, _ = position
+            record = self.segments[number].read(offset, length)
+        _, _, _, create, expire, _, hash_len, _ = RECORD.unpack_from(record)
+        s.create_date, s.expire_date = create, expire
+        s.hash = record[RECORD.size : RECORD.size + hash_len].decode("utf-8")
+        s.data = record[RECORD.size + hash_len :].decode("utf-8")
+        logger.debug(f"Reading segment secret: {s.id}")
+        return s, position
+
+    def set_secret(self, s):
+        if not s.check_id():
+            return False
+        hashed = s.hash.encode("utf-8")
+        data = s.data.encode("utf-8")
+        expires_at = s.expires_at()
+        record = (
+            RECORD.pack(
+                RECORD_MAGIC,
+                PUT,
+                s.id.encode("utf-8"),
+                s.create_date,
+                s.expire_date,
+                expires_at,
+                len(hashed),
+                len(data),
+            )
+            + hashed
+            + data
+        )
+        with self.lock:
+            self._append(PUT, s.id, record, expires_at)
+        logger.debug(f"Saving segment secret: {s.id}")
+        return True
+
+    def delete_secret(self, secret_id):
+        logger.info(f"Deleting segment secret: {secret_id}")
+        with self.lock:
+            position = self.index.get(secret_id)
+            if position:
+                self._tombstone(secret_id, position[3])
+        return True
+
+    def consume_secret(self, secret_id, verifier):
+        """Check the password, then write the tombstone for one-time secrets
+        only if the record read is still the indexed one, so only one request
+        receives the secret"""
+        s = secret(secret_id)
+        if not s.check_id():
+            return False, False
+        s, position = self._read(s)
+        if not s:
+            return False, False
+        if not verifier(s):
+            return s, False
+        if s.is_one_time():
+            with self.lock:
+                if self.index.get(s.id) != position:
+                    return False, False
+                self._tombstone(s.id, position[3])
+            logger.info(f"Deleting segment secret: {s.id}")
+        return s, True
+
+    def delete_expired(self):
+        """Drop expired secrets from the index. Their records are reclaimed
+        when the compactor rewrites or drops their segments."""
+        now = int(time.time())
+        with self.lock:
+            scanned = len(self.index)
+            expired = [i for i, p in self.index.items() if p[3] <= now]
+            for secret_id in expired:
+                self._unindex(secret_id)
+        logger.info(f"Expired {len(expired)} segment secrets")
+        return {"scanned": scanned, "deleted": len(expired)}
+
+    def stats(self):
+        """Return indexed secret, segment and log size gauges"""
+        with self.lock:
+            return {
+                "record_count": len(self.index),
+                "segments": len(self.segments),
+                "log_bytes": sum(seg.size for seg in self.segments.values()),
+            }
+
+    @property
+    def cleaner_lock_path(self):
+        return os.path.join(self.config.path, "CLEANER.lock")
+
+    def run_compactor(self):
+        while True:
+            time.sleep(self.config.compact_interval)
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Segment compaction failed: {e}")
+
+    def compact(self):
+        """Drop sealed segments whose records have all expired or been deleted
+        and rewrite those whose live ratio is below compact_ratio into the
+        active segment"""
+        now = int(time.time())
+        for number in sorted(self.segments):
+            with self.lock:
+                seg = self.segments[number]
+                if seg is self.active:
+                    continue
+                if seg.max_expires_at <= now:
+                    for secret_id in [
+                        i for i, p in self.index.items() if p[0] == number
+                    ]:
+                        self._unindex(secret_id)
+                tombstones = {i: e for i, e in seg.tombstones.items() if e > now}
+                if seg.live or tombstones:
+                    if seg.size and seg.live / seg.size >= self.config.compact_ratio:
+                        continue
+                    self._rewrite(seg, tombstones)
+                del self.segments[number]
+                seg.remove()
+                logger.info(f"Compacted segment {number}")
+
+    def _rewrite(self, seg, tombstones):
+        """Copy live records and unexpired tombstones into the active segment"""
+        live = [(i, p) for i, p in self.index.items() if p[0] == seg.number]
+        for secret_id, (_, offset, length, expires_at) in live:
+            self._append(PUT, secret_id, seg.read(offset, length), expires_at)
+        for secret_id, expires_at in tombstones.items():
+            self._tombstone(secret_id, expires_at)
+
+    def _tombstone(self, secret_id, expires_at):
+        """Append a tombstone for a deleted secret. It carries the expiry date
+        of the secret, as it can be dropped once the secret would have expired
+        anyway. Must hold the lock."""
+        record = RECORD.pack(
+            RECORD_MAGIC, TOMBSTONE, secret_id.encode("utf-8"), 0, 0, expires_at, 0, 0
+        )
+        self._append(TOMBSTONE, secret_id, record, expires_at)
+
+    def _append(self, record_type, secret_id, record, expires_at):
+        """Append a record to the active segment and update the index, rolling
+        to a new segment when the active one is full. Must hold the lock."""
+        offset = self.active.append(record_type, secret_id, record, expires_at)
+        if record_type == TOMBSTONE:
+            self._unindex(secret_id)
+            self.active.tombstones[secret_id] = expires_at
+        else:
+            self._index(secret_id, self.active.number, offset, len(record), expires_at)
+        if self.active.size >= self.config.segment_size:
+            self.active.seal()
+            self.active = self._new_segment()
+
+    def _new_segment(self):
+        number = max(self.segments, default=0) + 1
+        seg = self.segments[number] = segment_file(self.config.path, number)
+        return seg
+
+    def _index(self, secret_id, number, offset, length, expires_at):
+        self._unindex(secret_id)
+        self.index[secret_id] = (number, offset, length, expires_at)
+        self.segments[number].live += length
+
+    def _unindex(self, secret_id):
+        position = self.index.pop(secret_id, None)
+        if position:
+            self.segments[position[0]].live -= position[2]
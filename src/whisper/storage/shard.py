@@ -0,0 +1,242 @@
+import bisect
+import hashlib
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from whisper import ConfigError, check_config, class_loader, secret
+from whisper.storage import store_backend
+
+logger = logging.getLogger(__name__)
+
+
+class shard(store_backend):
+    """Sharded store. Secrets are spread over several backend stores, such as
+    S3 stores with different buckets or paths, by consistent hashing of the
+    random secret ID, so each shard takes an even share of reads, writes and
+    cleaning. When a shard is added only the secrets now mapped to it move,
+    and until they have been moved by the rebalancer they are still found on
+    the shard which held them before."""
+
+    def __init__(self, name="shard", parent=None):
+        self.default_config = {
+            "shards": [],
+            "vnodes": 64,
+            "fallback_reads": 1,
+            "clean_workers": 0,
+            "rebalance_interval": 3600,
+        }
+        self.shard_default_config = {
+            "name": None,
+            "storage_class": None,
+            "storage_config": {},
+        }
+        super().__init__(name, parent)
+
+    def start(self):
+        if not self.config.shards:
+            raise ConfigError("shards", "At least one shard must be configured")
+        self.shards = {}
+        for shard_config in self.config.shards:
+            shard_config = check_config(
+                {**self.shard_default_config, **shard_config},
+                self.shard_default_config,
+            )
+            if shard_config.name in self.shards:
+                raise ConfigError(shard_config.name, "Duplicate shard name")
+            backend = class_loader(
+                shard_config.storage_class, shard_config.name, parent=self
+            )
+            config = {**backend.default_config, **shard_config.storage_config}
+            backend.config = check_config(config, backend.default_config)
+            backend.start()
+            self.shards[shard_config.name] = backend
+        # each shard owns the IDs from each of its points up to the next point
+        # on the ring
+        points = []
+        for shard_name in self.shards:
+            for i in range(self.config.vnodes):
+                digest = hashlib.blake2b(
+                    f"{shard_name}:{i}".encode("utf-8"), digest_size=8
+                ).digest()
+                points.append((int.from_bytes(digest, "big"), shard_name))
+        points.sort()
+        self.ring = [p for p, _ in points]
+        self.ring_shards = [s for _, s in points]
+        self.native_expiry = all(b.native_expiry for b in self.shards.values())
+        self.last_rebalance = time.time()
+        logger.info(
+            f"Sharded store: {len(self.shards)} shards, {len(self.ring)} ring points"
+        )
+
+    def _owners(self, secret_id):
+        """Return the shard which owns a secret, followed by the shards which
+        owned it before the shards before them on the ring were added, up to
+        fallback_reads of them"""
+        # IDs are random hex, so their leading digits are already uniform
+        position = int(secret_id[:16], 16)
+        index = bisect.bisect_left(self.ring, position) % len(self.ring)
+        owners = []
+        for i in range(len(self.ring)):
+            shard_name = self.ring_shards[(index + i) % len(self.ring)]
+            if shard_name not in owners:
+                owners.append(shard_name)
+                if len(owners) > self.config.fallback_reads:
+                    break
+        return [self.shards[shard_name] for shard_name in owners]
+
+    def _owner(self, secret_id):
+        return self._owners(secret_id)[0]
+
+    def _valid(self, secret_id):
+        return secret(secret_id).check_id()
+
+    def get_secret(self, secret_id):
+        if not self._valid(secret_id):
+            return False
+        for backend in self._owners(secret_id):
+            s = backend.get_secret(secret_id)
+            if s:
+                return s
+        return False
+
+    def set_secret(self, s):
+        if not s.check_id():
+            return False
+        return self._owner(s.id).set_secret(s)
+
+    def set_secret_stream(self, s, stream):
+        if not s.check_id():
+            return False
+        return self._owner(s.id).set_secret_stream(s, stream)
+
+    def delete_secret(self, secret_id):
+        """Delete the secret from every shard it may be on"""
+        if not self._valid(secret_id):
+            return False
+        for backend in self._owners(secret_id):
+            backend.delete_secret(secret_id)
+        return True
+
+    def get_secret_metadata(self, secret_id):
+        if not self._valid(secret_id):
+            return False
+        for backend in self._owners(secret_id):
+            s = backend.get_secret_metadata(secret_id)
+            if s:
+                return s
+        return False
+
+    def secret_exists(self, secret_id):
+        if not self._valid(secret_id):
+            return False
+        return any(b.secret_exists(secret_id) for b in self._owners(secret_id))
+
+    def consume_secret(self, secret_id, verifier):
+        if not self._valid(secret_id):
+            return False, False
+        for backend in self._owners(secret_id):
+            s, valid = backend.consume_secret(secret_id, verifier)
+            if s:
+                return s, valid
+        return False, False
+
+    def consume_secret_stream(self, secret_id, verifier):
+        if not self._valid(secret_id):
+            return False, False, None
+        for backend in self._owners(secret_id):
+            s, valid, chunks = backend.consume_secret_stream(secret_id, verifier)
+            if s:
+                return s, valid, chunks
+        return False, False, None
+
+    def list_secret_ids(self):
+        """Chain the IDs of every shard, or None if any shard can't list its
+        secrets"""
+        shard_ids = [backend.list_secret_ids() for backend in self.shards.values()]
+        if any(ids is None for ids in shard_ids):
+            return None
+        return itertools.chain.from_iterable(shard_ids)
+
+    def delete_expired(self):
+        """Clean every shard in parallel, then move secrets to the shards
+        which now own them if rebalance_interval has passed"""
+        rebalance = (
+            self.config.rebalance_interval
+            and time.time() - self.last_rebalance >= self.config.rebalance_interval
+        )
+        if rebalance:
+            self.last_rebalance = time.time()
+        workers = self.config.clean_workers or len(self.shards)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(
+                pool.map(lambda n: self._clean_shard(n, rebalance), self.shards)
+            )
+        scanned = sum(r["scanned"] for r in results)
+        deleted = sum(r["deleted"] for r in results)
+        return {"scanned": scanned, "deleted": deleted}
+
+    def _clean_shard(self, shard_name, rebalance):
+        backend = self.shards[shard_name]
+        result = {"scanned": 0, "deleted": 0}
+        start = time.time()
+        try:
+            if not backend.native_expiry:
+                result = backend.delete_expired() or result
+            if rebalance:
+                self.rebalance(shard_name)
+        except Exception as e:
+            logger.error(f"Shard {shard_name} - Clean failed: {e}")
+        logger.info(f"Shard {shard_name} - Cleaned in {time.time() - start:.2f}s")
+        return result
+
+    def rebalance(self, shard_name):
+        """Move secrets stored on a shard which no longer owns them to their
+        owner. One-time secrets are claimed with an atomic consume before they
+        are written to their owner, so a reader can never receive one from
+        both shards."""
+        backend = self.shards[shard_name]
+        ids = backend.list_secret_ids()
+        if ids is None:
+            logger.warning(f"Shard {shard_name} - Can't list secrets to rebalance")
+            return
+        moved = 0
+        for secret_id in list(ids):
+            owner = self._owner(secret_id)
+            if owner is backend:
+                continue
+            s = backend.get_secret(secret_id)
+            if not s or s.is_expired():
+                continue
+            if s.is_one_time():
+                s, _ = backend.consume_secret(secret_id, lambda s: True)
+                if not s:
+                    continue
+                try:
+                    owner.set_secret(s)
+                except Exception:
+                    backend.set_secret(s)
+                    raise
+            else:
+                owner.set_secret(s)
+                backend.delete_secret(secret_id)
+            moved += 1
+        if moved:
+            logger.info(f"Shard {shard_name} - Moved {moved} secrets to their owners")
+
+    def acquire_cleaner_lease(self, owner, ttl, stats=None):
+        """The lease is held in the first configured shard"""
+        return next(iter(self.shards.values())).acquire_cleaner_lease(owner, ttl, stats)
+
+    def stats(self):
+        """Return the totals of the shards' gauges, or for hedged read delays
+        and rates the highest of them"""
+        totals = {}
+        for backend in self.shards.values():
+            for key, value in backend.stats().items():
+                if key.startswith("hedge_"):
+                    totals[key] = max(totals.get(key, 0), value)
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        return totals
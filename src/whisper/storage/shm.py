@@ -0,0 +1,307 @@
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from whisper import ConfigError, secret
+from whisper.storage import StoreFullError, store_backend
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"WSHM0002"
+# magic, capacity, slot_size
+HEADER = struct.Struct("<8sQQ")
+HEADER_SIZE = 64
+# room for the longest hash string of every hasher, scrypt and argon2id hashes
+# run to about 140 bytes with large parameters
+HASH_SIZE = 256
+# used, id, create_date, expire_date, expires_at, hash length, hash, data
+# length, data slot
+ENTRY = struct.Struct(f"<B40sqqqH{HASH_SIZE}sII")
+EMPTY, USED = 0, 1
+
+
+class shm(store_backend):
+    """Shared memory store. Secrets are kept in a memory mapped file, normally
+    in /dev/shm, so that every worker process on the host shares the same
+    secrets. The file holds an open addressing hash table of fixed size entries
+    keyed by secret ID, a slot map, and a fixed size data slot per secret."""
+
+    def __init__(self, name="shm", parent=None):
+        self.default_config = {
+            "path": "/dev/shm/whisper.store",
+            "capacity": 1024,
+            "slot_size": 1048576,
+        }
+        super().__init__(name, parent)
+
+    def start(self):
+        if secret.hasher.hash_length() > HASH_SIZE:
+            raise ConfigError(
+                "hash_config",
+                f"{secret.hasher} hashes do not fit in the {HASH_SIZE} bytes "
+                f"kept per shared memory secret",
+            )
+        self.lock = threading.Lock()
+        self.fd = os.open(self.config.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            self._init_file()
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.mm = mmap.mmap(self.fd, 0)
+        self.entries_offset = HEADER_SIZE
+        self.slot_map_offset = self.entries_offset + self.capacity * ENTRY.size
+        self.data_offset = self.slot_map_offset + self.capacity
+        logger.info(
+            f"Shared memory store {self.config.path}: {self.capacity} slots "
+            f"of {self.slot_size} bytes"
+        )
+
+    def _init_file(self):
+        """Create and size the store file if it is new, otherwise use the
+        geometry of the existing file"""
+        header = os.pread(self.fd, HEADER.size, 0)
+        if len(header) == HEADER.size and header[:8] == MAGIC:
+            _, self.capacity, self.slot_size = HEADER.unpack(header)
+            if (self.capacity, self.slot_size) != (
+                self.config.capacity,
+                self.config.slot_size,
+            ):
+                logger.warning(
+                    f"Using existing shared memory store geometry: "
+                    f"{self.capacity} slots of {self.slot_size} bytes"
+                )
+            return
+        if header[:4] == MAGIC[:4]:
+            logger.warning(
+                f"Replacing shared memory store {self.config.path} made with an "
+                f"older entry layout"
+            )
+        self.capacity, self.slot_size = self.config.capacity, self.config.slot_size
+        size = HEADER_SIZE + self.capacity * (ENTRY.size + 1 + self.slot_size)
+        fs = os.statvfs(os.path.dirname(self.config.path))
+        if size > fs.f_bavail * fs.f_frsize:
+            raise ConfigError(
+                self.config.path,
+                f"Not enough space for a {size} byte shared memory store",
+            )
+        # start from zeros, an older layout's entries would read as garbage
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.fd, size)
+        os.pwrite(self.fd, HEADER.pack(MAGIC, self.capacity, self.slot_size), 0)
+
+    def _locked(self, operation):
+        """Hold the in-process lock and a cross-process file lock"""
+        return _file_lock(self.lock, self.fd, operation)
+
+    def _home(self, secret_id):
+        digest = hashlib.blake2b(secret_id.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % self.capacity
+
+    def _entry_offset(self, index):
+        return self.entries_offset + index * ENTRY.size
+
+    def _read_entry(self, index):
+        return ENTRY.unpack_from(self.mm, self._entry_offset(index))
+
+    def _find(self, secret_id):
+        """Return the table index holding secret_id, or None"""
+        key = secret_id.encode("utf-8")
+        index = self._home(secret_id)
+        for _ in range(self.capacity):
+            used, entry_id = struct.unpack_from(
+                "<B40s", self.mm, self._entry_offset(index)
+            )
+            if used == EMPTY:
+                return None
+            if entry_id == key:
+                return index
+            index = (index + 1) % self.capacity
+        return None
+
+    def get_secret(self, secret_id):
+        s = secret(secret_id)
+        if not s.check_id():
+            return False
+        with self._locked(fcntl.LOCK_SH):
+            index = self._find(secret_id)
+            if index is None:
+                return False
+            _, _, create, expire, _, hash_len, hashed, data_len, slot = (
+                self._read_entry(index)
+            )
+            start = self.data_offset + slot * self.slot_size
+            # decode straight from the mapping, the only copy made is the
+            # string returned to the caller
+            with memoryview(self.mm) as view:
+                data = str(view[start : start + data_len], "utf-8")
+        s.create_date, s.expire_date = create, expire
+        s.hash = hashed[:hash_len].decode("utf-8")
+        s.data = data
+        logger.debug(f"Reading shared memory secret: {s.id}")
+        return s
+
+    def set_secret(self, s):
+        if not s.check_id():
+            return False
+        data = s.data.encode("utf-8")
+        hashed = s.hash.encode("utf-8")
+        if len(data) > self.slot_size or len(hashed) > HASH_SIZE:
+            raise StoreFullError("Secret is larger than a shared memory slot")
+        with self._locked(fcntl.LOCK_EX):
+            index = self._find(s.id)
+            if index is None:
+                index = self._free_index(s.id)
+                slot = self._free_slot()
+            else:
+                slot = self._read_entry(index)[-1]
+            start = self.data_offset + slot * self.slot_size
+            self.mm[start : start + len(data)] = data
+            self.mm[self.slot_map_offset + slot] = USED
+            ENTRY.pack_into(
+                self.mm,
+                self._entry_offset(index),
+                USED,
+                s.id.encode("utf-8"),
+                s.create_date,
+                s.expire_date,
+                s.expires_at(),
+                len(hashed),
+                hashed,
+                len(data),
+                slot,
+            )
+        logger.debug(f"Saving shared memory secret: {s.id}")
+        return True
+
+    def delete_secret(self, secret_id):
+        logger.info(f"Deleting shared memory secret: {secret_id}")
+        with self._locked(fcntl.LOCK_EX):
+            index = self._find(secret_id)
+            if index is not None:
+                self._remove(index)
+        return True
+
+    def get_secret_metadata(self, secret_id):
+        s = secret(secret_id)
+        if not s.check_id():
+            return False
+        with self._locked(fcntl.LOCK_SH):
+            index = self._find(secret_id)
+            if index is None:
+                return False
+            s.create_date, s.expire_date = self._read_entry(index)[2:4]
+        return s
+
+    def secret_exists(self, secret_id):
+        return bool(self.get_secret_metadata(secret_id))
+
+    def list_secret_ids(self):
+        secret_ids = []
+        with self._locked(fcntl.LOCK_SH):
+            for index in range(self.capacity):
+                used, entry_id = struct.unpack_from(
+                    "<B40s", self.mm, self._entry_offset(index)
+                )
+                if used == USED:
+                    secret_ids.append(entry_id.decode("utf-8"))
+        return secret_ids
+
+    def consume_secret(self, secret_id, verifier):
+        """Check the password, then remove one-time secrets under the exclusive
+        lock if the entry read is still stored, so only one request across all
+        processes receives the secret"""
+        s = self.get_secret(secret_id)
+        if not s:
+            return False, False
+        if not verifier(s):
+            return s, False
+        if s.is_one_time():
+            with self._locked(fcntl.LOCK_EX):
+                index = self._find(secret_id)
+                if index is None or self._read_entry(index)[2] != s.create_date:
+                    return False, False
+                self._remove(index)
+            logger.info(f"Deleting shared memory secret: {secret_id}")
+        return s, True
+
+    def delete_expired(self):
+        now = int(time.time())
+        scanned = deleted = 0
+        with self._locked(fcntl.LOCK_EX):
+            index = 0
+            while index < self.capacity:
+                used, entry_id, _, _, expires_at = struct.unpack_from(
+                    "<B40sqqq", self.mm, self._entry_offset(index)
+                )
+                # removing shifts a later entry into this index, so check it
+                # again before moving on
+                if used == USED and expires_at <= now:
+                    logger.info(f"Deleting shared memory secret: {entry_id.decode()}")
+                    self._remove(index)
+                    deleted += 1
+                    continue
+                scanned += used == USED
+                index += 1
+        return {"scanned": scanned + deleted, "deleted": deleted}
+
+    @property
+    def cleaner_lock_path(self):
+        return f"{self.config.path}.cleaner.lock"
+
+    def _free_index(self, secret_id):
+        index = self._home(secret_id)
+        for _ in range(self.capacity):
+            if self.mm[self._entry_offset(index)] == EMPTY:
+                return index
+            index = (index + 1) % self.capacity
+        raise StoreFullError("Shared memory store is full")
+
+    def _free_slot(self):
+        slot = self.mm.find(b"\x00", self.slot_map_offset, self.data_offset)
+        if slot < 0:
+            raise StoreFullError("Shared memory store is full")
+        return slot - self.slot_map_offset
+
+    def _remove(self, index):
+        """Free an entry and its data slot, then shift later entries of the
+        same probe run back so lookups never need tombstones"""
+        slot = self._read_entry(index)[-1]
+        self.mm[self.slot_map_offset + slot] = EMPTY
+        hole = index
+        index = (index + 1) % self.capacity
+        while self.mm[self._entry_offset(index)] != EMPTY:
+            entry_id = self._read_entry(index)[1].decode("utf-8")
+            home = self._home(entry_id)
+            # move the entry into the hole unless its home lies cyclically
+            # after the hole, within (hole, index]
+            if (hole < index and not hole < home <= index) or (
+                hole > index and index < home <= hole
+            ):
+                start = self._entry_offset(index)
+                self.mm[
+                    self._entry_offset(hole) : self._entry_offset(hole) + ENTRY.size
+                ] = self.mm[start : start + ENTRY.size]
+                hole = index
+            index = (index + 1) % self.capacity
+        self.mm[self._entry_offset(hole)] = EMPTY
+
+
+class _file_lock:
+    def __init__(self, lock, fd, operation):
+        self.lock = lock
+        self.fd = fd
+        self.operation = operation
+
+    def __enter__(self):
+        self.lock.acquire()
+        fcntl.flock(self.fd, self.operation)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
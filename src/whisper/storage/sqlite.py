@@ -0,0 +1,155 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from whisper import secret
+from whisper.storage import store_backend
+
+logger = logging.getLogger(__name__)
+
+
+class sqlite(store_backend):
+    """SQLite store. Secrets are rows in a WAL mode database with an index on
+    the expiry date, so several worker processes on a host can share it and the
+    cleaner is a single DELETE statement."""
+
+    def __init__(self, name="sqlite", parent=None):
+        self.default_config = {"path": "/tmp/whisper.db", "timeout": 10}
+        super().__init__(name, parent)
+
+    def start(self):
+        self.local = threading.local()
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS secrets ("
+            "id TEXT PRIMARY KEY, create_date INTEGER, expire_date INTEGER, "
+            "expires_at INTEGER, hash TEXT, data BLOB)"
+        )
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS secrets_expires_at ON secrets (expires_at)"
+        )
+
+    def _db(self):
+        """Connection for the current thread"""
+        if not getattr(self.local, "db", None):
+            self.local.db = sqlite3.connect(
+                self.config.path, timeout=self.config.timeout, isolation_level=None
+            )
+            self.local.db.execute("PRAGMA synchronous=NORMAL")
+        return self.local.db
+
+    def get_secret(self, secret_id):
+        s = secret(secret_id)
+        if not s.check_id():
+            return False
+        row = (
+            self._db()
+            .execute(
+                "SELECT create_date, expire_date, hash, data FROM secrets "
+                "WHERE id = ?",
+                (s.id,),
+            )
+            .fetchone()
+        )
+        if not row:
+            return False
+        s.create_date, s.expire_date, s.hash, data = row
+        s.data = data.decode("utf-8")
+        logger.debug(f"Reading SQLite secret: {s.id}")
+        return s
+
+    def set_secret(self, s):
+        if not s.check_id():
+            return False
+        self._db().execute(
+            "REPLACE INTO secrets VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                s.id,
+                s.create_date,
+                s.expire_date,
+                s.expires_at(),
+                s.hash,
+                s.data.encode("utf-8"),
+            ),
+        )
+        logger.debug(f"Saving SQLite secret: {s.id}")
+        return True
+
+    def delete_secret(self, secret_id):
+        logger.info(f"Deleting SQLite secret: {secret_id}")
+        self._db().execute("DELETE FROM secrets WHERE id = ?", (secret_id,))
+        return True
+
+    def delete_expired(self):
+        cursor = self._db().execute(
+            "DELETE FROM secrets WHERE expires_at <= ?", (int(time.time()),)
+        )
+        logger.info(f"Deleted {cursor.rowcount} expired SQLite secrets")
+        # only expired rows are read, through the expiry index
+        return {"scanned": cursor.rowcount, "deleted": cursor.rowcount}
+
+    def stats(self):
+        """Return the stored secret count"""
+        (count,) = self._db().execute("SELECT COUNT(*) FROM secrets").fetchone()
+        return {"record_count": count}
+
+    def get_secret_metadata(self, secret_id):
+        s = secret(secret_id)
+        if not s.check_id():
+            return False
+        row = (
+            self._db()
+            .execute(
+                "SELECT create_date, expire_date FROM secrets WHERE id = ?", (s.id,)
+            )
+            .fetchone()
+        )
+        if not row:
+            return False
+        s.create_date, s.expire_date = row
+        return s
+
+    def secret_exists(self, secret_id):
+        return bool(self.get_secret_metadata(secret_id))
+
+    def list_secret_ids(self):
+        for (secret_id,) in self._db().execute("SELECT id FROM secrets"):
+            yield secret_id
+
+    @property
+    def cleaner_lock_path(self):
+        return f"{self.config.path}.cleaner.lock"
+
+    def consume_secret(self, secret_id, verifier):
+        """Check the password against the stored hash before reading the data.
+        One-time secrets are read and deleted by a single DELETE ... RETURNING
+        statement, so only one request can ever receive them."""
+        s = secret(secret_id)
+        if not s.check_id():
+            return False, False
+        db = self._db()
+        row = db.execute(
+            "SELECT create_date, expire_date, hash FROM secrets WHERE id = ?",
+            (s.id,),
+        ).fetchone()
+        if not row:
+            return False, False
+        s.create_date, s.expire_date, s.hash = row
+        if not verifier(s):
+            return s, False
+        if s.is_one_time():
+            row = db.execute(
+                "DELETE FROM secrets WHERE id = ? RETURNING data", (s.id,)
+            ).fetchone()
+            logger.info(f"Deleting SQLite secret: {s.id}")
+        else:
+            row = db.execute(
+                "SELECT data FROM secrets WHERE id = ?", (s.id,)
+            ).fetchone()
+        # the secret was consumed or deleted since it was first read
+        if not row:
+            return False, False
+        s.data = row[0].decode("utf-8")
+        return s, True
@@ -0,0 +1,134 @@
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from whisper import check_config, secret  # noqa: E402
+from whisper.hashers import bcrypt_hasher  # noqa: E402
+
+# cheap hashes, the tests check behaviour rather than hash strength
+secret.hasher = bcrypt_hasher(rounds=4)
+
+KEY_PASS = b"test-key" + b"password"
+DATA = "ZW5jcnlwdGVkIGRhdGE="
+
+BACKENDS = ["memory", "local", "sqlite", "segment", "shm", "redis", "s3", "gcs"]
+BACKENDS += ["shard"]
+
+
+def make_secret(expiration="1 day", data=DATA):
+    """A new secret with the test password"""
+    s = secret()
+    s.create(expiration, KEY_PASS, data)
+    return s
+
+
+def make_expired(one_time=False):
+    """A secret which the cleaner should delete"""
+    s = make_secret("once" if one_time else "1 day")
+    if one_time:
+        # one-time secrets expire 30 days after they are created
+        s.create_date -= 86400 * 31
+    else:
+        s.expire_date = int(time.time()) - 10
+    return s
+
+
+def configure(backend, **config):
+    """Set a backend's config the way the store wrapper does"""
+    backend.config = check_config(
+        {**backend.default_config, **config}, backend.default_config
+    )
+    return backend
+
+
+def verify(s):
+    return s.check_password(KEY_PASS)
+
+
+@pytest.fixture(params=BACKENDS)
+def backend_config(request, tmp_path, monkeypatch):
+    """Backend class and config for the backend named by the test parameter,
+    with S3 on moto, Redis on fakeredis and GCS on an emulator if
+    STORAGE_EMULATOR_HOST is set"""
+    # the default cleaner lock lives in the temp directory
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    name = request.param
+    if name == "memory":
+        from whisper.storage.memory import memory
+
+        yield memory, {}
+    elif name == "local":
+        from whisper.storage.local import local
+
+        yield local, {"path": str(tmp_path / "local")}
+    elif name == "sqlite":
+        from whisper.storage.sqlite import sqlite
+
+        yield sqlite, {"path": str(tmp_path / "whisper.db")}
+    elif name == "segment":
+        from whisper.storage.segment import segment
+
+        yield segment, {"path": str(tmp_path / "segments"), "compact_interval": 3600}
+    elif name == "shm":
+        from whisper.storage.shm import shm
+
+        yield shm, {"path": str(tmp_path / "whisper.store"), "capacity": 64}
+    elif name == "redis":
+        fakeredis = pytest.importorskip("fakeredis")
+        from whisper.storage import redis as redis_module
+
+        server = fakeredis.FakeServer()
+        monkeypatch.setattr(
+            redis_module,
+            "Redis",
+            lambda connection_pool: fakeredis.FakeRedis(server=server),
+        )
+        yield redis_module.redis, {}
+    elif name == "s3":
+        moto = pytest.importorskip("moto")
+        import boto3
+        from whisper.storage.aws import s3
+
+        monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+        monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+        with moto.mock_aws():
+            boto3.client("s3").create_bucket(Bucket="whisper-test")
+            yield s3, {"bucket_name": "whisper-test", "bucket_path": "secrets"}
+    elif name == "gcs":
+        if not os.environ.get("STORAGE_EMULATOR_HOST"):
+            pytest.skip("STORAGE_EMULATOR_HOST is not set")
+        from google.cloud import storage
+        from whisper.storage.gcp import gcs
+
+        bucket = f"whisper-test-{uuid.uuid4().hex[:8]}"
+        storage.Client(project="whisper-test").create_bucket(bucket)
+        yield gcs, {"bucket_name": bucket, "gcp_project": "whisper-test"}
+    elif name == "shard":
+        from whisper.storage.shard import shard
+
+        yield shard, {
+            "shards": [
+                {
+                    "name": n,
+                    "storage_class": "whisper.storage.local.local",
+                    "storage_config": {"path": str(tmp_path / n)},
+                }
+                for n in ["a", "b"]
+            ],
+            "rebalance_interval": 0,
+        }
+
+
+@pytest.fixture
+def backend(backend_config):
+    backend_class, config = backend_config
+    b = configure(backend_class(), **config)
+    b.start()
+    return b
@@ -0,0 +1,153 @@
+"""Create and retrieve secrets through the Flask app"""
+
+import importlib
+import os
+import runpy
+import sys
+
+import pytest
+import yaml
+
+from conftest import DATA
+from whisper import secret
+
+PASSWORD = "correct horse"
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory, monkeypatch_module):
+    path = tmp_path_factory.mktemp("app")
+    config = {
+        "secret_key": "test-key",
+        "storage_class": "whisper.storage.memory.memory",
+        "hash_config": {"params": {"rounds": 4}, "workers": 1},
+        "attempt_limit_config": {"path": str(path / "attempts.db")},
+    }
+    config_filename = path / "config.yaml"
+    config_filename.write_text(yaml.safe_dump(config))
+    monkeypatch_module.setenv("CONFIG_FILE", str(config_filename))
+    sys.modules.pop("app", None)
+    # the app sets the hash pool and hasher used by every secret
+    executor, hasher = secret.executor, secret.hasher
+    app = importlib.import_module("app")
+    yield app.app.test_client()
+    secret.executor, secret.hasher = executor, hasher
+    app.hash_pool.pool.shutdown()
+
+
+@pytest.fixture(scope="module")
+def monkeypatch_module():
+    with pytest.MonkeyPatch.context() as mp:
+        yield mp
+
+
+def create(client, expiration="1 day"):
+    response = client.post(
+        "/",
+        json={"expiration": expiration, "password": PASSWORD, "encrypted_data": DATA},
+    )
+    assert response.status_code == 200
+    return response.json["id"]
+
+
+def show(client, secret_id, password=PASSWORD):
+    return client.post(f"/{secret_id}", json={"password": password}).json
+
+
+def test_create_and_show(client):
+    secret_id = create(client)
+    assert client.get(f"/{secret_id}").status_code == 200
+    assert show(client, secret_id) == {"encrypted_data": DATA}
+    # multi-use secrets can be read again
+    assert show(client, secret_id) == {"encrypted_data": DATA}
+
+
+def create_stream(client, headers):
+    return client.post(
+        "/",
+        data=DATA.encode("utf-8"),
+        content_type="application/octet-stream",
+        headers=headers,
+    )
+
+
+def test_create_stream(client):
+    response = create_stream(
+        client, {"X-Whisper-Expiration": "1 hour", "X-Whisper-Password": PASSWORD}
+    )
+    assert show(client, response.json["id"]) == {"encrypted_data": DATA}
+    response = create_stream(
+        client,
+        {"X-Whisper-Expiration": "One time use", "X-Whisper-Password": PASSWORD},
+    )
+    secret_id = response.json["id"]
+    assert show(client, secret_id) == {"encrypted_data": DATA}
+    assert show(client, secret_id) == {"result": "Invalid ID"}
+
+
+def test_create_stream_missing_password(client):
+    response = create_stream(client, {"X-Whisper-Expiration": "1 hour"})
+    assert response.status_code == 400
+
+
+def test_create_stream_missing_expiration(client):
+    response = create_stream(client, {"X-Whisper-Password": PASSWORD})
+    assert response.status_code == 400
+
+
+def test_create_stream_invalid_expiration(client):
+    response = create_stream(
+        client, {"X-Whisper-Expiration": "1 hours", "X-Whisper-Password": PASSWORD}
+    )
+    assert response.status_code == 400
+
+
+def test_one_time(client):
+    secret_id = create(client, expiration="once")
+    assert show(client, secret_id) == {"encrypted_data": DATA}
+    assert show(client, secret_id) == {"result": "Invalid ID"}
+    # the secret page redirects to a new secret once it is gone
+    assert client.get(f"/{secret_id}").status_code == 302
+
+
+def test_bad_password(client):
+    secret_id = create(client, expiration="once")
+    assert show(client, secret_id, "wrong") == {"result": "Invalid password."}
+    # a wrong password doesn't use up a one-time secret
+    assert show(client, secret_id) == {"encrypted_data": DATA}
+
+
+def test_unknown_id(client):
+    assert show(client, "0" * 40) == {"result": "Invalid ID"}
+    assert client.get(f"/{'0' * 40}").status_code == 302
+
+
+@pytest.mark.parametrize("stored_hash", ["$md5$not-a-hash", "$2b$04$truncated"])
+def test_unreadable_hash(client, stored_hash):
+    from app import store
+
+    secret_id = create(client)
+    s = store.get_secret(secret_id)
+    s.hash = stored_hash
+    store.set_secret(s)
+    assert show(client, secret_id) == {"result": "Invalid password."}
+
+
+def test_store_full(client, monkeypatch):
+    from app import store
+
+    # a byte budget no secret fits in
+    monkeypatch.setitem(store.backend.config, "max_bytes", 1)
+    response = client.post(
+        "/",
+        json={"expiration": "1 day", "password": PASSWORD, "encrypted_data": DATA},
+    )
+    assert response.status_code == 507
+
+
+def test_worker_import_starts_nothing(client):
+    # hash pool workers import the app again as __mp_main__ when it is run
+    # directly with python app.py
+    path = os.path.join(os.path.dirname(__file__), "..", "src", "app.py")
+    module = runpy.run_path(path, run_name="__mp_main__")
+    assert "hash_pool" not in module and "limiter" not in module
@@ -0,0 +1,131 @@
+"""LRU cache of multi-use secrets in front of the storage backend"""
+
+import types
+
+import pytest
+
+from conftest import DATA, configure, make_secret, verify
+from whisper.storage import cache as cache_module
+from whisper.storage import store
+from whisper.storage.cache import secret_cache
+from whisper.storage.memory import memory
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time as seen by the cache, moved on by the test"""
+    clock = types.SimpleNamespace(now=cache_module.time.time())
+    monkeypatch.setattr(
+        cache_module, "time", types.SimpleNamespace(time=lambda: clock.now)
+    )
+    return clock
+
+
+def entry_size(s):
+    return len(s.data) + len(s.hash) + 256
+
+
+@pytest.fixture
+def cached_store():
+    """A store with the cache in front of a memory backend, without the
+    cleaner thread"""
+    st = store("whisper.storage.memory.memory")
+    st.backend = configure(memory())
+    st.backend.start()
+    st.cache = secret_cache({"enabled": True})
+    return st
+
+
+def test_get_returns_copy():
+    cache = secret_cache({"enabled": True})
+    s = make_secret()
+    cache.put(s)
+    cached = cache.get(s.id)
+    assert (cached.id, cached.hash, cached.data) == (s.id, s.hash, s.data)
+    cached.data = None
+    assert cache.get(s.id).data == DATA
+    assert cache.stats()["hits"] == 2
+
+
+def test_one_time_not_cached():
+    cache = secret_cache({"enabled": True})
+    s = make_secret("once")
+    cache.put(s)
+    assert cache.get(s.id) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_lru_eviction():
+    first, second, third = make_secret(), make_secret(), make_secret()
+    cache = secret_cache({"enabled": True, "max_bytes": entry_size(first) * 2})
+    cache.put(first)
+    cache.put(second)
+    # reading first makes second the least recently used
+    assert cache.get(first.id)
+    cache.put(third)
+    assert cache.get(second.id) is None
+    assert cache.get(first.id) and cache.get(third.id)
+    assert cache.stats()["bytes"] == entry_size(first) * 2
+
+
+def test_oversized_entry_not_cached():
+    s = make_secret()
+    cache = secret_cache({"enabled": True, "max_entry_bytes": entry_size(s) - 1})
+    cache.put(s)
+    assert cache.get(s.id) is None
+
+
+def test_ttl_and_expiration(clock):
+    cache = secret_cache({"enabled": True, "ttl": 60})
+    s = make_secret("1 hour")
+    cache.put(s)
+    clock.now += 61
+    assert cache.get(s.id) is None
+    # never kept past the secret's expiration date
+    s.expire_date = int(clock.now) + 10
+    cache.put(s)
+    clock.now += 11
+    cache.delete_expired()
+    assert cache.stats()["entries"] == 0
+
+
+def test_consume_caches_multi_use(cached_store):
+    s = make_secret()
+    cached_store.set_secret(s)
+    assert cached_store.consume_secret(s.id, verify)[1]
+    assert cached_store.cache.get(s.id)
+
+
+def test_delete_invalidates(cached_store):
+    s = make_secret()
+    cached_store.set_secret(s)
+    cached_store.consume_secret(s.id, verify)
+    cached_store.delete_secret(s.id)
+    assert cached_store.get_secret(s.id) is False
+    assert cached_store.consume_secret(s.id, verify) == (False, False)
+
+
+def test_set_invalidates(cached_store):
+    s = make_secret()
+    cached_store.set_secret(s)
+    cached_store.consume_secret(s.id, verify)
+    s.data = "bmV3IGRhdGE="
+    cached_store.set_secret(s)
+    assert cached_store.get_secret(s.id).data == "bmV3IGRhdGE="
+
+
+def test_one_time_consumed_once(cached_store):
+    s = make_secret("once")
+    cached_store.set_secret(s)
+    assert cached_store.get_secret(s.id)
+    assert cached_store.consume_secret(s.id, verify)[1]
+    assert cached_store.consume_secret(s.id, verify)[0] is False
+    assert cached_store.get_secret(s.id) is False
+
+
+def test_consume_stream_caches_multi_use(cached_store):
+    s = make_secret()
+    cached_store.set_secret(s)
+    _, valid, chunks = cached_store.consume_secret_stream(s.id, verify)
+    assert valid and "".join(chunks) == DATA
+    assert cached_store.cache.get(s.id).data == DATA
@@ -0,0 +1,137 @@
+"""Counting Bloom filter of stored secret IDs"""
+
+import random
+import time
+import uuid
+
+import pytest
+
+from conftest import configure, make_secret, verify
+from whisper.storage import store
+from whisper.storage.filter import secret_filter
+from whisper.storage.memory import memory
+
+
+class listing:
+    """Backend stand-in listing a fixed set of IDs"""
+
+    def __init__(self, ids=(), during=None):
+        self.ids = list(ids)
+        self.during = during
+
+    def list_secret_ids(self):
+        for n, secret_id in enumerate(self.ids):
+            if n == len(self.ids) // 2 and self.during:
+                self.during()
+            yield secret_id
+
+
+def wait_built(f):
+    """Wait for the rebuild thread started by start() to finish"""
+    deadline = time.time() + 10
+    while not f._header()[3]:
+        assert time.time() < deadline, "filter was not built"
+        time.sleep(0.01)
+    while f._header()[4]:
+        assert time.time() < deadline, "filter rebuild did not finish"
+        time.sleep(0.01)
+
+
+def make_filter(tmp_path, backend=None, **config):
+    f = secret_filter({"enabled": True, "path": str(tmp_path / "filter"), **config})
+    f.start(backend or listing())
+    wait_built(f)
+    return f
+
+
+def new_ids(n):
+    return [uuid.uuid4().hex for _ in range(n)]
+
+
+def test_no_false_negatives_after_add_and_remove(tmp_path):
+    f = make_filter(tmp_path, capacity=1000)
+    ids = new_ids(1000)
+    for secret_id in ids:
+        f.add(secret_id)
+    removed = set(random.sample(ids, 500))
+    for secret_id in removed:
+        f.remove(secret_id)
+    assert all(f.might_contain(i) for i in ids if i not in removed)
+    # removed and never added IDs are mostly rejected
+    assert sum(f.might_contain(i) for i in removed) < 50
+    assert sum(f.might_contain(i) for i in new_ids(1000)) < 50
+
+
+def test_listed_ids_kept_by_rebuild(tmp_path):
+    ids = new_ids(100)
+    f = make_filter(tmp_path, backend=listing(ids))
+    assert all(f.might_contain(i) for i in ids)
+
+
+def test_ids_added_during_rebuild_kept(tmp_path):
+    added = new_ids(10)
+    backend = listing(new_ids(100))
+    f = make_filter(tmp_path, backend=backend)
+    backend.during = lambda: [f.add(i) for i in added]
+    f._rebuild()
+    assert all(f.might_contain(i) for i in backend.ids + added)
+
+
+def test_saturated_counters_not_decremented(tmp_path):
+    f = make_filter(tmp_path, capacity=10)
+    for _ in range(300):
+        f.add("a")
+    for _ in range(300):
+        f.remove("a")
+    assert f.might_contain("a")
+
+
+def test_everything_allowed_before_first_build(tmp_path):
+    backend = listing()
+    backend.list_secret_ids = lambda: None
+    f = secret_filter({"enabled": True, "path": str(tmp_path / "filter")})
+    f.start(backend)
+    assert f.might_contain(uuid.uuid4().hex)
+
+
+def test_shared_between_processes(tmp_path):
+    first = make_filter(tmp_path)
+    second = make_filter(tmp_path)
+    first.add("a")
+    assert second.might_contain("a")
+    second.remove("a")
+    assert not first.might_contain("a")
+
+
+@pytest.fixture
+def filtered_store(tmp_path):
+    """A store with the filter in front of a memory backend, without the
+    cleaner thread"""
+    st = store("whisper.storage.memory.memory")
+    st.backend = configure(memory())
+    st.backend.start()
+    st.filter = make_filter(tmp_path, backend=st.backend)
+    return st
+
+
+def test_store_updates_filter(filtered_store):
+    multi, once = make_secret(), make_secret("once")
+    filtered_store.set_secret(multi)
+    filtered_store.set_secret(once)
+    assert filtered_store.filter.might_contain(multi.id)
+    assert filtered_store.filter.might_contain(once.id)
+    assert filtered_store.consume_secret(once.id, verify)[1]
+    assert filtered_store.consume_secret(multi.id, verify)[1]
+    assert not filtered_store.filter.might_contain(once.id)
+    assert filtered_store.filter.might_contain(multi.id)
+
+
+def test_store_skips_backend_for_unknown_ids(filtered_store, monkeypatch):
+    def fail(*args):
+        raise AssertionError("backend called")
+
+    monkeypatch.setattr(filtered_store.backend, "get_secret", fail)
+    monkeypatch.setattr(filtered_store.backend, "consume_secret", fail)
+    s = make_secret()
+    assert filtered_store.get_secret(s.id) is False
+    assert filtered_store.consume_secret(s.id, verify) == (False, False)
@@ -0,0 +1,44 @@
+"""Password hashers and their configuration"""
+
+import pytest
+
+from conftest import KEY_PASS
+from whisper import ConfigError
+from whisper.hashers import scrypt_hasher
+from whisper.hashing import load_hasher
+
+
+def test_scrypt_calibrate_memory_limit():
+    hasher = scrypt_hasher(ln=10)
+    # a target no host reaches within 16 MB
+    hasher.calibrate(10**9, max_memory=16 * 2**20)
+    assert hasher.params["ln"] == 14
+    assert hasher.memory(hasher.params) <= 16 * 2**20
+
+
+def test_load_hasher_memory_limit():
+    hasher = load_hasher("scrypt", {"ln": 10}, target_ms=10**9, max_memory_mb=16)
+    assert hasher.memory(hasher.params) <= 16 * 2**20
+    with pytest.raises(ConfigError):
+        load_hasher("scrypt", {"ln": 20}, max_memory_mb=64)
+    # no limit
+    assert load_hasher("scrypt", {"ln": 20}).params["ln"] == 20
+
+
+@pytest.mark.parametrize(
+    "hashed",
+    [
+        "$scrypt$ln=10,r=8$c2FsdA==$ZGlnZXN0",
+        "$scrypt$ln=10,r=8,p=1$not base64$",
+        "$scrypt$",
+    ],
+)
+def test_scrypt_verify_malformed(hashed):
+    assert not scrypt_hasher(ln=10).verify(KEY_PASS, hashed)
+
+
+def test_scrypt_verify():
+    hasher = scrypt_hasher(ln=10)
+    hashed = hasher.hash(KEY_PASS)
+    assert hasher.verify(KEY_PASS, hashed)
+    assert not hasher.verify(b"wrong", hashed)
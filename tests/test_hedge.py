@@ -0,0 +1,119 @@
+"""Hedged reads for cloud stores"""
+
+import threading
+import time
+
+import pytest
+
+from whisper.storage import hedge as hedge_module
+from whisper.storage.hedge import read_hedger
+
+
+class slow_read:
+    """Read whose first call takes a second, later calls return at once"""
+
+    def __init__(self, delay=1):
+        self.delay = delay
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, key):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        if call == 1:
+            time.sleep(self.delay)
+            return f"{key}-slow"
+        return f"{key}-fast"
+
+
+def make_hedger(**config):
+    h = read_hedger({"enabled": True, **config}, workers=4, backend="test")
+    # latencies measured by the tests themselves would move the delay
+    h._record = lambda latency: None
+    return h
+
+
+def test_disabled_reads_once():
+    h = read_hedger({}, backend="test")
+    read = slow_read(delay=0)
+    assert h.read(read, "a") == "a-slow"
+    assert read.calls == 1
+    assert h.stats() == {}
+
+
+def test_delay_from_percentile():
+    h = read_hedger({"enabled": True, "percentile": 90, "window": 100}, backend="test")
+    for n in range(hedge_module.MIN_SAMPLES - 1):
+        h._record(1)
+    assert h.delay is None
+    h.latencies.clear()
+    h.samples = 0
+    for ms in range(1, 101):
+        h._record(ms / 1000)
+    assert h.delay == pytest.approx(0.091)
+    # never below min_delay_ms, once the window has moved on
+    for _ in range(100):
+        h._record(0.0001)
+    assert h.delay == pytest.approx(0.005)
+
+
+def test_no_hedge_without_samples():
+    h = make_hedger(max_rate=1)
+    read = slow_read(delay=0.05)
+    assert h.read(read, "a") == "a-slow"
+    assert read.calls == 1
+
+
+def test_fast_read_not_hedged():
+    h = make_hedger(max_rate=1)
+    h.delay = 0.5
+    read = slow_read(delay=0)
+    assert h.read(read, "a") == "a-slow"
+    assert read.calls == 1
+    assert h.stats()["hedge_rate"] == 0
+
+
+def test_hedge_fires_past_delay():
+    h = make_hedger(max_rate=1)
+    h.delay = 0.01
+    read = slow_read()
+    discarded = threading.Event()
+    start = time.perf_counter()
+    result = h.read(read, "a", discard=lambda r: discarded.set())
+    assert result == "a-fast"
+    assert time.perf_counter() - start < 0.5
+    assert read.calls == 2
+    assert h.stats() == {"hedge_delay_ms": 10, "hedge_rate": 1}
+    # the losing first read is discarded once it returns
+    assert discarded.wait(5)
+
+
+def test_hedges_limited_to_max_rate():
+    h = make_hedger(max_rate=0.1)
+    h.delay = 0.001
+    calls = []
+
+    def read(key):
+        calls.append(key)
+        time.sleep(0.01)
+        return key
+
+    for n in range(50):
+        assert h.read(read, n) == n
+    assert 4 <= h.hedges <= 5
+    assert len(calls) == 50 + h.hedges
+    assert h.stats()["hedge_rate"] <= 0.1
+
+
+def test_saved_hedges_capped():
+    h = make_hedger(max_rate=0.5)
+    for n in range(100):
+        h.read(lambda: None)
+    assert h.tokens == hedge_module.MAX_TOKENS
+    h.delay = 0.001
+    for n in range(20):
+        h.read(time.sleep, 0.01)
+    # ten saved up, and nine earned as the first of these reads found the
+    # bucket full, not the sixty earned in all
+    assert h.hedges == hedge_module.MAX_TOKENS + 9
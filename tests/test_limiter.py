@@ -0,0 +1,82 @@
+"""Retrieval attempt token buckets"""
+
+import types
+
+import pytest
+
+from whisper import limiter as limiter_module
+from whisper.limiter import attempt_limiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time as seen by the limiter, moved on by the test"""
+    clock = types.SimpleNamespace(now=1000000.0)
+    monkeypatch.setattr(
+        limiter_module, "time", types.SimpleNamespace(time=lambda: clock.now)
+    )
+    return clock
+
+
+def make_limiter(tmp_path, **config):
+    limiter = attempt_limiter({"path": str(tmp_path / "attempts.db"), **config})
+    limiter.start()
+    return limiter
+
+
+def test_bucket_denies_when_empty_and_refills(tmp_path, clock):
+    limiter = make_limiter(tmp_path, id_burst=3, id_rate=0.1)
+    assert all(limiter.allow("a", f"10.0.0.{i}") for i in range(3))
+    assert not limiter.allow("a", "10.0.0.9")
+    # a token refills every 10 seconds
+    clock.now += 5
+    assert not limiter.allow("a", "10.0.0.9")
+    clock.now += 5
+    assert limiter.allow("a", "10.0.0.9")
+    assert not limiter.allow("a", "10.0.0.9")
+    # refills stop at the burst size
+    clock.now += 3600
+    assert all(limiter.allow("a", f"10.0.1.{i}") for i in range(3))
+    assert not limiter.allow("a", "10.0.1.9")
+
+
+def test_ip_bucket(tmp_path, clock):
+    limiter = make_limiter(tmp_path, ip_burst=2, ip_rate=0.5)
+    assert limiter.allow("a", "10.0.0.1")
+    assert limiter.allow("b", "10.0.0.1")
+    assert not limiter.allow("c", "10.0.0.1")
+    assert limiter.allow("c", "10.0.0.2")
+    clock.now += 2
+    assert limiter.allow("d", "10.0.0.1")
+
+
+def test_denial_takes_no_tokens(tmp_path, clock):
+    limiter = make_limiter(tmp_path, id_burst=2, ip_burst=1)
+    assert limiter.allow("a", "10.0.0.1")
+    # denied by the empty IP bucket, the ID bucket keeps both tokens
+    assert not limiter.allow("b", "10.0.0.1")
+    assert limiter.allow("b", "10.0.0.2")
+    assert limiter.allow("b", "10.0.0.3")
+    assert not limiter.allow("b", "10.0.0.4")
+
+
+def test_buckets_shared_between_processes(tmp_path, clock):
+    first = make_limiter(tmp_path, id_burst=1)
+    second = make_limiter(tmp_path, id_burst=1)
+    assert first.allow("a", "10.0.0.1")
+    assert not second.allow("a", "10.0.0.2")
+
+
+def test_disabled(tmp_path, clock):
+    limiter = make_limiter(tmp_path, enabled=False, id_burst=1)
+    assert all(limiter.allow("a", "10.0.0.1") for _ in range(10))
+
+
+def test_max_failures(tmp_path, clock):
+    limiter = make_limiter(tmp_path, max_failures=3)
+    assert not limiter.record_failure("a")
+    assert not limiter.record_failure("a")
+    limiter.reset_failures("a")
+    assert not limiter.record_failure("a")
+    assert not limiter.record_failure("a")
+    assert limiter.record_failure("a")
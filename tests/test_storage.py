@@ -0,0 +1,462 @@
+"""Contract tests run against every storage backend, followed by tests of
+backend specific behaviour"""
+
+import io
+import os
+from unittest import mock
+
+import pytest
+
+from botocore.exceptions import ClientError
+from conftest import DATA, KEY_PASS, configure, make_expired, make_secret, verify
+from whisper import ConfigError, secret, serialization
+from whisper.hashers import scrypt_hasher
+from whisper.storage import StoreFullError, store_backend
+from whisper.storage.local import local
+from whisper.storage.memory import memory, record
+
+
+def test_set_get(backend):
+    s = make_secret()
+    assert backend.set_secret(s)
+    stored = backend.get_secret(s.id)
+    assert stored.id == s.id
+    assert stored.data == DATA
+    assert stored.hash == s.hash
+    assert (stored.create_date, stored.expire_date) == (s.create_date, s.expire_date)
+
+
+def test_get_missing(backend):
+    assert not backend.get_secret(make_secret().id)
+    assert not backend.get_secret("../../etc/passwd")
+
+
+def test_delete(backend):
+    s = make_secret()
+    backend.set_secret(s)
+    backend.delete_secret(s.id)
+    assert not backend.get_secret(s.id)
+    assert not backend.secret_exists(s.id)
+
+
+def test_metadata(backend):
+    s = make_secret()
+    backend.set_secret(s)
+    meta = backend.get_secret_metadata(s.id)
+    assert (meta.create_date, meta.expire_date) == (s.create_date, s.expire_date)
+    assert backend.secret_exists(s.id)
+    assert not backend.secret_exists(make_secret().id)
+
+
+def test_set_secret_stream(backend):
+    s = make_secret(data=None)
+    backend.set_secret_stream(s, io.BytesIO(DATA.encode("utf-8")))
+    assert backend.get_secret(s.id).data == DATA
+
+
+def test_consume_multi_use(backend):
+    s = make_secret()
+    backend.set_secret(s)
+    consumed, valid = backend.consume_secret(s.id, lambda s: False)
+    assert consumed.id == s.id and not valid
+    consumed, valid = backend.consume_secret(s.id, verify)
+    assert valid and consumed.data == DATA
+    assert backend.secret_exists(s.id)
+
+
+def test_consume_one_time(backend):
+    s = make_secret("once")
+    backend.set_secret(s)
+    consumed, valid = backend.consume_secret(s.id, lambda s: False)
+    assert consumed.id == s.id and not valid
+    assert backend.secret_exists(s.id)
+    consumed, valid = backend.consume_secret(s.id, verify)
+    assert valid and consumed.data == DATA
+    assert not backend.secret_exists(s.id)
+    assert backend.consume_secret(s.id, verify) == (False, False)
+
+
+def test_consume_missing(backend):
+    assert backend.consume_secret(make_secret().id, verify) == (False, False)
+
+
+def test_consume_stream_one_time(backend):
+    s = make_secret("once")
+    backend.set_secret(s)
+    consumed, valid, chunks = backend.consume_secret_stream(s.id, verify)
+    assert valid and "".join(chunks) == DATA
+    assert not backend.secret_exists(s.id)
+
+
+def test_delete_expired(backend):
+    live = make_secret()
+    expired = [make_expired(), make_expired(one_time=True)]
+    for s in [live] + expired:
+        backend.set_secret(s)
+    if not backend.native_expiry:
+        result = backend.delete_expired()
+        assert set(result) == {"scanned", "deleted"}
+    assert backend.secret_exists(live.id)
+    for s in expired:
+        assert not backend.secret_exists(s.id)
+
+
+def test_list_secret_ids(backend):
+    s = make_secret()
+    backend.set_secret(s)
+    ids = backend.list_secret_ids()
+    assert ids is None or s.id in set(ids)
+
+
+def test_cleaner_lease(backend, backend_config):
+    assert backend.acquire_cleaner_lease("first", 60, {"runs": 1})
+    # renewed by its holder
+    assert backend.acquire_cleaner_lease("first", 60, {"runs": 2})
+    backend_class, config = backend_config
+    rival = configure(backend_class(), **config)
+    # leases kept in the backend's storage need a connection, the default file
+    # lock only needs the config
+    if type(rival).acquire_cleaner_lease is not store_backend.acquire_cleaner_lease:
+        rival.start()
+    if isinstance(backend, memory):
+        # secrets are kept per process, so every process sweeps its own
+        assert rival.acquire_cleaner_lease("second", 60)
+    else:
+        assert not rival.acquire_cleaner_lease("second", 60)
+
+
+def test_consume_failed_verifier_keeps_secret(backend):
+    s = make_secret("once")
+    backend.set_secret(s)
+
+    def verifier(s):
+        raise RuntimeError("hash pool is full")
+
+    with pytest.raises(RuntimeError):
+        backend.consume_secret(s.id, verifier)
+    assert backend.secret_exists(s.id)
+    assert backend.consume_secret(s.id, verify)[1]
+
+
+def test_consume_readable_while_verifying(backend):
+    s = make_secret("once")
+    backend.set_secret(s)
+    seen = []
+
+    def verifier(checked):
+        seen.append(backend.secret_exists(s.id))
+        return False
+
+    backend.consume_secret(s.id, verifier)
+    assert seen == [True]
+
+
+def test_consume_after_concurrent_delete(backend):
+    s = make_secret("once")
+    backend.set_secret(s)
+
+    def verifier(checked):
+        # deleted by another request while the password is checked
+        backend.delete_secret(s.id)
+        return checked.check_password(KEY_PASS)
+
+    assert backend.consume_secret(s.id, verifier) == (False, False)
+    assert not backend.secret_exists(s.id)
+    backend.consume_secret(s.id, lambda s: False)
+    assert not backend.secret_exists(s.id)
+
+
+@pytest.mark.parametrize("backend_config", ["shm"], indirect=True)
+def test_shm_scrypt_hash(backend_config, monkeypatch):
+    monkeypatch.setattr(secret, "hasher", scrypt_hasher(ln=10))
+    backend_class, config = backend_config
+    backend = configure(backend_class(), **config)
+    backend.start()
+    s = make_secret()
+    assert len(s.hash) > 128
+    backend.set_secret(s)
+    assert backend.get_secret(s.id).hash == s.hash
+
+
+@pytest.mark.parametrize("backend_config", ["shm"], indirect=True)
+def test_shm_hash_too_long(backend_config, monkeypatch):
+    monkeypatch.setattr(secret, "hasher", scrypt_hasher(ln=10))
+    monkeypatch.setattr(scrypt_hasher, "hash_length", lambda self: 1000)
+    backend_class, config = backend_config
+    with pytest.raises(ConfigError):
+        configure(backend_class(), **config).start()
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "DeleteObject")
+
+
+@pytest.mark.parametrize("backend_config", ["s3"], indirect=True)
+@pytest.mark.parametrize("code", ["PreconditionFailed", "NoSuchKey"])
+def test_s3_consume_lost_race(backend, monkeypatch, code):
+    s = make_secret("once")
+    backend.set_secret(s)
+    monkeypatch.setattr(
+        backend.client, "delete_object", mock.Mock(side_effect=client_error(code))
+    )
+    assert backend.consume_secret(s.id, verify) == (False, False)
+    assert backend.consume_secret_stream(s.id, verify) == (False, False, None)
+
+
+@pytest.mark.parametrize("backend_config", ["s3"], indirect=True)
+def test_s3_consume_delete_error(backend, monkeypatch):
+    s = make_secret("once")
+    backend.set_secret(s)
+    monkeypatch.setattr(
+        backend.client,
+        "delete_object",
+        mock.Mock(side_effect=client_error("AccessDenied")),
+    )
+    with pytest.raises(ClientError):
+        backend.consume_secret(s.id, verify)
+    with pytest.raises(ClientError):
+        backend.consume_secret_stream(s.id, verify)
+    assert backend.secret_exists(s.id)
+
+
+@pytest.mark.parametrize("backend_config", ["s3"], indirect=True)
+def test_s3_consume_stream_closes_body(backend, monkeypatch):
+    s = make_secret("once")
+    backend.set_secret(s)
+    bodies = []
+    get_s3_obj = backend.get_s3_obj
+
+    def recording_get(key):
+        store_obj = get_s3_obj(key)
+        bodies.append(store_obj["Body"])
+        return store_obj
+
+    def verifier(s):
+        raise RuntimeError("hash pool is full")
+
+    monkeypatch.setattr(backend, "get_s3_obj", recording_get)
+    with pytest.raises(RuntimeError):
+        backend.consume_secret_stream(s.id, verifier)
+    assert bodies and all(body._raw_stream.closed for body in bodies)
+
+
+@pytest.mark.parametrize("backend_config", ["shard"], indirect=True)
+def test_shard_list_secret_ids_unsupported(backend, monkeypatch):
+    s = make_secret()
+    backend.set_secret(s)
+    assert s.id in set(backend.list_secret_ids())
+    shard = next(iter(backend.shards.values()))
+    monkeypatch.setattr(shard, "list_secret_ids", lambda: None)
+    assert backend.list_secret_ids() is None
+
+
+def budget_memory(tmp_path, overflow, secrets=2):
+    """A memory store with room for a number of test secrets"""
+    size = record(make_secret()).size
+    backend = configure(
+        memory(),
+        max_bytes=size * secrets + size // 2,
+        overflow=overflow,
+        overflow_path=str(tmp_path / "overflow"),
+    )
+    backend.start()
+    return backend
+
+
+def in_memory(backend, secret_id):
+    return secret_id in backend._stripe(secret_id).secrets
+
+
+def test_memory_budget_reject(tmp_path):
+    backend = budget_memory(tmp_path, "reject")
+    stored = [make_secret(), make_secret()]
+    for s in stored:
+        backend.set_secret(s)
+    with pytest.raises(StoreFullError):
+        backend.set_secret(make_secret())
+    stats = backend.stats()
+    assert stats["record_count"] == 2
+    assert stats["resident_bytes"] == sum(record(s).size for s in stored)
+    assert stats["resident_bytes"] <= stats["max_bytes"]
+    # deleting frees room
+    backend.delete_secret(stored[0].id)
+    backend.set_secret(make_secret())
+    assert backend.stats()["record_count"] == 2
+
+
+def test_memory_budget_spill(tmp_path):
+    backend = budget_memory(tmp_path, "spill")
+    oldest, middle, newest = make_secret(), make_secret(), make_secret()
+    for s in [oldest, middle, newest]:
+        backend.set_secret(s)
+    assert not in_memory(backend, oldest.id)
+    assert backend.overflow.secret_exists(oldest.id)
+    assert in_memory(backend, middle.id) and in_memory(backend, newest.id)
+    assert backend.stats()["record_count"] == 2
+    # spilled secrets are still read, consumed and deleted through the store
+    assert backend.get_secret(oldest.id).data == DATA
+    assert backend.consume_secret(oldest.id, verify)[1]
+    backend.delete_secret(oldest.id)
+    assert not backend.secret_exists(oldest.id)
+
+
+def test_memory_budget_one_time_not_spilled(tmp_path):
+    backend = budget_memory(tmp_path, "spill")
+    for _ in range(2):
+        backend.set_secret(make_secret("once"))
+    with pytest.raises(StoreFullError):
+        backend.set_secret(make_secret("once"))
+    assert not list(backend.overflow.list_secret_ids())
+
+
+def test_memory_budget_oversized(tmp_path):
+    backend = budget_memory(tmp_path, "spill")
+    s = make_secret()
+    backend.set_secret(s)
+    with pytest.raises(StoreFullError):
+        backend.set_secret(make_secret(data=DATA * 100))
+    # nothing was spilled to make room for a secret which can't fit
+    assert in_memory(backend, s.id)
+    assert backend.stats()["record_count"] == 1
+
+
+def test_memory_budget_replace(tmp_path):
+    backend = budget_memory(tmp_path, "reject")
+    s = make_secret()
+    for _ in range(5):
+        backend.set_secret(s)
+    assert backend.stats()["record_count"] == 1
+    assert backend.reserved_bytes == backend.stats()["resident_bytes"]
+
+
+@pytest.mark.parametrize("backend_config", ["redis"], indirect=True)
+def test_redis_consume_round_trips(backend, monkeypatch):
+    # the first consume loads the delete script
+    warm = make_secret("once")
+    backend.set_secret(warm)
+    backend.consume_secret(warm.id, verify)
+    s = make_secret("once")
+    backend.set_secret(s)
+    commands = []
+    execute_command = backend.client.execute_command
+
+    def recording_execute(*args, **kwargs):
+        commands.append(args[0])
+        return execute_command(*args, **kwargs)
+
+    monkeypatch.setattr(backend.client, "execute_command", recording_execute)
+    assert backend.consume_secret(s.id, verify)[1]
+    assert commands == ["MGET", "EVALSHA"]
+
+
+@pytest.mark.parametrize("backend_config", ["redis"], indirect=True)
+def test_redis_consume_rewritten(backend):
+    s = make_secret("once")
+    backend.set_secret(s)
+    rewritten = make_secret("once")
+    rewritten.id = s.id
+
+    def verifier(checked):
+        # written again while the password is checked
+        backend.set_secret(rewritten)
+        return True
+
+    assert backend.consume_secret(s.id, verifier) == (False, False)
+    assert backend.get_secret(s.id).hash == rewritten.hash
+
+
+def flat_local(tmp_path, *secrets):
+    """A local store holding secrets written before fan out was enabled"""
+    backend = configure(local(), path=str(tmp_path / "local"))
+    os.makedirs(backend.config.path)
+    # an existing index directory stops start() from rebuilding it
+    os.makedirs(backend.index_path)
+    for s in secrets:
+        with open(backend._flat_path(s.id), "wb") as secret_file:
+            secret_file.write(serialization.dumps(s))
+    return backend
+
+
+def test_local_delete_during_fanout_migration(tmp_path, monkeypatch):
+    s = make_secret()
+    backend = flat_local(tmp_path, s)
+    fanout_filename = backend.secret_path(s.id)
+    moved = []
+
+    def migrate_after(fn):
+        # the flat file is moved just after the fan out path was looked at
+        def wrapper(filename):
+            try:
+                return fn(filename)
+            finally:
+                if filename == fanout_filename and not moved:
+                    moved.append(filename)
+                    backend.migrate_fanout()
+
+        return wrapper
+
+    monkeypatch.setattr(os.path, "exists", migrate_after(os.path.exists))
+    monkeypatch.setattr(os, "remove", migrate_after(os.remove))
+    backend.delete_secret(s.id)
+    assert moved
+    assert not os.path.exists(fanout_filename)
+    assert not backend.secret_exists(s.id)
+
+
+def test_local_consume_during_fanout_migration(tmp_path):
+    s = make_secret("once")
+    backend = flat_local(tmp_path, s)
+
+    def verifier(checked):
+        backend.migrate_fanout()
+        return checked.check_password(KEY_PASS)
+
+    consumed, valid = backend.consume_secret(s.id, verifier)
+    assert valid and consumed.data == DATA
+    assert not backend.secret_exists(s.id)
+
+
+def test_local_fanout_migration_keeps_newer(tmp_path):
+    s = make_secret()
+    backend = flat_local(tmp_path, s)
+    rehashed = make_secret()
+    rehashed.id = s.id
+    # written to the fan out layout after the migration's scan started
+    backend.set_secret(rehashed)
+    backend.migrate_fanout()
+    assert backend.get_secret(s.id).hash == rehashed.hash
+    assert not os.path.exists(backend._flat_path(s.id))
+
+
+@pytest.mark.parametrize("backend_config", ["s3"], indirect=True)
+def test_s3_index_built_by_cleaner(backend_config, monkeypatch):
+    backend_class, config = backend_config
+    writer = configure(backend_class(), **config)
+    writer.start()
+    live, expired = make_secret(), make_expired()
+    for s in [live, expired]:
+        # stored by a version without the expiry index
+        writer.put_s3_obj(s)
+    backend = configure(backend_class(), **config)
+    backend.start()
+    assert not list(backend.list_s3_keys(backend.index_prefix))
+    rebuilds = mock.Mock(wraps=backend.rebuild_index)
+    monkeypatch.setattr(backend, "rebuild_index", rebuilds)
+    assert backend.delete_expired()["deleted"] == 1
+    assert backend.secret_exists(live.id)
+    assert not backend.secret_exists(expired.id)
+    backend.delete_expired()
+    assert rebuilds.call_count == 1
+
+
+@pytest.mark.parametrize("backend_config", ["s3"], indirect=True)
+@pytest.mark.parametrize("lease", [b'{"owner": "gone", "expi', b"[]", b"{}"])
+def test_s3_unreadable_lease(backend, backend_config, lease):
+    backend.client.put_object(
+        Body=lease, Bucket="whisper-test", Key="secrets/_cleaner.lease"
+    )
+    assert backend.acquire_cleaner_lease("first", 60)
+    backend_class, config = backend_config
+    rival = configure(backend_class(), **config)
+    rival.start()
+    assert not rival.acquire_cleaner_lease("second", 60)